@@ -0,0 +1,92 @@
+import random
+from datetime import datetime, timedelta, timezone
+
+# Number of records of the synthetic corpora used by the benchmarks
+CORPUS_SIZES = {"10k": 10_000, "1m": 1_000_000, "10m": 10_000_000}
+
+# Tag vocabulary: a few very common tags, then a long tail drawn with decreasing frequencies
+COMMON_TAGS = ["safe", "pony", "solo", "cute", "oc", "smiling", "looking at you", "simple background"]
+RARE_TAGS = [f"tag {position}" for position in range(5000)]
+EPOCH = datetime(2012, 1, 2, tzinfo = timezone.utc)
+
+def record_random(seed, image_id):
+    """
+    Returns the random generator of one record, so that any record can be rebuilt from its id alone.
+    ---
+    :param <seed>: <integer> ; seed of the corpus
+    :param <image_id>: <integer> ; id of the picture
+    """
+    return random.Random(seed * 1_000_003 + image_id)
+
+def synthetic_tags(seed, image_id):
+    """
+    Returns the tags of a synthetic picture, as derpibooru serves them (a ', ' separated string).
+    ---
+    :param <seed>: <integer> ; seed of the corpus
+    :param <image_id>: <integer> ; id of the picture
+    """
+    rng = record_random(seed, image_id)
+    tags = [tag for position, tag in enumerate(COMMON_TAGS) if rng.random() < 0.6 / (position + 1)]
+    tags += [RARE_TAGS[int(rng.paretovariate(1.2)) % len(RARE_TAGS)] for _ in range(rng.randint(2, 20))]
+    return ", ".join(sorted(set(tags)))
+
+def synthetic_record(image_id, seed = 0, host = "derpicdn.net", missing_tags = 0.0):
+    """
+    Returns the metadata of a synthetic picture, shaped like a record of derpibooru's images.json pages.
+    ---
+    :param <image_id>: <integer> ; id of the picture
+    :param <seed>: <integer> ; seed of the corpus
+    :param <host>: <str> ; host serving the pictures (e.g. the address of a mock server)
+    :param <missing_tags>: <float> ; share of the pictures served without tags (pictures to repair)
+    """
+    rng = record_random(seed, image_id)
+    created_at = EPOCH + timedelta(minutes = 5 * image_id)
+    upvotes, downvotes = int(rng.paretovariate(1.5)) - 1, int(rng.paretovariate(3)) - 1
+    extension = "png" if rng.random() < 0.6 else rng.choice(["jpg", "jpeg", "gif"])
+    prefix = f"//{host}/img/{image_id}/"
+    representations = {name: f"{prefix}{name}.{extension}"
+                       for name in ["thumb_tiny", "thumb_small", "thumb", "small", "medium", "large", "tall"]}
+    representations["full"] = f"//{host}/img/view/{image_id}.{extension}"
+    return {"id": image_id,
+            "created_at": created_at.isoformat().replace("+00:00", "Z"),
+            "updated_at": (created_at + timedelta(days = rng.randint(0, 900))).isoformat().replace("+00:00", "Z"),
+            "score": upvotes - downvotes, "upvotes": upvotes, "downvotes": downvotes,
+            "faves": int(rng.paretovariate(1.5)) - 1,
+            "uploader": f"uploader {rng.randint(0, 20000)}", "uploader_id": rng.randint(1, 400000),
+            "tags": None if rng.random() < missing_tags else synthetic_tags(seed, image_id),
+            "aspect_ratio": round(rng.uniform(0.5, 2.0), 4),
+            "comment_count": rng.randint(0, 40), "width": 1000, "height": 1000,
+            "representations": representations,
+            "sha512_hash": "%0128x" % rng.getrandbits(512),
+            "orig_sha512_hash": "%0128x" % rng.getrandbits(512)}
+
+def iter_pages(start, end, seed = 0, host = "derpicdn.net", missing_tags = 0.0, page_size = 50):
+    """
+    Yields the pages of the synthetic pictures whose ids are in ]start, end], in ascending id order.
+    ---
+    :param <start>: <integer> ; id after which the pages start
+    :param <end>: <integer> ; last id of the pages
+    :param <seed>: <integer> ; seed of the corpus
+    :param <host>: <str> ; host serving the pictures
+    :param <missing_tags>: <float> ; share of the pictures served without tags
+    :param <page_size>: <integer> ; number of pictures per page
+    """
+    for low in range(start + 1, end + 1, page_size):
+        yield [synthetic_record(image_id, seed, host, missing_tags) for image_id in range(low, min(low + page_size, end + 1))]
+
+def fill_store(search, backend, start, end, seed = 0, host = "derpicdn.net", missing_tags = 0.0, batch_size = 10_000):
+    """
+    Writes the synthetic pictures whose ids are in ]start, end] into the metadata store of a search,
+    by batches and without going through the network.
+    ---
+    :param <search>: <img_metadata> ; search trimming the records
+    :param <backend>: <metadata_backend> ; backend opened by search.check_prior_extract(), the records are written through it
+    :param <start>: <integer> ; id after which the pictures are written
+    :param <end>: <integer> ; last id written
+    :param <seed>: <integer> ; seed of the corpus
+    :param <host>: <str> ; host serving the pictures
+    :param <missing_tags>: <float> ; share of the pictures stored without tags
+    :param <batch_size>: <integer> ; number of records appended at once
+    """
+    for page in iter_pages(start, end, seed, host, missing_tags, batch_size):
+        backend.append(search.trim_metadata(page))
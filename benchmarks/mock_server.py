@@ -0,0 +1,136 @@
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+from .corpus import synthetic_record
+
+class mock_handler(BaseHTTPRequestHandler):
+    """
+    Answers the derpibooru routes used by derpi_get with the synthetic corpus of the server:
+    '/images.json' (pages of ids after 'gt=', up to 'lte=', ascending or descending), '/images/<id>.json',
+    '/search.json' ('id:1 || id:2 ...' queries) and '/img/<id>/<name>.<extension>' (picture bytes).
+    """
+    protocol_version = "HTTP/1.1"
+    # Headers and body are written separately: Nagle's algorithm would hold the body for a delayed ACK
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def send_body(self, status, body, content_type = "application/json", headers = {}):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in headers.items(): self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_json(self, data):
+        self.send_body(200, json.dumps(data).encode("utf-8"))
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.requests += 1
+            failed = server.random.random() < server.error_rate
+        if server.latency > 0: time.sleep(server.latency)
+        if failed:
+            server.errors += 1
+            return self.send_body(503, b"", headers = {"Retry-After": "0"})
+        url = urlparse(self.path)
+        params = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        if url.path == "/images.json": return self.send_json({"images": server.page(params)})
+        if url.path == "/search.json": return self.send_json({"search": server.search(params.get("q", ""))})
+        match = re.fullmatch(r"/images/(\d+)\.json", url.path)
+        if match and 0 < int(match.group(1)) <= server.size:
+            return self.send_json({"image": server.record(int(match.group(1)))})
+        match = re.fullmatch(r"/img/(?:view/)?(\d+)(?:/\w+)?\.\w+", url.path)
+        if match and 0 < int(match.group(1)) <= server.size:
+            return self.send_body(200, server.picture(int(match.group(1))), "image/png",
+                                  {"ETag": f"\"{match.group(1)}\""})
+        self.send_body(404, b"")
+
+class mock_server(ThreadingHTTPServer):
+    """
+    Local HTTP server mimicking the derpibooru API over a synthetic corpus of <size> pictures (ids 1 to <size>).
+    Records are rebuilt from their id on each request, so that a corpus of ten million pictures costs no memory.
+    Every request waits <latency> seconds, and fails with a 503 (and 'Retry-After: 0') with probability <error_rate>.
+    Use it as a context manager: the server runs on a background thread while the block is executed.
+    """
+    daemon_threads = True
+
+    def __init__(self, size = 10_000, latency = 0.0, error_rate = 0.0, missing_tags = 0.0,
+                 picture_size = 32 * 1024, seed = 0, port = 0):
+        """
+        Initializes the server (listening on 127.0.0.1).
+        ---
+        :param <size>: <integer> ; number of pictures of the corpus
+        :param <latency>: <float> ; delay in seconds added to every request
+        :param <error_rate>: <float> ; probability of a request failing with a 503
+        :param <missing_tags>: <float> ; share of the pictures served without tags in images.json pages
+        :param <picture_size>: <integer> ; size in bytes of the served pictures
+        :param <seed>: <integer> ; seed of the corpus and of the injected errors
+        :param <port>: <integer> ; port to listen on (0 picks a free port)
+        """
+        super().__init__(("127.0.0.1", port), mock_handler)
+        self.size = size
+        self.latency = latency
+        self.error_rate = error_rate
+        self.missing_tags = missing_tags
+        self.picture_size = picture_size
+        self.seed = seed
+        self.host = f"127.0.0.1:{self.server_address[1]}"
+        self.root = f"http://{self.host}"
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.errors = 0
+        self.thread = None
+
+    def __enter__(self):
+        self.thread = threading.Thread(target = self.serve_forever, name = "mock-derpibooru", daemon = True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
+        self.server_close()
+
+    def record(self, image_id, missing_tags = None):
+        return synthetic_record(image_id, self.seed, self.host, self.missing_tags if missing_tags is None else missing_tags)
+
+    def page(self, params, page_size = 50):
+        """
+        Returns a page of images.json.
+        ---
+        :param <params>: <dict> ; query parameters ('gt', 'lte', 'order')
+        :param <page_size>: <integer> ; number of pictures per page
+        """
+        if params.get("order") == "d":
+            return [self.record(image_id) for image_id in range(self.size, max(0, self.size - page_size), -1)]
+        start = int(params.get("gt", 0))
+        end = min(self.size, int(params.get("lte", self.size)))
+        return [self.record(image_id) for image_id in range(start + 1, min(start + page_size, end) + 1)]
+
+    def search(self, query):
+        """
+        Returns the results of a search query; only 'id:1 || id:2 ...' queries have results.
+        Pictures are always served with their tags by the search endpoint.
+        ---
+        :param <query>: <str> ; search query
+        """
+        ids = [int(image_id) for image_id in re.findall(r"id:(\d+)", query)]
+        return [self.record(image_id, 0.0) for image_id in ids if 0 < image_id <= self.size]
+
+    def picture(self, image_id):
+        """
+        Returns the (deterministic) bytes of a picture.
+        ---
+        :param <image_id>: <integer> ; id of the picture
+        """
+        block = hashlib.sha512(f"{self.seed}:{image_id}".encode("utf-8")).digest()
+        return (block * (self.picture_size // len(block) + 1))[:self.picture_size]
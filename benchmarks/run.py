@@ -0,0 +1,234 @@
+"""
+Benchmarks of derpi_get against a local mock derpibooru server (see benchmarks/mock_server.py).
+Run from the root of the repository, e.g.:
+
+    python -m benchmarks.run --sizes 10k 1m --output results.json
+
+Each size builds a synthetic corpus of that many pictures and measures:
+crawl throughput, the cost of json_collect() as the store grows, the size of the store and the time of a full scan,
+the latency of id_filter(),
+and the throughput of repair_tags() and request_imgs(). Results are printed and written as JSON.
+"""
+import argparse
+import contextlib
+import io
+import json
+import math
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+from derpi_get import METRICS, derpibooru_search
+from derpi_get.segment_codecs import CODECS
+from .corpus import CORPUS_SIZES, fill_store, iter_pages
+from .mock_server import mock_server
+
+# id_filter() queries: (label, tags, at_least_one)
+FILTER_QUERIES = [("one common tag", ["+safe"], True),
+                  ("two common tags (all)", ["+safe", "+cute"], False),
+                  ("one rare tag", ["+tag 40"], True),
+                  ("common tag minus common tag", ["+safe", "-pony"], True)]
+
+def result(name, size, metric, value, unit, **params):
+    """
+    Returns one benchmark measurement.
+    ---
+    :param <name>: <str> ; name of the benchmark
+    :param <size>: <integer> ; number of pictures of the corpus
+    :param <metric>: <str> ; name of the measured quantity
+    :param <value>: <float> ; measured value
+    :param <unit>: <str> ; unit of the value
+    :param <params>: <dict> ; parameters the measurement depends on
+    """
+    return {"name": name, "size": size, "metric": metric, "value": round(value, 6), "unit": unit, "params": params}
+
+def percentile(values, share):
+    """
+    Returns the nearest-rank percentile of a list of measurements.
+    ---
+    :param <values>: <list> ; measurements
+    :param <share>: <float> ; percentile as a share (e.g. 0.95)
+    """
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(math.ceil(share * len(ordered))) - 1)]
+
+def timed(function, *args, **kwargs):
+    """
+    Calls a function with the output of derpi_get silenced and returns (elapsed seconds, returned value).
+    """
+    with contextlib.redirect_stdout(io.StringIO()):
+        started = time.perf_counter()
+        value = function(*args, **kwargs)
+        elapsed = time.perf_counter() - started
+    return elapsed, value
+
+def open_search(options, server, folder, **kwargs):
+    """
+    Returns a search sending its requests to the mock server and storing its data in <folder>.
+    ---
+    :param <options>: <argparse.Namespace> ; options of the run (backend and codec)
+    :param <server>: <mock_server> ; running mock server
+    :param <folder>: <str> ; data folder of the search
+    :param <kwargs>: <dict> ; other arguments of derpibooru_search
+    """
+    codec = options.codec if options.backend == "segments" else None
+    return derpibooru_search(api_root = server.root, data_path = folder, backend = options.backend, codec = codec, **kwargs)
+
+def bench_crawl(options, server, size, folder):
+    """
+    Crawls the pages of the mock server into an empty store and measures the pages and records retrieved per second.
+    """
+    pages = min(options.crawl_pages, math.ceil(size / 50))
+    search = open_search(options, server, os.path.join(folder, "crawl"), instances = pages)
+    elapsed, _ = timed(search.crawl_metadata, rate = options.rate)
+    nb_records = search.check_prior_extract(False).last_id()
+    return [result("crawl", size, "pages_per_second", pages / elapsed, "pages/s", pages = pages),
+            result("crawl", size, "records_per_second", nb_records / elapsed, "records/s", pages = pages)]
+
+def bench_collect(options, server, size, search):
+    """
+    Fills the store up to <size> pictures and, at evenly spaced store sizes, measures the cost of json_collect() per page.
+    The measured pages are the last ones of each step, so that the store ends up holding the ids 1 to <size>.
+    """
+    results = []
+    backend = search.check_prior_extract(False)
+    last_id = 0
+    for step in range(1, options.collect_steps + 1):
+        target = size * step // options.collect_steps
+        collected = max(last_id, target - 50 * options.collect_pages)
+        with contextlib.redirect_stdout(io.StringIO()):
+            fill_store(search, backend, last_id, collected, options.seed, server.host, options.missing_tags)
+        pages = list(iter_pages(collected, target, options.seed, server.host, options.missing_tags))
+        if pages == []: continue
+        elapsed, _ = timed(lambda: [search.json_collect(page, backend) for page in pages])
+        last_id = target
+        results.append(result("json_collect", size, "ms_per_page", 1000 * elapsed / len(pages), "ms",
+                              store_records = collected))
+    # The following benchmarks are only meaningful on the whole corpus
+    nb_records = sum(len(batch) for batch in backend.iter_batches())
+    assert(nb_records == size), f"The store holds {nb_records} records instead of {size}."
+    return results
+
+def bench_scan(options, server, size, search):
+    """
+    Measures the size on disk of the metadata store and the time of a full scan from a newly opened store.
+    """
+    folder = search.data_folder()
+    footprint = sum(os.path.getsize(os.path.join(folder, fname)) for fname in os.listdir(folder)
+                    if fname.startswith("derpibooru_metadata"))
+    elapsed, nb_records = timed(lambda: sum(1 for _ in search.iter_records()))
+    return [result("store", size, "bytes_on_disk", footprint, "bytes", codec = options.codec),
+            result("scan", size, "records_per_second", nb_records / elapsed, "records/s", codec = options.codec)]
+
+def bench_id_filter(options, server, size, search):
+    """
+    Measures the latency of id_filter() queries on the full store.
+    """
+    results = []
+    for label, tags, at_least_one in FILTER_QUERIES:
+        durations = []
+        for _ in range(options.repeat):
+            elapsed, ids = timed(search.id_filter, tags, at_least_one)
+            durations.append(1000 * elapsed)
+        for name, share in [("p50_ms", 0.5), ("p95_ms", 0.95)]:
+            results.append(result("id_filter", size, name, percentile(durations, share), "ms",
+                                  query = label, matches = len(ids)))
+    return results
+
+def bench_repair(options, server, size, search):
+    """
+    Repairs the pictures stored without tags through the search endpoint and measures the repaired records per second.
+    """
+    elapsed, nb_repaired = timed(search.repair_tags, options.workers, options.rate)
+    return [result("repair_tags", size, "records_per_second", nb_repaired / elapsed, "records/s",
+                   repaired = nb_repaired, workers = options.workers)]
+
+def bench_download(options, server, size, search):
+    """
+    Downloads pictures from the mock server and measures the pictures and bytes retrieved per second.
+    """
+    id_list = search.id_filter(["+safe"], True)
+    elapsed, summary = timed(search.request_imgs, ["+safe"], id_list, options.images, options.workers, options.rate,
+                             options.seed)
+    return [result("request_imgs", size, "images_per_second", summary["downloaded"] / elapsed, "images/s",
+                   downloaded = summary["downloaded"], workers = options.workers),
+            result("request_imgs", size, "megabytes_per_second", summary["bytes"] / elapsed / 1024 ** 2, "MB/s",
+                   downloaded = summary["downloaded"], workers = options.workers)]
+
+def run(options):
+    """
+    Runs every benchmark on every requested corpus size and returns the report.
+    """
+    report = {"python": sys.version.split()[0], "platform": platform.platform(),
+              "timestamp": datetime.now(timezone.utc).isoformat(), "options": vars(options), "results": []}
+    for name in options.sizes:
+        size = CORPUS_SIZES[name]
+        folder = tempfile.mkdtemp(prefix = f"derpi_get_bench_{name}_", dir = options.folder)
+        try:
+            with mock_server(size, options.latency, options.error_rate, options.missing_tags,
+                             options.picture_size, options.seed) as server:
+                results = bench_crawl(options, server, size, folder)
+                search = open_search(options, server, os.path.join(folder, "store"))
+                results += bench_collect(options, server, size, search)
+                results += bench_scan(options, server, size, search)
+                results += bench_id_filter(options, server, size, search)
+                results += bench_repair(options, server, size, search)
+                results += bench_download(options, server, size, search)
+                for item in results:
+                    print(f"{item['name']:>13} {name:>4} {item['metric']:>20} {item['value']:>14.3f} {item['unit']:<9} "
+                          f"{json.dumps(item['params'])}")
+                report["results"] += results
+                report["results"].append(result("mock_server", size, "requests", server.requests, "requests",
+                                                errors = server.errors))
+        finally:
+            if not options.keep: shutil.rmtree(folder, ignore_errors = True)
+    # Counters and histograms recorded by derpi_get over the whole run (see derpi_get/metrics.py)
+    report["metrics"] = METRICS.snapshot()
+    return report
+
+def parse_arguments(arguments = None):
+    """
+    Parses the command line options of the benchmarks.
+    ---
+    :param <arguments>: <list> ; command line arguments (None for sys.argv)
+    """
+    parser = argparse.ArgumentParser(description = "Benchmarks derpi_get against a local mock derpibooru server.")
+    parser.add_argument("--sizes", nargs = "+", choices = list(CORPUS_SIZES), default = ["10k"],
+                        help = "synthetic corpus sizes (1m and 10m take minutes to hours and gigabytes of disk)")
+    parser.add_argument("--backend", choices = ["segments", "sqlite"], default = "segments")
+    parser.add_argument("--codec", choices = list(CODECS), default = "jsonl", help = "codec of the sealed segments")
+    parser.add_argument("--latency", type = float, default = 0.0, help = "delay in seconds added to each request")
+    parser.add_argument("--error-rate", type = float, default = 0.0, help = "share of requests failing with a 503")
+    parser.add_argument("--missing-tags", type = float, default = 0.01, help = "share of pictures stored without tags")
+    parser.add_argument("--picture-size", type = int, default = 32 * 1024, help = "size in bytes of the served pictures")
+    parser.add_argument("--rate", type = float, default = 1000.0, help = "requests allowed per second by derpi_get")
+    parser.add_argument("--workers", type = int, default = 4, help = "concurrent repair and download workers")
+    parser.add_argument("--crawl-pages", type = int, default = 200, help = "maximum number of pages crawled")
+    parser.add_argument("--collect-steps", type = int, default = 10, help = "store sizes at which json_collect is measured")
+    parser.add_argument("--collect-pages", type = int, default = 20, help = "pages collected at each store size")
+    parser.add_argument("--repeat", type = int, default = 5, help = "repetitions of each id_filter query")
+    parser.add_argument("--images", type = int, default = 200, help = "number of pictures downloaded")
+    parser.add_argument("--seed", type = int, default = 0)
+    parser.add_argument("--folder", default = None, help = "folder of the temporary stores (defaults to the system's)")
+    parser.add_argument("--keep", action = "store_true", help = "keeps the temporary stores")
+    parser.add_argument("--output", default = None, help = "path of the JSON report")
+    return parser.parse_args(arguments)
+
+def main(arguments = None):
+    """
+    Runs the benchmarks, prints the results and writes the JSON report if requested.
+    ---
+    :param <arguments>: <list> ; command line arguments (None for sys.argv)
+    """
+    options = parse_arguments(arguments)
+    report = run(options)
+    if options.output is not None:
+        with open(options.output, "w") as file: json.dump(report, file, indent = 2)
+        print(f"Results written to {options.output}.")
+    return report
+
+if __name__ == "__main__":
+    main()
@@ -1 +1,3 @@
-from .abstract_class import derpibooru_search
\ No newline at end of file
+from .abstract_class import derpibooru_search
+from .async_class import async_derpibooru_search
+from .metrics import METRICS, configure_logging, jsonl_exporter, prometheus_exporter
@@ -1,9 +1,13 @@
-from .core_class import img_metadata, error_message
+from .core_class import DatabaseFullyCrawled, img_metadata, error_message
+from .download_engine import download_engine
+from .download_planner import download_planner
+from .image_store import image_store
+from .metrics import METRICS, log_event
+from .query import compile_query
+import itertools
 import logging
 import os
-import random
 import requests
-import time
 
 log = logging.getLogger()
 
@@ -18,33 +22,38 @@ class derpibooru_search(img_metadata):
         Changes the search parameters of the created object derpibooru_search.
         ---
         :param <self>: <class> ; class object reference
-        :param <tags>: <list> ; list of strings (i.e. picture tags)
-        :param <at_least_one>: <boolean> ; toggles 'at least one tag' option instead of 'all tags'
+        :param <tags>: <list> or <str> ; list of strings (i.e. picture tags) or a query expression such as '(a OR b) AND NOT c'
+        :param <at_least_one>: <boolean> ; toggles 'at least one tag' option instead of 'all tags' (ignored by query expressions)
         :param <instances>: <integer> ; number of instances/loops allowed before stop
         """
-        assert(isinstance(tags, list)), error_message("Erroneous Type", "change_search", "derpi_get/abstract_class.py")
+        assert(isinstance(tags, (list, str))), error_message("Erroneous Type", "change_search", "derpi_get/abstract_class.py")
+        if isinstance(tags, str): compile_query(tags)
         assert(isinstance(at_least_one, bool)), error_message("Erroneous Type", "change_search", "derpi_get/abstract_class.py")
         self.tags = tags
         self.at_least_one = at_least_one
         if (isinstance(instances, int) == False) and (instances != ""):
-            print("The specified number of <instances> was not recognize. It will be defaulted to 10.")
+            log_event("search.instances", "The specified number of <instances> was not recognize. It will be defaulted to 10.",
+                      logging.WARNING, instances = instances)
             self.instances = 10
         else:
             self.instances = instances
             
-    def crawl(self):
+    def crawl(self, shards = 1):
         """
 		Launches the scraping procedure.
 		---
 		:param <self>: <class> ; class object reference
+		:param <shards>: <integer> ; number of id ranges crawled in parallel (see crawl_sharded()), 1 for the sequential crawl
 		"""
-        print("----|Entering Derpibooru Data Crawler code|----")
+        log_event("crawl.start", "----|Entering Derpibooru Data Crawler code|----", shards = shards)
         try:
-            self.crawl_metadata()
+            with METRICS.span("crawl", shards = shards):
+                if shards > 1: self.crawl_sharded(shards)
+                else: self.crawl_metadata()
         except DatabaseFullyCrawled:
-            print("exit point")
-        except (IOError, WindowsError) as error:
-            log.error(io_windows_error)
+            log_event("crawl.complete", "exit point")
+        except (IOError, OSError) as error:
+            log.error(error_message("IO or Windows", "crawl", "derpi_get/abstract_class.py"))
             raise
         except (requests.exceptions.TooManyRedirects, requests.exceptions.RequestException) as error:
             log.error(error_message("Request [generic error]", "crawl", "derpi_get/abstract_class.py"))
@@ -58,23 +67,29 @@ class derpibooru_search(img_metadata):
         except requests.exceptions.Timeout as error:
             log.error(error_message("Request [timeout]", "crawl", "derpi_get/abstract_class.py"))
             raise
-        print("---------------|Exiting Program|---------------")
+        log_event("crawl.end", "---------------|Exiting Program|---------------")
+        METRICS.flush()
 
-    def retrieve_ids(self):
+    def retrieve_ids(self, lazy = False):
         """
         Retrieves the IDs of locally stored metadata fitting specific tag values.
         ---
         :param <self>: <class> ; class object reference
+        :param <lazy>: <boolean> ; returns a generator streaming the IDs as the store is scanned instead of a list
         """
-        print("----|Retrieving IDs based on tag selection|----")
-        assert(isinstance(self.tags, list)), error_message("Erroneous Type", "retrieve_ids", "derpi_get/abstract_class.py")
+        log_event("retrieve_ids.start", "----|Retrieving IDs based on tag selection|----")
+        assert(isinstance(self.tags, (list, str))), error_message("Erroneous Type", "retrieve_ids", "derpi_get/abstract_class.py")
         assert(isinstance(self.at_least_one, bool)), error_message("Erroneous Type", "retrieve_ids", "derpi_get/abstract_class.py")
+        if lazy:
+            log_event("retrieve_ids.lazy", "-----------|Streaming IDs on demand|-----------")
+            return self.iter_ids(self.tags)
         try:
-            id_list = self.id_filter(self.tags, self.at_least_one)
-        except (IOError, WindowsError) as error:
+            if isinstance(self.tags, str): id_list = self.query_filter(self.tags)
+            else: id_list = self.id_filter(self.tags, self.at_least_one)
+        except (IOError, OSError) as error:
             log.error(error_message("IO or Windows", "retrieve_ids", "derpi_get/abstract_class.py"))
             raise
-        print("----------------|IDs retrieved|----------------")
+        log_event("retrieve_ids.end", "----------------|IDs retrieved|----------------", matches = len(id_list))
         return id_list
 	
     def repair(self):
@@ -83,10 +98,10 @@ class derpibooru_search(img_metadata):
 		---
 		:param <self>: <class> ; class object reference
 		"""
-        print("----|Repairing missing tags in stored JSON|----")
+        log_event("repair.start", "----|Repairing missing tags in stored JSON|----")
         try:
-            self.repair_tags()
-        except (IOError, WindowsError) as error:
+            with METRICS.span("repair"): self.repair_tags()
+        except (IOError, OSError) as error:
             log.error(error_message("IO or Windows", "repair", "derpi_get/abstract_class.py"))
             raise
         except (requests.exceptions.TooManyRedirects, requests.exceptions.RequestException) as error:
@@ -101,82 +116,157 @@ class derpibooru_search(img_metadata):
         except requests.exceptions.Timeout as error:
             log.error(error_message("Request [timeout]", "repair", "derpi_get/abstract_class.py"))
             raise
-        print("----------------|Tags repaired|----------------")
+        log_event("repair.end", "----------------|Tags repaired|----------------")
+        METRICS.flush()
 
-    def request_imgs(self, tags, id_list, nb_of_requests = None):
+    def refresh(self, since = None):
+        """
+		Refreshes the locally stored metadata of pictures updated on derpibooru since the last refresh.
+		---
+		:param <self>: <class> ; class object reference
+		:param <since>: <str> ; ISO 8601 timestamp used as a starting point by the first refresh
+		"""
+        log_event("refresh.start", "----|Refreshing updated metadata in store|----")
+        try:
+            with METRICS.span("refresh"): nb_changed = self.refresh_metadata(since)
+        except (IOError, OSError) as error:
+            log.error(error_message("IO or Windows", "refresh", "derpi_get/abstract_class.py"))
+            raise
+        except (requests.exceptions.TooManyRedirects, requests.exceptions.RequestException) as error:
+            log.error(error_message("Request [generic error]", "refresh", "derpi_get/abstract_class.py"))
+            raise
+        log_event("refresh.end", "--------------|Metadata refreshed|-------------")
+        METRICS.flush()
+        return nb_changed
+
+    def request_imgs(self, tags, id_list, nb_of_requests = None, workers = 4, rate = 5.0, seed = None):
         """
 		Retrieves images from derpibooru based on a specific ID list.
+		Downloads run concurrently on a pool of <workers> threads sharing a rate limit of <rate> requests per second.
+		Pictures are stored once by hash in ./data/objects and hard-linked into the query folder,
+		so that pictures already downloaded for another query are not requested again.
 		---
 		:param <self>: <class> ; class object reference
 		:param <tags>: <list> ; list of strings (tags used to search ids)
-		:param <id_list>: <list> ; list of strings (i.e. picture id + url)
+		:param <id_list>: <list> or <iterator> ; list of strings (i.e. picture id + url), picked at random,
+		                  or an iterator (e.g. retrieve_ids(lazy = True)) whose pictures are downloaded as they are streamed
 		:param <nb_of_requests>: <integer> ; number of images to request
+		:param <workers>: <integer> ; number of concurrent downloads
+		:param <rate>: <float> ; number of image requests allowed per second
+		:param <seed>: <integer> ; seed of the random order of the pictures (None for a different order on each run)
 		"""                
-        print("------|Requesting images from derpibooru|-----")
+        log_event("request_imgs.start", "------|Requesting images from derpibooru|-----")
         assert(isinstance(tags, list)), error_message("Erroneous Type", "request_imgs", "derpi_get/abstract_class.py")
-        assert(isinstance(id_list, list)), error_message("Erroneous Type", "request_imgs", "derpi_get/abstract_class.py")
+        with METRICS.span("request_imgs", workers = workers):
+            plan = self.plan_downloads(tags, id_list, nb_of_requests, seed)
+            summary = download_engine(workers, rate, cache = self.open_cache()).download(plan["jobs"], plan["on_result"])
+            self.complete_downloads(plan, summary)
+        log_event("request_imgs.end", "---------------|Images retrieved|--------------")
+        METRICS.flush()
+        return summary
+
+    def plan_downloads(self, tags, id_list, nb_of_requests = None, seed = None):
+        """
+		Plans the downloads of request_imgs(): returns a dictionary holding the generator of the (id, url, path)
+		download jobs ("jobs"), the callback recording their progress ("on_result") and the state
+		complete_downloads() needs to link the downloaded pictures.
+		Lists are turned into a resumable work queue by a download_planner (see derpi_get/download_planner.py);
+		iterators are filtered as they are streamed.
+		---
+		:param <self>: <class> ; class object reference
+		:param <tags>: <list> ; list of strings (tags used to search ids)
+		:param <id_list>: <list> or <iterator> ; see request_imgs()
+		:param <nb_of_requests>: <integer> ; number of images to request
+		:param <seed>: <integer> ; seed of the random order of the pictures (None for a different order on each run)
+		"""
+        streamed = not isinstance(id_list, list)
 
         try:
-            img_path = os.getcwd() + "\\data\\" + "".join(sorted(tags))
+            folder_name = "".join(sorted(tags))
+            if self.representation != "medium": folder_name += f"_{self.representation}"
+            img_path = os.path.join(self.data_folder(), folder_name)
             if not os.path.exists(img_path): os.makedirs(img_path)
-        except (IOError, WindowsError) as error:
-            log.error(error_message("IO or Windows", "request_imgs", "derpi_get/abstract_class.py"))
+            objects = image_store(os.path.join(self.data_folder(), "objects"))
+            backend = self.check_prior_extract(False)
+            planner = download_planner(img_path, seed = seed)
+            if streamed:
+                present = planner.present_ids()
+                queue = (item for item in id_list if planner.eligible(item))
+                if nb_of_requests is not None: queue = itertools.islice(queue, nb_of_requests)
+                queue = (item for item in queue if item[0] not in present)
+                hashes = {}
+            else:
+                queue = planner.plan(id_list, nb_of_requests)
+                hashes = backend.hashes_of([item[0] for item in queue])
+        except (IOError, OSError) as error:
+            log.error(error_message("IO or Windows", "plan_downloads", "derpi_get/abstract_class.py"))
             raise
-            
-        if (nb_of_requests == None) or (len(id_list) < nb_of_requests): nb_of_requests = len(id_list)
 
-        length = len(id_list)
-        nb_req = 0
+        views = {}
+        counts = {"requests": 0, "linked": 0}
 
-        try:
-            
-            while length > 0:
-                random_index = random.randint(0, length - 1)
-                item = id_list[random_index]
-                id_list.pop(random_index)
-                
-                nb_req += 1
-                length = len(id_list)
-                
-                image_id = str(item[0])
-                path_derpibooru = item[1]
-                extension = "." + path_derpibooru.split(".")[-1]
-                
-                if nb_req > nb_of_requests: 
-                    break
-                
-                picture_path = img_path + "\\" + image_id
-                
-                if ((os.path.exists(picture_path + ".png")) or
-                    (os.path.exists(picture_path + ".jpeg")) or
-                    (os.path.exists(picture_path + ".jpg"))): 
-                    continue
-                
-                if not (item[1].endswith("png") 
-				or item[1].endswith("jpeg") 
-				or item[1].endswith("jpg")):
-                    nb_of_requests += 1
-                    continue
-                
-                picture_path += extension
-                request = requests.get("http://" + path_derpibooru)
-                #print(nb_req, nb_of_requests, picture_path, path_derpibooru)
-                if request.status_code == 200:
-                    with open(picture_path, 'wb') as f:
-                        f.write(request.content)
-                time.sleep(.200)
-                print(f"The picture {image_id} was downloaded.")
+        def plan_jobs():
+            """
+            Yields the (id, url, path) download jobs, so that downloads start while the queue is still being read.
+            """
+            for item in queue:
+                counts["requests"] += 1
+                job = plan_job(item)
+                if job is not None: yield job
+                elif not streamed: planner.done(item[0])
 
-        except (requests.exceptions.TooManyRedirects, requests.exceptions.RequestException) as error:
-            log.error(error_message("Request [generic error]", "request_imgs", "derpi_get/abstract_class.py"))
-            raise
-        except requests.exceptions.HTTPError as error:
-            log.error(error_message("Request [hhtp]", "request_imgs", "derpi_get/abstract_class.py"))
-            raise
-        except requests.exceptions.ConnectionError as error:
-            log.error(error_message("Request [Connection]", "request_imgs", "derpi_get/abstract_class.py"))
-            raise
-        except requests.exceptions.Timeout as error:
-            log.error(error_message("Request [timeout]", "request_imgs", "derpi_get/abstract_class.py"))
-            raise
-        print("---------------|Images retrieved|--------------")
\ No newline at end of file
+        def plan_job(item):
+            """
+            Returns the download job of an item (None if the picture is only linked).
+            """
+            path_derpibooru = item[1]
+            picture_path = os.path.join(img_path, str(item[0])) + "." + path_derpibooru.split(".")[-1]
+            # Pictures already stored for another query are only linked into this one
+            sha512_hash = hashes.get(item[0]) if not streamed else backend.hashes_of([item[0]]).get(item[0])
+            name = objects.object_name(item[0], path_derpibooru, sha512_hash)
+            if objects.contains(name):
+                objects.link(name, picture_path)
+                counts["linked"] += 1
+                return None
+            # Ids sharing a picture with a queued one are linked once its download completes
+            if name in views:
+                views[name].append((item[0], picture_path))
+                return None
+            views[name] = [(item[0], picture_path)]
+            return (item[0], "http://" + path_derpibooru, objects.object_path(name))
+
+        def on_result(result):
+            """
+            Links each downloaded picture into the query folder (under every id sharing it) and records the progress
+            of the work queue, as downloads complete, so that an interrupted run loses none of them.
+            """
+            if not result["success"]: return
+            name = os.path.basename(result["path"])
+            objects.add(name)
+            for position, (image_id, picture_path) in enumerate(views[name]):
+                objects.link(name, picture_path)
+                if position > 0: counts["linked"] += 1
+                if not streamed: planner.done(image_id)
+
+        return {"jobs": plan_jobs(), "on_result": on_result, "views": views, "objects": objects, "counts": counts,
+                "planner": planner if not streamed else None}
+
+    def complete_downloads(self, plan, summary):
+        """
+		Completes the summary of a download run (the downloaded pictures are linked by the plan's on_result callback)
+		and deletes its work queue if every picture was retrieved.
+		---
+		:param <self>: <class> ; class object reference
+		:param <plan>: <dict> ; plan returned by plan_downloads()
+		:param <summary>: <dict> ; summary returned by the download engine
+		"""
+        nb_linked = plan["counts"]["linked"]
+        summary["deduplicated"] = nb_linked
+        if plan["planner"] is not None: plan["planner"].finish(summary["failed"])
+        METRICS.increment("deduplicated_pictures_total", nb_linked)
+        log_event("request_imgs.summary",
+                  f"{summary['downloaded']} pictures downloaded ({summary['from_cache']} from cache), "+\
+                  f"{nb_linked} already stored, {summary['failed']} failed "+\
+                  f"({summary['images_per_second']:.2f} pictures/s, {self.bytes_length(float(summary['bytes_per_second']))}/s).",
+                  downloaded = summary["downloaded"], from_cache = summary["from_cache"], deduplicated = nb_linked,
+                  failed = summary["failed"], seconds = round(summary["seconds"], 3), bytes = summary["bytes"])
@@ -0,0 +1,161 @@
+from .abstract_class import derpibooru_search
+from .async_client import aiohttp, async_client, async_repair_engine
+from .core_class import IMAGES_PATH, DatabaseFullyCrawled, error_message
+from .metrics import METRICS, log_event
+from .repair_engine import SEARCH_PATH
+import asyncio
+import contextlib
+import logging
+import os
+
+log = logging.getLogger()
+
+class async_derpibooru_search(derpibooru_search):
+    """
+    asyncio variant of derpibooru_search, for applications running an event loop.
+    Crawl, repair and image requests are coroutines sharing one async_client (a pooled aiohttp session,
+    an async rate limiter and the HTTP cache), so that many searches run concurrently on a single loop
+    without one thread per operation. Metadata storage and id retrieval are inherited unchanged.
+    """
+    def __init__(self, tags = [], at_least_one = True, instances = 10, client = None, rate = 5.0, connections = 8, **kwargs):
+        """
+        Initializes the search.
+        ---
+        :param <tags>: <list> or <str> ; see img_metadata
+        :param <at_least_one>: <boolean> ; see img_metadata
+        :param <instances>: <integer> ; see img_metadata
+        :param <client>: <async_client> ; client shared with other searches (a private one is opened if None)
+        :param <rate>: <float> ; number of requests allowed per second by a private client
+        :param <connections>: <integer> ; size of the connection pool of a private client
+        :param <kwargs>: <dict> ; other arguments of img_metadata (segment_size, backend, cache_size...)
+        """
+        super().__init__(tags, at_least_one, instances, **kwargs)
+        self.client = client
+        self.owns_client = client is None
+        self.rate = rate
+        self.connections = connections
+
+    async def open(self):
+        """
+        Opens the private client if no shared client was given.
+        """
+        if self.client is None: self.client = async_client(self.open_cache(), self.rate, self.connections)
+        await self.client.open()
+        return self
+
+    async def close(self):
+        """
+        Closes the private client (a shared client is left to its owner).
+        """
+        if self.owns_client and self.client is not None:
+            await self.client.close()
+            self.client = None
+
+    @contextlib.asynccontextmanager
+    async def session(self):
+        """
+        Opens the client for the duration of one operation. A private client opened here is closed afterwards,
+        one opened beforehand (e.g. by 'async with search:') is left open.
+        """
+        opened_here = self.client is None
+        await self.open()
+        try: yield self.client
+        finally:
+            if opened_here: await self.close()
+
+    async def __aenter__(self):
+        return await self.open()
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def crawl(self):
+        """
+        Retrieves picture metadata from the derpibooru REST API (see crawl_metadata()).
+        Pages are fetched through the shared client and failures back off on the event loop;
+        the store is opened and written from a worker thread so that disk I/O never blocks the loop.
+        """
+        log_event("crawl.start", "-----|Crawling derpibooru picture metadata|----")
+        derpibooru_url = self.api_root + IMAGES_PATH
+        iterations = self.instances
+        try: backend = await asyncio.to_thread(self.check_prior_extract)
+        except (IOError, OSError) as error:
+            log.error(error_message("IO or Windows", "crawl", "derpi_get/async_class.py"))
+            raise
+        requested_id = backend.last_id()
+        async with self.session():
+            while True:
+                try:
+                    if type(iterations) == int:
+                        if iterations > 0: iterations -= 1
+                        else:
+                            log_event("crawl.done", f"{self.instances} images retrieved as requested.", pages = self.instances)
+                            break
+                    log_event("crawl.page", f"You are requesting the derpibooru page starting with the id° {requested_id}.",
+                              cursor = requested_id)
+                    json_derpibooru = (await self.client.get(derpibooru_url + str(requested_id))).json()["images"]
+                    METRICS.increment("pages_crawled_total")
+                    if json_derpibooru == []: raise DatabaseFullyCrawled
+                    requested_id = await asyncio.to_thread(self.json_collect, json_derpibooru, backend)
+                except DatabaseFullyCrawled:
+                    log_event("crawl.complete", "The crawler scraped the derpibooru metadata. The program will now close.",
+                              cursor = requested_id)
+                    break
+                # Connection errors and timeouts are OSError subclasses: they must be caught before disk errors
+                except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as error:
+                    # The delay is applied by the rate controller before the next request
+                    try: self.client.limiter.back_off(error)
+                    except type(error):
+                        log.error(error_message("Request [generic error]", "crawl", "derpi_get/async_class.py"))
+                        raise
+                except (IOError, OSError) as error:
+                    log.error(error_message("IO or Windows", "crawl", "derpi_get/async_class.py"))
+                    raise
+        log_event("crawl.end", "---------------|Exiting Program|---------------")
+        METRICS.flush()
+
+    async def repair(self, concurrency = 4, batch_size = 50):
+        """
+        Repairs missing tags of the locally stored metadata (see repair_tags()).
+        ---
+        :param <concurrency>: <integer> ; number of concurrent batch requests
+        :param <batch_size>: <integer> ; number of ids requested at once (at most 50)
+        """
+        log_event("repair.start", "----|Repairing missing tags in stored JSON|----")
+        backend = await asyncio.to_thread(self.check_prior_extract, False)
+        checkpoint_path = os.path.join(self.data_folder(), "derpibooru_repair.json")
+        try:
+            async with self.session():
+                nb_repaired = await async_repair_engine(backend, checkpoint_path, self.client, concurrency, batch_size,
+                                                        self.api_root + SEARCH_PATH).run()
+        # Connection errors and timeouts are OSError subclasses: they must be caught before disk errors
+        except (aiohttp.ClientError, asyncio.TimeoutError) as error:
+            log.error(error_message("Request [generic error]", "repair", "derpi_get/async_class.py"))
+            raise
+        except (IOError, OSError) as error:
+            log.error(error_message("IO or Windows", "repair", "derpi_get/async_class.py"))
+            raise
+        log_event("repair.done", f"{nb_repaired} pictures repaired.", records = nb_repaired)
+        log_event("repair.end", "----------------|Tags repaired|----------------")
+        METRICS.flush()
+        return nb_repaired
+
+    async def request_imgs(self, tags, id_list, nb_of_requests = None, concurrency = 4, seed = None):
+        """
+        Retrieves images from derpibooru based on a specific ID list (see derpibooru_search.request_imgs()).
+        ---
+        :param <tags>: <list> ; list of strings (tags used to search ids)
+        :param <id_list>: <list> or <iterator> ; list of (id, url) items or an iterator streaming them
+        :param <nb_of_requests>: <integer> ; number of images to request
+        :param <concurrency>: <integer> ; number of concurrent downloads
+        :param <seed>: <integer> ; seed of the random order of the pictures (None for a different order on each run)
+        """
+        log_event("request_imgs.start", "------|Requesting images from derpibooru|-----")
+        assert(isinstance(tags, list)), error_message("Erroneous Type", "request_imgs", "derpi_get/async_class.py")
+        plan = await asyncio.to_thread(self.plan_downloads, tags, id_list, nb_of_requests, seed)
+        async with self.session():
+            summary = await self.client.download(plan["jobs"], concurrency, plan["on_result"])
+        await asyncio.to_thread(self.complete_downloads, plan, summary)
+        log_event("request_imgs.end", "---------------|Images retrieved|--------------")
+        METRICS.flush()
+        return summary
@@ -0,0 +1,310 @@
+import asyncio
+import logging
+import os
+import time
+from .download_engine import (RETRY_STATUSES, close_part, discard_part, open_part, range_start, record_download,
+                              resume_headers, summarize)
+from .http_cache import cached_response
+from .metrics import METRICS
+from .rate_limiter import rate_controller
+from .repair_engine import EVERYTHING_FILTER_ID, SEARCH_URL, record_batch, repair_engine
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+log = logging.getLogger()
+
+def require_aiohttp():
+    """
+    Raises an ImportError explaining how to enable the asyncio client when aiohttp is missing.
+    """
+    if aiohttp is None:
+        raise ImportError("The asyncio client of derpi_get requires aiohttp (pip install aiohttp).")
+
+class async_rate_controller(rate_controller):
+    """
+    rate_controller shared by every coroutine sending requests to derpibooru.
+    Pacing, pauses and back-offs are the same; waiting coroutines sleep on the event loop in arrival order.
+    """
+    def __init__(self, *args, **kwargs):
+        """
+        Initializes the controller (see rate_controller.__init__()). The lock ordering the waiting coroutines
+        is created by the first acquire(), so that it belongs to the running event loop.
+        """
+        super().__init__(*args, **kwargs)
+        self.queue = None
+
+    async def acquire(self):
+        """
+        Waits until a token is available (and any pause is over), then consumes it.
+        """
+        if self.queue is None: self.queue = asyncio.Lock()
+        async with self.queue:
+            wait = self.take()
+            while wait > 0:
+                METRICS.increment("rate_limit_wait_seconds_total", wait)
+                await asyncio.sleep(wait)
+                wait = self.take()
+
+class async_client:
+    """
+    asyncio HTTP client shared by any number of concurrent searches running on one event loop.
+    Requests go through one pooled aiohttp session, one adaptive rate controller and the on-disk HTTP cache,
+    with the same caching and resumable download semantics as http_cache.get() and download_engine.fetch().
+    """
+    def __init__(self, cache, rate = 5.0, connections = 8, timeout = 60, chunk_size = 64 * 1024, resume = True,
+                 attempts = 5):
+        """
+        Initializes the client. The session is opened by open() (or by entering the client with 'async with').
+        ---
+        :param <cache>: <http_cache> ; HTTP cache the requests go through
+        :param <rate>: <float> ; number of requests allowed per second across all coroutines
+        :param <connections>: <integer> ; size of the connection pool
+        :param <timeout>: <integer> ; timeout in seconds of each request
+        :param <chunk_size>: <integer> ; size in bytes of the chunks written to disk
+        :param <resume>: <boolean> ; toggles resuming interrupted downloads with HTTP Range requests
+        :param <attempts>: <integer> ; number of requests sent for one picture before giving up on it
+        """
+        require_aiohttp()
+        assert(isinstance(attempts, int) and attempts > 0), "The number of attempts must be a positive integer."
+        self.cache = cache
+        self.connections = connections
+        self.timeout = timeout
+        self.chunk_size = chunk_size
+        self.resume = resume
+        self.attempts = attempts
+        self.limiter = async_rate_controller(rate)
+        self.session = None
+
+    async def open(self):
+        """
+        Opens the pooled session (it must be opened from within the event loop).
+        """
+        if self.session is None:
+            self.session = aiohttp.ClientSession(connector = aiohttp.TCPConnector(limit = self.connections),
+                                                 timeout = aiohttp.ClientTimeout(total = self.timeout))
+        return self
+
+    async def close(self):
+        """
+        Closes the pooled session.
+        """
+        if self.session is not None: await self.session.close()
+        self.session = None
+
+    async def __aenter__(self):
+        """
+        Opens the session when entering 'async with' and returns the client.
+        """
+        return await self.open()
+
+    async def __aexit__(self, *exc_info):
+        """
+        Closes the session when leaving 'async with', whether or not an exception was raised.
+        """
+        await self.close()
+
+    async def get(self, url, params = None):
+        """
+        Sends a GET request through the cache and returns a cached_response (see http_cache.get()).
+        Raises aiohttp.ClientResponseError on HTTP error statuses.
+        ---
+        :param <url>: <str> ; url of the resource
+        :param <params>: <dict> ; query parameters
+        """
+        key = self.cache.key(url, params)
+        # Cache files are read and written from worker threads, so that the loop is never blocked by disk I/O
+        meta = await asyncio.to_thread(self.cache.load, key)
+        if meta is not None and self.cache.is_fresh(meta):
+            METRICS.increment("http_requests_total", labels = {"outcome": "hit"})
+            return await asyncio.to_thread(self.cache.read, key, meta)
+        await self.limiter.acquire()
+        started = time.perf_counter()
+        async with self.session.get(url, params = params, headers = self.cache.validators(meta)) as response:
+            self.limiter.observe(response)
+            if response.status == 304 and meta is not None:
+                METRICS.increment("http_requests_total", labels = {"outcome": "revalidated"})
+                meta = await asyncio.to_thread(self.cache.revalidated, key, meta, response)
+                return await asyncio.to_thread(self.cache.read, key, meta)
+            METRICS.increment("http_requests_total", labels = {"outcome": "miss", "status": str(response.status)})
+            response.raise_for_status()
+            content = await response.read()
+        METRICS.observe("http_request_seconds", time.perf_counter() - started)
+        METRICS.increment("http_response_bytes_total", len(content))
+        if response.status == 200: await asyncio.to_thread(self.cache.store, key, url, response.headers, content = content)
+        result = cached_response(content, response.headers)
+        result.status_code, result.from_cache = response.status, False
+        return result
+
+    async def fetch(self, image_id, url, path):
+        """
+        Downloads one picture and reports the outcome (see download_engine.fetch()).
+        Throttled requests and stale partial files are retried, up to <attempts> requests per picture.
+        ---
+        :param <image_id>: <integer> ; id of the picture
+        :param <url>: <str> ; url of the picture
+        :param <path>: <str> ; path where the picture is saved
+        """
+        result = {"id": image_id, "url": url, "path": path, "success": False, "from_cache": False,
+                  "bytes": 0, "error": None}
+        part_path = path + ".part"
+        key = self.cache.key(url)
+        # Partial files and cache files are read and written from worker threads (see get())
+        for _ in range(self.attempts):
+            offset, headers = await asyncio.to_thread(resume_headers, part_path, self.resume)
+            meta = await asyncio.to_thread(self.cache.load, key) if offset == 0 else None
+            try:
+                if meta is not None and self.cache.is_fresh(meta):
+                    await asyncio.to_thread(self.cache.copy_to, key, path)
+                    result["success"] = result["from_cache"] = True
+                    return result
+                headers.update(self.cache.validators(meta))
+                await self.limiter.acquire()
+                async with self.session.get(url, headers = headers) as response:
+                    self.limiter.observe(response)
+                    if response.status in RETRY_STATUSES:
+                        # Throttled or unavailable: backs off (every coroutine waits) and tries again
+                        result["error"] = f"HTTP {response.status}"
+                        response.release()
+                        self.limiter.back_off(aiohttp.ClientResponseError(response.request_info, response.history,
+                                                                          status = response.status))
+                        continue
+                    if response.status == 304 and meta is not None:
+                        await asyncio.to_thread(self.cache.revalidated, key, meta, response)
+                        await asyncio.to_thread(self.cache.copy_to, key, path)
+                        result["success"] = result["from_cache"] = True
+                        return result
+                    if offset > 0 and (response.status == 416 or
+                                       response.status == 206 and range_start(response.headers) != offset):
+                        # The partial file does not match the remote picture anymore: starts over
+                        result["error"] = f"HTTP {response.status} (range mismatch)"
+                        await asyncio.to_thread(discard_part, part_path)
+                        continue
+                    if response.status not in (200, 206):
+                        result["error"] = f"HTTP {response.status}"
+                        return result
+                    file = await asyncio.to_thread(open_part, part_path, response.status, response.headers)
+                    try:
+                        async for chunk in response.content.iter_chunked(self.chunk_size):
+                            await asyncio.to_thread(file.write, chunk)
+                            result["bytes"] += len(chunk)
+                        await asyncio.to_thread(close_part, file, part_path, path)
+                    finally:
+                        if not file.closed: file.close()
+                await asyncio.to_thread(self.cache.store, key, url, response.headers, file_path = path)
+                result["success"], result["error"] = True, None
+            except (aiohttp.ClientError, asyncio.TimeoutError, IOError, OSError) as error:
+                result["error"] = repr(error)
+            return result
+        return result
+
+    async def download(self, jobs, concurrency = 4, on_result = None):
+        """
+        Downloads pictures on <concurrency> coroutines and returns a summary of the run (see download_engine.download()).
+        Jobs are drawn from <jobs> as coroutines become free, so a generator starts downloading before it is exhausted.
+        ---
+        :param <jobs>: <iterable> ; (id, url, path) tuples
+        :param <concurrency>: <integer> ; number of concurrent downloads
+        :param <on_result>: <function> ; called with the result of each download as it completes
+        """
+        assert(isinstance(concurrency, int) and concurrency > 0), "The concurrency must be a positive integer."
+        started = time.monotonic()
+        results = []
+        jobs = iter(jobs)
+        # Planning a job and recording a result hash, link and write files: they run on worker threads,
+        # one at a time so that the plan's state is never touched by two threads
+        planning = asyncio.Lock()
+
+        async def worker():
+            """
+            Downloads jobs one after another until <jobs> is exhausted.
+            """
+            while True:
+                async with planning: job = await asyncio.to_thread(next, jobs, None)
+                if job is None: return
+                started = time.perf_counter()
+                result = await self.fetch(*job)
+                METRICS.observe("download_seconds", time.perf_counter() - started)
+                results.append(result)
+                record_download(result)
+                if on_result is not None:
+                    async with planning: await asyncio.to_thread(on_result, result)
+
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        return summarize(results, time.monotonic() - started)
+
+class async_repair_engine(repair_engine):
+    """
+    repair_engine whose batches are requested concurrently on the event loop through an async_client.
+    The checkpoint is shared with the threaded engine, so either one can resume the other's repair.
+    """
+    def __init__(self, backend, checkpoint_path, client, concurrency = 4, batch_size = 50, search_url = SEARCH_URL):
+        """
+        Initializes the repair engine.
+        ---
+        :param <backend>: <metadata_backend> ; metadata storage backend
+        :param <checkpoint_path>: <str> ; path of the checkpoint file listing the ids left to repair
+        :param <client>: <async_client> ; opened client the search requests go through
+        :param <concurrency>: <integer> ; number of concurrent batch requests
+        :param <batch_size>: <integer> ; number of ids requested per search query (at most 50)
+        :param <search_url>: <str> ; url of the search endpoint
+        """
+        assert(isinstance(concurrency, int) and concurrency > 0), "The concurrency must be a positive integer."
+        assert(isinstance(batch_size, int) and 0 < batch_size <= 50), "The batch size must be between 1 and 50."
+        self.backend = backend
+        self.checkpoint_path = checkpoint_path
+        self.client = client
+        self.workers = concurrency
+        self.batch_size = batch_size
+        self.search_url = search_url
+
+    async def fetch_batch(self, ids):
+        """
+        Requests the tags of a batch of ids through the client, backing off on request errors until it succeeds.
+        Returns {id: tags} for the ids derpibooru answered with tags.
+        ---
+        :param <ids>: <list> ; ids of the pictures
+        """
+        params = {"q": " || ".join(f"id:{image_id}" for image_id in ids),
+                  "perpage": len(ids), "filter_id": EVERYTHING_FILTER_ID}
+        while True:
+            try:
+                response = await self.client.get(self.search_url, params)
+                break
+            except (aiohttp.ClientError, asyncio.TimeoutError) as error:
+                self.client.limiter.back_off(error)
+        return {image_data["id"]: image_data["tags"] for image_data in response.json()["search"]
+                if image_data.get("tags") is not None}
+
+    async def run(self):
+        """
+        Repairs the pending ids on <concurrency> coroutines, saving the checkpoint after each batch,
+        and deletes the checkpoint once every batch is done. Returns the number of repaired records.
+        """
+        pending = self.pending_ids()
+        remaining = set(pending)
+        batches = iter([pending[start:start + self.batch_size] for start in range(0, len(pending), self.batch_size)])
+        counts = {"repaired": 0}
+        writing = asyncio.Lock()
+
+        async def worker():
+            """
+            Repairs batches one after another until every batch is taken.
+            """
+            for batch in batches:
+                tags = await self.fetch_batch(batch)
+                # Segment rewrites and checkpoints are written one batch at a time from a worker thread,
+                # so that the loop is never blocked by disk I/O
+                async with writing:
+                    await asyncio.to_thread(self.backend.update,
+                                            {image_id: {"tags": tags[image_id]} for image_id in batch if image_id in tags})
+                    record_batch(batch, tags)
+                    counts["repaired"] += len(tags)
+                    remaining.difference_update(batch)
+                    await asyncio.to_thread(self.save_checkpoint, sorted(remaining))
+
+        await asyncio.gather(*(worker() for _ in range(self.workers)))
+        os.remove(self.checkpoint_path)
+        return counts["repaired"]
@@ -0,0 +1,540 @@
+import bisect
+import json
+import logging
+import os
+import sqlite3
+import threading
+from .query import compiled_query
+from .segment_store import MANIFEST_NAME, SEGMENT_PREFIX, SEGMENT_SUFFIXES, segment_store
+from .tag_index import split_tags, tag_index
+
+log = logging.getLogger()
+
+def is_newer(record, stored):
+    """
+    Checks whether a record fetched from derpibooru was updated after the stored version.
+    Timestamps share derpibooru's ISO 8601 format and are therefore compared as strings.
+    ---
+    :param <record>: <dict> ; fetched metadata record
+    :param <stored>: <dict> ; stored metadata record
+    """
+    if record.get("updated_at") is None: return False
+    return stored.get("updated_at") is None or record["updated_at"] > stored["updated_at"]
+
+class metadata_backend:
+    """
+    Interface of the storage backends holding the crawled picture metadata.
+    Crawling, filtering and repairing only go through these methods.
+    """
+    def last_id(self):
+        """
+        Returns the highest stored id (0 if the backend is empty).
+        """
+        raise NotImplementedError
+
+    def append(self, records):
+        """
+        Stores records more recent than any stored one (as sent by the crawler).
+        ---
+        :param <records>: <list> ; list of metadata dictionaries
+        """
+        self.upsert(records)
+
+    def upsert(self, records):
+        """
+        Inserts records or replaces the stored records bearing the same ids.
+        ---
+        :param <records>: <list> ; list of metadata dictionaries
+        """
+        raise NotImplementedError
+
+    def update(self, changes):
+        """
+        Merges new field values into stored records. Ids that are not stored are ignored.
+        ---
+        :param <changes>: <dict> ; {id: {field: value}}
+        """
+        records = []
+        for image_id, fields in changes.items():
+            record = self.get(image_id)
+            if record is not None: records.append(dict(record, **fields))
+        self.upsert(records)
+
+    def refresh(self, records):
+        """
+        Merges the fields of records whose 'updated_at' is more recent than the stored one.
+        Records that are not stored or not more recent are ignored. Returns the number of changed records.
+        ---
+        :param <records>: <list> ; list of metadata dictionaries
+        """
+        changed = []
+        for record in records:
+            stored = self.get(record["id"])
+            if stored is not None and is_newer(record, stored): changed.append(dict(stored, **record))
+        self.upsert(changed)
+        return len(changed)
+
+    def get(self, image_id):
+        """
+        Returns the record of an id (None if it is not stored).
+        ---
+        :param <image_id>: <integer> ; id of the picture
+        """
+        raise NotImplementedError
+
+    def iter_records(self, min_id = None, max_id = None, predicate = None):
+        """
+        Iterates lazily over the stored records.
+        ---
+        :param <min_id>: <integer> ; lowest id to return (None for no bound)
+        :param <max_id>: <integer> ; highest id to return (None for no bound)
+        :param <predicate>: <function> ; record -> boolean, evaluated as records are read (None to keep all)
+        """
+        raise NotImplementedError
+
+    def iter_ids(self, query = None, min_id = None, max_id = None):
+        """
+        Iterates lazily over the (id, medium url) of the stored pictures matching a query.
+        ---
+        :param <query>: <compiled_query> or <function> ; compiled query or record -> boolean predicate (None to match all)
+        :param <min_id>: <integer> ; lowest id to return (None for no bound)
+        :param <max_id>: <integer> ; highest id to return (None for no bound)
+        """
+        predicate = query.match if isinstance(query, compiled_query) else query
+        for record in self.iter_records(min_id, max_id, predicate):
+            # Pictures stored without representations have no url to download
+            url = (record.get("representations") or {}).get("medium")
+            if url is not None: yield (record["id"], url[2:])
+
+    def representation_urls(self, ids, name):
+        """
+        Returns {id: url} of one representation of the given stored pictures (without the leading '//'),
+        reading only the records between the lowest and the highest id.
+        ---
+        :param <ids>: <list> ; ids of the pictures
+        :param <name>: <str> ; name of the representation (e.g. 'full')
+        """
+        if len(ids) == 0: return {}
+        wanted = set(ids)
+        urls = {}
+        for record in self.iter_records(min(wanted), max(wanted), lambda record: record["id"] in wanted):
+            url = (record.get("representations") or {}).get(name)
+            if url is not None: urls[record["id"]] = url[2:] if url.startswith("//") else url
+        return urls
+
+    def iter_batches(self, batch_size = 10000):
+        """
+        Iterates over every stored record by lists of at most <batch_size> records.
+        ---
+        :param <batch_size>: <integer> ; maximum number of records per list
+        """
+        batch = []
+        for record in self.iter_records():
+            batch.append(record)
+            if len(batch) == batch_size:
+                yield batch
+                batch = []
+        if batch != []: yield batch
+
+    def records_missing_tags(self):
+        """
+        Iterates over the stored records whose list of tags is missing.
+        """
+        for record in self.iter_records():
+            if record.get("tags") is None: yield record
+
+    def hashes_of(self, ids):
+        """
+        Returns a dictionary {id: sha512_hash} of the stored ids whose record holds a hash.
+        ---
+        :param <ids>: <list> ; ids of the pictures
+        """
+        hashes = {}
+        for image_id in ids:
+            record = self.get(image_id)
+            if record is not None and record.get("sha512_hash") is not None: hashes[image_id] = record["sha512_hash"]
+        return hashes
+
+    def filter_ids(self, tags_keep, tags_remove, at_least_one):
+        """
+        Returns the sorted list of (id, medium url) of the pictures carrying at least one (or all)
+        of <tags_keep> and none of <tags_remove>.
+        ---
+        :param <tags_keep>: <list> ; tags that pictures must carry
+        :param <tags_remove>: <list> ; tags that pictures must not carry
+        :param <at_least_one>: <boolean> ; toggles 'at least one tag' instead of 'all tags'
+        """
+        raise NotImplementedError
+
+    def filter_query(self, query):
+        """
+        Returns the sorted list of (id, medium url) of the pictures matching a compiled query.
+        ---
+        :param <query>: <compiled_query> ; query compiled by derpi_get.query.compile_query()
+        """
+        return list(self.iter_ids(query))
+
+    def close(self):
+        """
+        Releases the resources held by the backend.
+        """
+        pass
+
+class segment_backend(metadata_backend):
+    """
+    Backend storing records in append-only JSON Lines segments, queried through an inverted tag index.
+    Sealed segments can be compressed (see derpi_get/segment_codecs.py).
+    """
+    def __init__(self, folder, max_size = 1024 ** 2, max_records = None, codec = None):
+        """
+        Opens the segment store and the tag index located in <folder>.
+        ---
+        :param <folder>: <str> ; folder where the segments are stored
+        :param <max_size>: <integer> ; size in bytes at which the active segment is sealed
+        :param <max_records>: <integer> ; number of records at which the active segment is sealed (None to disable)
+        :param <codec>: <str> ; codec of the sealed segments ("jsonl", "gzip", "zstd" or "msgpack"), None to keep the store's
+        """
+        self.store = segment_store(folder, max_size, max_records, codec)
+        self.index = tag_index(folder)
+        self.index.catch_up(self.store)
+
+    def last_id(self):
+        """
+        Returns the highest stored id, read from the manifest (0 if the store is empty).
+        """
+        return self.store.last_id()
+
+    def append(self, records):
+        """
+        Appends records more recent than any stored one to the active segment and indexes them.
+        ---
+        :param <records>: <list> ; list of metadata dictionaries
+        """
+        self.store.append(records)
+        self.index.add_records(records)
+
+    def replace_in_segments(self, pending, merge):
+        """
+        Replaces stored records in place, rewriting only the segments where a record actually changed.
+        The ids found in the store are removed from <pending>. Returns the number of changed records.
+        ---
+        :param <pending>: <dict> ; {id: value} where value is combined with the stored record by <merge>
+        :param <merge>: <function> ; function (stored record, value) -> new record
+        """
+        nb_changed = 0
+        for entry in self.store.segments():
+            if pending == {}: break
+            if not any(entry["min_id"] <= image_id <= entry["max_id"] for image_id in pending): continue
+            content = self.store.read_segment(entry)
+            replaced = []
+            for position, record in enumerate(content):
+                if record["id"] not in pending: continue
+                new_record = merge(record, pending.pop(record["id"]))
+                if new_record == record: continue
+                content[position] = new_record
+                replaced.append((record, new_record))
+            if replaced == []: continue
+            self.store.rewrite_segment(entry, content)
+            for old_record, new_record in replaced: self.index.update_record(old_record, new_record)
+            nb_changed += len(replaced)
+        return nb_changed
+
+    def upsert(self, records):
+        """
+        Replaces stored records in place, rewriting only the segments whose records changed.
+        Records absent from the store are appended.
+        ---
+        :param <records>: <list> ; list of metadata dictionaries
+        """
+        pending = {record["id"]: record for record in records}
+        self.replace_in_segments(pending, lambda record, new_record: new_record)
+        if pending != {}: self.append(sorted(pending.values(), key = lambda record: record["id"]))
+
+    def update(self, changes):
+        """
+        Merges new field values into stored records, rewriting only the segments holding them.
+        ---
+        :param <changes>: <dict> ; {id: {field: value}}
+        """
+        self.replace_in_segments(dict(changes), lambda record, fields: dict(record, **fields))
+
+    def refresh(self, records):
+        """
+        Merges the fields of records whose 'updated_at' is more recent than the stored one.
+        Returns the number of changed records.
+        ---
+        :param <records>: <list> ; list of metadata dictionaries
+        """
+        pending = {record["id"]: record for record in records}
+        return self.replace_in_segments(pending, lambda stored, record:
+                                        dict(stored, **record) if is_newer(record, stored) else stored)
+
+    def get(self, image_id):
+        """
+        Returns the record of an id (None if it is not stored), reading only the segments whose id range holds it.
+        ---
+        :param <image_id>: <integer> ; id of the picture
+        """
+        for entry in self.store.segments():
+            if not (entry["min_id"] <= image_id <= entry["max_id"]): continue
+            for record in self.store.read_segment(entry):
+                if record["id"] == image_id: return record
+        return None
+
+    def iter_records(self, min_id = None, max_id = None, predicate = None):
+        """
+        Iterates lazily over the stored records, skipping the segments outside of [min_id, max_id].
+        ---
+        :param <min_id>: <integer> ; lowest id to return (None for no bound)
+        :param <max_id>: <integer> ; highest id to return (None for no bound)
+        :param <predicate>: <function> ; record -> boolean, evaluated as records are read (None to keep all)
+        """
+        return self.store.iter_records(min_id, max_id, predicate)
+
+    def iter_ids(self, query = None, min_id = None, max_id = None):
+        """
+        Iterates lazily over the (id, medium url) of the stored pictures matching a query.
+        ---
+        :param <query>: <compiled_query> or <function> ; compiled query or record -> boolean predicate (None to match all)
+        :param <min_id>: <integer> ; lowest id to return (None for no bound)
+        :param <max_id>: <integer> ; highest id to return (None for no bound)
+        """
+        # Tag-only queries are answered from the posting lists, others by streaming the segments
+        if query is not None and not (isinstance(query, compiled_query) and query.tag_only):
+            yield from metadata_backend.iter_ids(self, query, min_id, max_id)
+            return
+        id_list = self.index.ids if query is None else self.index.evaluate(query.tree)
+        start = bisect.bisect_left(id_list, min_id) if min_id is not None else 0
+        end = bisect.bisect_right(id_list, max_id) if max_id is not None else len(id_list)
+        # Pictures stored without representations have no url to download
+        for image_id, url in self.index.urls_of(id_list[position] for position in range(start, end)):
+            yield (image_id, url[2:])
+
+    def iter_batches(self, batch_size = 10000):
+        """
+        Iterates over every stored record by lists of at most <batch_size> records, reading one segment at a time.
+        ---
+        :param <batch_size>: <integer> ; maximum number of records per list
+        """
+        for entry in self.store.segments():
+            records = self.store.read_segment(entry)
+            for start in range(0, len(records), batch_size): yield records[start:start + batch_size]
+
+    def filter_ids(self, tags_keep, tags_remove, at_least_one):
+        """
+        Returns the sorted list of (id, medium url) of the pictures carrying at least one (or all)
+        of <tags_keep> and none of <tags_remove>, answered from the posting lists.
+        ---
+        :param <tags_keep>: <list> ; tags that pictures must carry
+        :param <tags_remove>: <list> ; tags that pictures must not carry
+        :param <at_least_one>: <boolean> ; toggles 'at least one tag' instead of 'all tags'
+        """
+        id_list = self.index.query(tags_keep, tags_remove, at_least_one)
+        return [(image_id, url[2:]) for image_id, url in self.index.urls_of(id_list)]
+
+    def filter_query(self, query):
+        """
+        Returns the sorted list of (id, medium url) of the pictures matching a compiled query.
+        ---
+        :param <query>: <compiled_query> ; query compiled by derpi_get.query.compile_query()
+        """
+        # Tag-only queries are answered from the posting lists, others by scanning the segments
+        if not query.tag_only: return sorted(metadata_backend.filter_query(self, query))
+        return [(image_id, url[2:]) for image_id, url in self.index.urls_of(self.index.evaluate(query.tree))]
+
+    def hashes_of(self, ids):
+        """
+        Returns a dictionary {id: sha512_hash} of the given ids, read from the hash file of the tag index.
+        ---
+        :param <ids>: <list> ; ids of the pictures
+        """
+        return self.index.hashes_of(ids)
+
+SQLITE_SCHEMA = """
+PRAGMA journal_mode = WAL;
+PRAGMA synchronous = NORMAL;
+CREATE TABLE IF NOT EXISTS images (
+    id INTEGER PRIMARY KEY,
+    created_at TEXT,
+    updated_at TEXT,
+    url TEXT,
+    record TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS tags (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE
+);
+CREATE TABLE IF NOT EXISTS image_tags (
+    tag_id INTEGER NOT NULL,
+    image_id INTEGER NOT NULL,
+    PRIMARY KEY (tag_id, image_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS image_tags_image_id ON image_tags (image_id);
+CREATE INDEX IF NOT EXISTS images_created_at ON images (created_at);
+"""
+
+class sqlite_backend(metadata_backend):
+    """
+    Backend storing records in a SQLite database: one row per picture (upserted by id)
+    and tags normalized into a join table, indexed by id, tag and created_at.
+    """
+    def __init__(self, path, import_folder = None):
+        """
+        Opens (or creates) the SQLite database located at <path>.
+        A database created next to a segment store (or to legacy 'derpibooru_metadata*.json' files) starts
+        with a copy of its records, built under a temporary name so that an interrupted import is started over.
+        ---
+        :param <path>: <str> ; path of the database file
+        :param <import_folder>: <str> ; folder of the segment store to import when the database is created (None to skip)
+        """
+        self.path = path
+        importing = import_folder is not None and not os.path.exists(path) and \
+            any(fname == MANIFEST_NAME or (fname.startswith(SEGMENT_PREFIX) and fname.endswith(tuple(SEGMENT_SUFFIXES)))
+                for fname in os.listdir(import_folder))
+        if importing:
+            for suffix in ["", "-wal", "-shm"]:
+                if os.path.exists(path + ".tmp" + suffix): os.remove(path + ".tmp" + suffix)
+        # The connection is shared with the crawler's writer thread and serialized by a lock
+        self.connection = sqlite3.connect(path + ".tmp" if importing else path, check_same_thread = False)
+        self.lock = threading.Lock()
+        self.connection.executescript(SQLITE_SCHEMA)
+        if importing:
+            self.import_segments(import_folder)
+            self.connection.close()
+            os.replace(path + ".tmp", path)
+            self.connection = sqlite3.connect(path, check_same_thread = False)
+            self.connection.executescript(SQLITE_SCHEMA)
+
+    def import_segments(self, folder):
+        """
+        Copies the records of the segment store located in <folder> into the database, one segment at a time.
+        ---
+        :param <folder>: <str> ; folder of the segment store
+        """
+        store = segment_store(folder)
+        nb_records = 0
+        for entry in store.segments():
+            records = store.read_segment(entry)
+            self.upsert(records)
+            nb_records += len(records)
+        log.info(f"{nb_records} records of the segment store imported into {self.path}.")
+
+    def last_id(self):
+        """
+        Returns the highest stored id (0 if the database is empty).
+        """
+        with self.lock:
+            row = self.connection.execute("SELECT MAX(id) FROM images").fetchone()
+        return row[0] if row[0] is not None else 0
+
+    def upsert(self, records):
+        """
+        Inserts records or replaces the rows bearing the same ids, along with their tags, in one transaction.
+        ---
+        :param <records>: <list> ; list of metadata dictionaries
+        """
+        if records == []: return
+        ids = [(record["id"],) for record in records]
+        tag_rows = [(record["id"], tag) for record in records for tag in split_tags(record)]
+        with self.lock, self.connection:
+            self.connection.executemany(
+                "INSERT INTO images (id, created_at, updated_at, url, record) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT (id) DO UPDATE SET created_at = excluded.created_at, "
+                "updated_at = excluded.updated_at, url = excluded.url, record = excluded.record",
+                [(record["id"], record.get("created_at"), record.get("updated_at"),
+                  (record.get("representations") or {}).get("medium"), json.dumps(record))
+                 for record in records])
+            self.connection.executemany("DELETE FROM image_tags WHERE image_id = ?", ids)
+            self.connection.executemany("INSERT OR IGNORE INTO tags (name) VALUES (?)",
+                                        [(tag,) for image_id, tag in tag_rows])
+            self.connection.executemany(
+                "INSERT OR IGNORE INTO image_tags (tag_id, image_id) SELECT id, ? FROM tags WHERE name = ?",
+                tag_rows)
+
+    def get(self, image_id):
+        """
+        Returns the record of an id (None if it is not stored).
+        ---
+        :param <image_id>: <integer> ; id of the picture
+        """
+        with self.lock:
+            row = self.connection.execute("SELECT record FROM images WHERE id = ?", (image_id,)).fetchone()
+        return json.loads(row[0]) if row is not None else None
+
+    def iter_records(self, min_id = None, max_id = None, predicate = None):
+        """
+        Iterates lazily over the stored records in ascending id order.
+        ---
+        :param <min_id>: <integer> ; lowest id to return (None for no bound)
+        :param <max_id>: <integer> ; highest id to return (None for no bound)
+        :param <predicate>: <function> ; record -> boolean, evaluated as records are read (None to keep all)
+        """
+        # Pages through the table by id so that no cursor stays open across yields
+        last_id = min_id - 1 if min_id is not None else -1
+        upper = max_id if max_id is not None else 2 ** 63 - 1
+        while True:
+            with self.lock:
+                rows = self.connection.execute("SELECT id, record FROM images WHERE id > ? AND id <= ? "
+                                               "ORDER BY id LIMIT 1000", (last_id, upper)).fetchall()
+            if rows == []: return
+            for image_id, record in rows:
+                record = json.loads(record)
+                if predicate is None or predicate(record): yield record
+            last_id = rows[-1][0]
+
+    def filter_ids(self, tags_keep, tags_remove, at_least_one):
+        """
+        Returns the sorted list of (id, medium url) of the pictures carrying at least one (or all)
+        of <tags_keep> and none of <tags_remove>, answered by the join table.
+        ---
+        :param <tags_keep>: <list> ; tags that pictures must carry
+        :param <tags_remove>: <list> ; tags that pictures must not carry
+        :param <at_least_one>: <boolean> ; toggles 'at least one tag' instead of 'all tags'
+        """
+        tag_ids = "SELECT image_id FROM image_tags JOIN tags ON tags.id = image_tags.tag_id WHERE tags.name IN ({})"
+        keep_marks = ", ".join("?" * len(tags_keep))
+        remove_marks = ", ".join("?" * len(tags_remove))
+        if at_least_one:
+            if tags_keep == []: return []
+            query = f"SELECT id, url FROM images WHERE id IN ({tag_ids.format(keep_marks)})"
+        elif tags_keep == []:
+            query = "SELECT id, url FROM images WHERE 1"
+        else:
+            query = f"SELECT id, url FROM images WHERE id IN ({tag_ids.format(keep_marks)} " +\
+                f"GROUP BY image_id HAVING COUNT(DISTINCT tag_id) = {len(set(tags_keep))})"
+        if tags_remove != []: query += f" AND id NOT IN ({tag_ids.format(remove_marks)})"
+        # Pictures stored without representations have no url to download
+        query += " AND url IS NOT NULL"
+        with self.lock:
+            rows = self.connection.execute(query + " ORDER BY id", tags_keep + tags_remove).fetchall()
+        return [(image_id, url[2:]) for image_id, url in rows]
+
+    def hashes_of(self, ids):
+        """
+        Returns a dictionary {id: sha512_hash} of the stored ids whose record holds a hash, by chunks of 500 ids.
+        ---
+        :param <ids>: <list> ; ids of the pictures
+        """
+        hashes = {}
+        for start in range(0, len(ids), 500):
+            chunk = list(ids[start:start + 500])
+            with self.lock:
+                rows = self.connection.execute("SELECT id, json_extract(record, '$.sha512_hash') FROM images "
+                                               f"WHERE id IN ({', '.join('?' * len(chunk))})", chunk).fetchall()
+            hashes.update({image_id: sha for image_id, sha in rows if sha is not None})
+        return hashes
+
+    def records_missing_tags(self):
+        """
+        Iterates over the stored records whose list of tags is missing, in ascending id order.
+        """
+        with self.lock:
+            rows = self.connection.execute("SELECT record FROM images WHERE json_extract(record, '$.tags') IS NULL "
+                                           "ORDER BY id").fetchall()
+        for row in rows: yield json.loads(row[0])
+
+    def close(self):
+        """
+        Closes the connection to the database.
+        """
+        with self.lock: self.connection.close()
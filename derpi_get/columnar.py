@@ -0,0 +1,180 @@
+import logging
+import os
+from datetime import date, datetime, time, timedelta, timezone
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.ipc as ipc
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+log = logging.getLogger()
+
+FILE_FORMATS = {"parquet": ".parquet", "arrow": ".arrow"}
+RANGE_COLUMNS = ["score", "upvotes", "downvotes", "faves", "aspect_ratio", "created_at", "updated_at"]
+
+def require_pyarrow():
+    """
+    Raises an ImportError explaining how to enable the columnar export when pyarrow is missing.
+    """
+    if pa is None:
+        raise ImportError("The columnar export of derpi_get requires pyarrow (pip install pyarrow).")
+
+def metadata_schema():
+    """
+    Returns the Arrow schema of the exported metadata. Tags are stored as a list of strings
+    (dictionary-encoded by the Parquet writer) and the medium representation url as a string.
+    """
+    require_pyarrow()
+    return pa.schema([("id", pa.int64()),
+                      ("created_at", pa.timestamp("us", tz = "UTC")),
+                      ("updated_at", pa.timestamp("us", tz = "UTC")),
+                      ("score", pa.int64()),
+                      ("upvotes", pa.int64()),
+                      ("downvotes", pa.int64()),
+                      ("faves", pa.int64()),
+                      ("aspect_ratio", pa.float64()),
+                      ("uploader", pa.string()),
+                      ("uploader_id", pa.int64()),
+                      ("tags", pa.list_(pa.string())),
+                      ("url", pa.string())])
+
+def is_day(value):
+    """
+    Tells whether a timestamp is a calendar day without a time (e.g. "2019-01-01").
+    ---
+    :param <value>: <str>, <date> or <datetime> ; timestamp
+    """
+    if isinstance(value, str): return len(value) == 10
+    return isinstance(value, date) and not isinstance(value, datetime)
+
+def parse_timestamp(value):
+    """
+    Converts an ISO 8601 string (as sent by derpibooru), a date or a datetime to an aware datetime.
+    Timestamps without a timezone are taken as UTC, and days as their midnight.
+    ---
+    :param <value>: <str>, <date> or <datetime> ; timestamp to convert (None is kept as is)
+    """
+    if value is None: return None
+    if isinstance(value, str): value = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    elif not isinstance(value, datetime): value = datetime.combine(value, time())
+    if value.tzinfo is None: value = value.replace(tzinfo = timezone.utc)
+    return value
+
+def row_indices(size):
+    """
+    Returns the int64 array [0, 1, ..., size - 1], computed by Arrow.
+    ---
+    :param <size>: <integer> ; number of rows
+    """
+    return pc.subtract(pc.cumulative_sum(pa.repeat(pa.scalar(1, pa.int64()), size)), 1)
+
+def records_to_batch(records):
+    """
+    Converts a list of metadata records to an Arrow record batch.
+    ---
+    :param <records>: <list> ; list of metadata dictionaries
+    """
+    schema = metadata_schema()
+    columns = {name: [] for name in schema.names}
+    for record in records:
+        for name in ["id", "score", "upvotes", "downvotes", "faves", "aspect_ratio", "uploader", "uploader_id"]:
+            columns[name].append(record.get(name))
+        columns["created_at"].append(parse_timestamp(record.get("created_at")))
+        columns["updated_at"].append(parse_timestamp(record.get("updated_at")))
+        columns["tags"].append(record["tags"].split(", ") if record.get("tags") else [])
+        columns["url"].append((record.get("representations") or {}).get("medium"))
+    return pa.RecordBatch.from_arrays([pa.array(columns[name], type = schema.field(name).type)
+                                       for name in schema.names], schema = schema)
+
+def export_columnar(backend, path, file_format = "parquet"):
+    """
+    Converts the metadata of a storage backend to a single columnar file, one batch
+    (i.e. one segment for the segment backend) at a time.
+    The file is written under a temporary name and renamed once complete.
+    ---
+    :param <backend>: <metadata_backend> ; metadata storage backend
+    :param <path>: <str> ; path of the columnar file
+    :param <file_format>: <str> ; "parquet" or "arrow" (Arrow IPC file)
+    """
+    require_pyarrow()
+    assert(file_format in FILE_FORMATS), f"The columnar format must be one of {list(FILE_FORMATS)}."
+    schema = metadata_schema()
+    temp_path = path + ".tmp"
+    if file_format == "parquet":
+        writer = pq.ParquetWriter(temp_path, schema, use_dictionary = ["tags", "uploader"])
+    else:
+        writer = ipc.new_file(temp_path, schema)
+    nb_records = 0
+    try:
+        for records in backend.iter_batches():
+            batch = records_to_batch(records)
+            if file_format == "parquet": writer.write_table(pa.Table.from_batches([batch]))
+            else: writer.write_batch(batch)
+            nb_records += batch.num_rows
+    finally:
+        writer.close()
+    os.replace(temp_path, path)
+    return nb_records
+
+def read_columnar(path, columns):
+    """
+    Reads some columns of a columnar metadata file.
+    ---
+    :param <path>: <str> ; path of the columnar file
+    :param <columns>: <list> ; names of the columns to read
+    """
+    require_pyarrow()
+    if path.endswith(FILE_FORMATS["parquet"]): return pq.read_table(path, columns = columns)
+    with pa.memory_map(path, "r") as source: return ipc.open_file(source).read_all().select(columns)
+
+def tag_mask(table, tag):
+    """
+    Returns a boolean array flagging the rows of <table> whose list of tags contains <tag>.
+    ---
+    :param <table>: <pyarrow.Table> ; metadata table holding a 'tags' column
+    :param <tag>: <str> ; tag to look for
+    """
+    tags = table.column("tags").combine_chunks()
+    flat = pc.list_flatten(tags)
+    parents = pc.list_parent_indices(tags)
+    matched = pc.filter(parents, pc.equal(flat, tag))
+    return pc.is_in(row_indices(table.num_rows), value_set = matched.cast(pa.int64()))
+
+def query_columnar(path, tags_keep = [], tags_remove = [], at_least_one = True, ranges = {}):
+    """
+    Selects the rows of a columnar metadata file with vectorized column scans.
+    ---
+    :param <path>: <str> ; path of the columnar file
+    :param <tags_keep>: <list> ; tags that pictures must carry (at least one or all of them)
+    :param <tags_remove>: <list> ; tags that pictures must not carry
+    :param <at_least_one>: <boolean> ; toggles 'at least one tag' instead of 'all tags'
+    :param <ranges>: <dict> ; {column: (low, high)} inclusive bounds, None standing for no bound
+                              (a day given as an upper date bound includes the whole day)
+    """
+    require_pyarrow()
+    for column in ranges:
+        assert(column in RANGE_COLUMNS), f"Range predicates are only available on {RANGE_COLUMNS}."
+    table = read_columnar(path, ["id", "url", "tags"] + list(ranges))
+    mask = pa.repeat(pa.scalar(True), table.num_rows)
+    # Numeric and date range predicates
+    for column, (low, high) in ranges.items():
+        if column in ["created_at", "updated_at"]:
+            day = is_day(high)
+            low, high = parse_timestamp(low), parse_timestamp(high)
+            if day: high += timedelta(days = 1, microseconds = -1)
+        values = table.column(column)
+        if low is not None: mask = pc.and_kleene(mask, pc.fill_null(pc.greater_equal(values, low), False))
+        if high is not None: mask = pc.and_kleene(mask, pc.fill_null(pc.less_equal(values, high), False))
+    # Tag predicates (an empty 'at least one' list keeps nothing, as in id_filter)
+    if tags_keep != [] or at_least_one:
+        keep = pa.repeat(pa.scalar(not at_least_one), table.num_rows)
+        for tag in tags_keep:
+            keep = pc.or_(keep, tag_mask(table, tag)) if at_least_one else pc.and_(keep, tag_mask(table, tag))
+        mask = pc.and_(mask, keep)
+    for tag in tags_remove: mask = pc.and_(mask, pc.invert(tag_mask(table, tag)))
+    selected = table.filter(mask)
+    return list(zip(selected.column("id").to_pylist(),
+                    [url[2:] if url else url for url in selected.column("url").to_pylist()]))
@@ -1,13 +1,31 @@
+import itertools
 import json
 import logging
-import operator
 import os
-import random
+import queue
 import requests
-import time
+import sqlite3
+import threading
+from .backends import segment_backend, sqlite_backend
+from .columnar import FILE_FORMATS, export_columnar, query_columnar
+from .download_planner import DERIVED_REPRESENTATIONS, representation_url
+from .http_cache import http_cache
+from .metrics import METRICS, log_event
+from .query import compile_query, compiled_query, tag_list_query
+from .rate_limiter import rate_controller
+from .records import compact_metadata
+from .repair_engine import EVERYTHING_FILTER_ID, SEARCH_PATH, repair_engine
+from .segment_codecs import CODECS
+from .segment_store import write_atomic
+from .shard_crawler import shard_crawler
 
 log = logging.getLogger()
 
+DERPIBOORU_ROOT = "https://derpibooru.org"
+# Pages of 50 pictures in ascending id order, following the id given after 'gt='
+IMAGES_PATH = "/images.json?constraint=id&order=a&gt="
+NEWEST_PATH = "/images.json?constraint=id&order=d"
+
 def error_message(error_type, location, file_location = "derpi_get/core_class.py"):
     """
     Creates a custom error message.
@@ -21,23 +39,52 @@ def error_message(error_type, location, file_location = "derpi_get/core_class.py
 class img_metadata:
     """
     Object implementing how to retrieve picture metadata from derpibooru's
-    REST API. Data is retrieved as a series of c. 1Mb JSON files.
+    REST API. Data is retrieved as a series of c. 1Mb JSON Lines segments.
     """
-    def __init__(self, tags = [], at_least_one = True, instances = 10):
+    def __init__(self, tags = [], at_least_one = True, instances = 10, segment_size = 1024 ** 2, segment_records = None,
+                 backend = "segments", cache_size = 512 * 1024 ** 2, api_root = DERPIBOORU_ROOT, data_path = None,
+                 representation = "medium", codec = None):
         """
         Initializes the img_metadata class object.
         ---
-        :param <tags>: <list> ; list picture tags used for sorting and extracting metadata
+        :param <tags>: <list> or <str> ; list picture tags used for sorting and extracting metadata, or a query expression
         :param <at_least_one>: <boolean> ; toggles whether or not data to be retrieved must satisfy at least one tag or all of them
         :param <instances>: <integer> ; number of derpibooru image requests allowed before stopping
+        :param <segment_size>: <integer> ; size in bytes at which a metadata segment is sealed
+        :param <segment_records>: <integer> ; number of records at which a metadata segment is sealed (None to disable)
+        :param <backend>: <str> ; metadata storage backend, "segments" (JSON Lines segments) or "sqlite"
+        :param <cache_size>: <integer> ; size cap in bytes of the on-disk HTTP cache (0 disables caching)
+        :param <api_root>: <str> ; root url of the derpibooru API (e.g. a mirror or a local mock server)
+        :param <data_path>: <str> ; folder where metadata and pictures are stored (defaults to './data')
+        :param <representation>: <str> ; size of the pictures whose urls are retrieved and downloaded ('medium', 'large', 'full'...)
+        :param <codec>: <str> ; compression of the sealed metadata segments: "jsonl" (none), "gzip", "zstd" or "msgpack"
+                                (None keeps the codec of an existing store, "jsonl" for a new one)
         """      
-        assert(isinstance(tags, list)), error_message("Erroneous Type", "__init__")
+        assert(isinstance(tags, (list, str))), error_message("Erroneous Type", "__init__")
         assert((isinstance(instances, int)) or instances == ""), error_message("Erroneous Type", "__init__")
         assert(isinstance(at_least_one, bool)), error_message("Erroneous Type", "__init__")
+        assert(isinstance(segment_size, int)), error_message("Erroneous Type", "__init__")
+        assert((segment_records is None) or isinstance(segment_records, int)), error_message("Erroneous Type", "__init__")
+        assert(backend in ["segments", "sqlite"]), error_message("Erroneous Value", "__init__")
+        assert(isinstance(cache_size, int)), error_message("Erroneous Type", "__init__")
+        assert(isinstance(api_root, str)), error_message("Erroneous Type", "__init__")
+        assert((data_path is None) or isinstance(data_path, str)), error_message("Erroneous Type", "__init__")
+        assert(isinstance(representation, str)), error_message("Erroneous Type", "__init__")
+        assert((codec is None) or codec in CODECS), error_message("Erroneous Value", "__init__")
         
         self.tags = tags
         self.at_least_one = at_least_one
         self.instances = instances
+        self.segment_size = segment_size
+        self.segment_records = segment_records
+        self.backend = backend
+        self.cache_size = cache_size
+        self.api_root = api_root.rstrip("/")
+        self.data_path = data_path
+        self.representation = representation
+        self.codec = codec
+        # (settings, backend) of the metadata store opened by check_prior_extract()
+        self.opened = None
     
     def bytes_length(self, bytes_size):
         """
@@ -62,42 +109,39 @@ class img_metadata:
         """
         keys_to_keep = ["id", "created_at", "updated_at", "score", "uploader",
                         "uploader_id", "upvotes", "downvotes", "faves", "tags",
-                        "tags_id", "aspect_ratio", "representations"]
+                        "tags_id", "aspect_ratio", "representations", "sha512_hash", "orig_sha512_hash"]
         return keys_to_keep
     
-    def json_split_size(self, path):
+    def data_folder(self):
         """
-        Splits a json file if it is too large (>1Mb).
-        ---
-        :param <path>: <string> ; path of a json file to weigh
+        Returns the path of the folder where metadata and pictures are stored.
         """
-        assert(isinstance(path, str)), error_message("Erroneous Type", "json_split_size")
-        max_size_reached_message = "MAX JSON FILE SIZE REACHED: file to be split."
+        if self.data_path is not None: return self.data_path
+        return os.path.join(os.getcwd(), "data")
 
-        length = self.bytes_length(float(os.stat(path).st_size))
-        length = length.split(" ")
+    def backend_path(self):
+        """
+        Returns the path of the file identifying the metadata store of the selected backend.
+        """
+        if self.backend == "sqlite": return os.path.join(self.data_folder(), "derpibooru_metadata.sqlite3")
+        return os.path.join(self.data_folder(), "derpibooru_manifest.json")
 
-        if float(length[0]) >= 1.0 and length[1] == "MB":
-            nb_file = 0
-            while True:
-                new_path = path[:-5] + "_" + str(nb_file) + ".json"
-                nb_file += 1
-                if os.path.exists(new_path) == False:
-                    print(max_size_reached_message)
-                    try:
-                        os.rename(path, new_path)
-                    except (IOError, WindowsError):
-                        log.error(error_message("IO or Windows", "json_split_size"))
-                        raise
-                    break
-            return True
-        else:
-            return False
+    def open_cache(self):
+        """
+        Opens the on-disk HTTP cache ('./data/http_cache') that metadata and image requests go through.
+        """
+        try: return http_cache(os.path.join(self.data_folder(), "http_cache"), self.cache_size)
+        except (IOError, OSError) as error:
+            log.error(error_message("IO or Windows", "open_cache"))
+            raise
 
     def check_prior_extract(self, print_msg = True):
         """
-        Checks if prior JSON extractions exist in the working directory (possibly created by self.json_split_size()
-        The default file name is 'derpibooru_metadata.json'.
+        Checks if prior extractions exist in the working directory and opens the metadata storage backend.
+        The backend is opened once and reused by the following calls, as long as the store and its settings are unchanged.
+        The "segments" backend is made of 'derpibooru_metadata*.jsonl' segments (compressed once sealed when the store
+        has a codec, e.g. 'derpibooru_metadata_0.jsonl.zst') described by 'derpibooru_manifest.json',
+        the "sqlite" backend of the 'derpibooru_metadata.sqlite3' database.
         ---
         :param <print_msg>: <boolean> ; toggles between printing messages to the cmd or printing nothing
         """
@@ -108,233 +152,497 @@ class img_metadata:
             ---
             :param <file>: <str> ; name of item.
             """
-            return {"created":f"{file} created in {os.getcwd()}.",
-            "not_created":f"{file} not created in {os.getcwd()}.",
-            "found":f"{file} found in {os.getcwd()}.",
-            "not_found":f"{file} not found in {os.getcwd()}."}
+            location = os.path.dirname(self.data_folder())
+            return {"created":f"{file} created in {location}.",
+            "not_created":f"{file} not created in {location}.",
+            "found":f"{file} found in {location}.",
+            "not_found":f"{file} not found in {location}."}
 
         assert(isinstance(print_msg, bool)), error_message("Erroneous Type", "check_prior_extract")        
         
         folder_messages = create_warnings("Folder ./data")
-        json_messages = create_warnings("File derpibooru_metadata.json")
-        json_path = os.getcwd() + "\\data\\derpibooru_metadata.json"
+        store_messages = create_warnings("Metadata store")
+        data_path = self.data_folder()
         
-        # Checks if a json file exists
-        if os.path.exists(json_path):
-            if print_msg: print(json_messages["found"])
-        else:
-            # If the json file doesn't exist, checks if the folder ./data exists
-            # If the folder doesn't exist, creates it
-            try:
-                if print_msg: print(json_messages["not_found"])
-                if not os.path.exists(os.getcwd() + "\\data"):
-                    if print_msg: print(folder_messages["not_found"])
-                    os.makedirs(os.getcwd() + "\\data")
-                    if print_msg: print(folder_messages["created"])
-                with open(json_path, "w") as file: file.write("[]")
-                if print_msg: print(json_messages["created"])
-            except (IOError, WindowsError) as error:
-                if print_msg: print(folder_messages["not_created"]+"\n"+json_messages["not_created"])
-                log.error(error_message("IO or Windows", "check_prior_extract"))
-                raise
-        return json_path
+        # If the folder ./data doesn't exist, creates it
+        try:
+            if not os.path.exists(data_path):
+                if print_msg: log_event("store.folder", folder_messages["not_found"], path = data_path)
+                os.makedirs(data_path)
+                if print_msg: log_event("store.folder", folder_messages["created"], path = data_path)
+            store_found = os.path.exists(self.backend_path())
+            # Two handles on one store would each rewrite the manifest and lose the other's segments
+            settings = (self.backend, data_path, self.segment_size, self.segment_records, self.codec)
+            if store_found and self.opened is not None and self.opened[0] == settings: backend = self.opened[1]
+            else:
+                if self.backend == "sqlite": backend = sqlite_backend(self.backend_path(), data_path)
+                else: backend = segment_backend(data_path, self.segment_size, self.segment_records, self.codec)
+                self.opened = (settings, backend)
+        except (IOError, OSError, sqlite3.Error) as error:
+            if print_msg: log_event("store.folder", folder_messages["not_created"]+"\n"+store_messages["not_created"],
+                                    logging.ERROR, path = data_path)
+            log.error(error_message("IO or Windows", "check_prior_extract"))
+            raise
+        if print_msg: log_event("store.open", store_messages["found" if store_found else "created"],
+                                backend = self.backend, found = store_found)
+        return backend
 
-    def crawl_metadata(self):
+    def crawl_metadata(self, rate = 5.0, queue_size = 8):
         """
         Retrieves picture metadata from the derpibooru REST API.
+        The crawl is a two-stage pipeline: the calling thread fetches pages under a rate limit
+        while a writer thread trims and persists them. Both stages are joined by a bounded queue,
+        so that the fetcher only waits on the writer when <queue_size> pages are pending.
+        ---
+        :param <rate>: <float> ; number of page requests allowed per second
+        :param <queue_size>: <integer> ; number of fetched pages allowed to wait for the writer
         """
         
-        def back_off(counter, error):
+        def back_off(error, message):
             """
             In case of a request error, creates a back-off as requested by the derpibooru ToS.
+            The delay is applied by the rate controller before the next request.
             ---
-            :param <counter>: int ; counter variable
-            :param <error>: str ; error message
+            :param <error>: <Exception> ; error raised by the request
+            :param <message>: <str> ; error message logged if the back-off gives up
             """
-            if counter > 50: 
-                log.error(error)
+            try: controller.back_off(error)
+            except type(error):
+                log.error(message)
                 raise
-            print(f"The program will back off for {2**counter} seconds.")
-            counter += 1
-            time.sleep(2 ** counter)
-            return counter
         
-        derpibooru_url = "https://derpibooru.org/images.json?constraint=id&order=a&gt="
         iterations = self.instances
-        back_off_counter = 0
         
         # Checks for prior extractions
-        try: json_path = self.check_prior_extract()
-        except (IOError, WindowsError) as error:
+        try: backend = self.check_prior_extract()
+        except (IOError, OSError) as error:
             log.error(error_message("IO or Windows", "crawl_metadata"))
             raise
         
-        # Saves existing data in the most recent JSON file
-        with open(json_path, "r") as file: requested_id = json.load(file)
-        json_local = requested_id
-        # Records the most recent retrieved ID (+&) based on the assumption that the JSON is sorted in descending order
-        if requested_id == []: requested_id = 1
-        else: requested_id = requested_id[0]["id"] + 1
+        # Records the most recent retrieved ID of the backend (the API returns ids > gt)
+        requested_id = backend.last_id()
+        pages = queue.Queue(maxsize = queue_size)
+        writer_errors = []
+        
+        def persist():
+            """
+            Writer stage: appends the pages handed over by the fetcher to the metadata store.
+            After a failure (of any kind), remaining pages are drained without being written so that the fetcher
+            never blocks, and the fetcher stops before its next request.
+            """
+            with METRICS.attach(parent_span):
+                while True:
+                    json_derpibooru = pages.get()
+                    if json_derpibooru is None: return
+                    if writer_errors != []: continue
+                    try: self.json_collect(json_derpibooru, backend)
+                    except Exception as error: writer_errors.append(error)
+        
+        # The spans of the writer are attached to the span the crawl runs in
+        parent_span = METRICS.current_span()
+        writer = threading.Thread(target = persist, name = "derpi_get-writer", daemon = True)
+        writer.start()
+        cache = self.open_cache()
+        controller = rate_controller(rate)
 
-        while True:
+        while writer_errors == []:
             try:
                 # Checks if iterations is a variable of type int
                 # If it is, subtracts 1 (iterations is a counter)
                 if type(iterations)==int:
                     if iterations > 0: iterations -= 1
                     else: 
-                        print(f"{self.instances} images retrieved as requested.")
+                        log_event("crawl.done", f"{self.instances} images retrieved as requested.", pages = self.instances)
                         break
-                # Checks if ./data folder and target metadata file exist
-                json_path = self.check_prior_extract(False)
                 # Requests a new derpibooru page
-                print(f"You are requesting the derpibooru page starting with the id° {requested_id}.")
-                json_derpibooru = requests.get(derpibooru_url + str(requested_id)).json()["images"]
+                log_event("crawl.page", f"You are requesting the derpibooru page starting with the id° {requested_id}.",
+                          cursor = requested_id)
+                with METRICS.span("crawl.page", cursor = requested_id):
+                    #time delay to respect the API's license (only applied to requests that reach the server)
+                    request = cache.get(self.api_root + IMAGES_PATH + str(requested_id), before_request = controller.acquire,
+                                        after_response = controller.observe)
+                    request.raise_for_status()
+                    json_derpibooru = request.json()["images"]
+                METRICS.increment("pages_crawled_total")
                 # Raises exception in case derpibooru was fully scraped, i.e. request returned an empty list
                 if json_derpibooru == []: raise DatabaseFullyCrawled
-                # Updates content of metadata file
-                requested_id, json_local = self.json_collect(json_derpibooru, json_local, json_path)
-                #time delay to respect the API's license
-                time.sleep(.200)
+                # Hands the page over to the writer (blocks while the queue is full) and moves the cursor
+                pages.put(json_derpibooru)
+                requested_id = max(image_data["id"] for image_data in json_derpibooru)
             except DatabaseFullyCrawled:
-                print("The crawler scraped the derpibooru metadata. The program will now close.")
+                log_event("crawl.complete", "The crawler scraped the derpibooru metadata. The program will now close.",
+                          cursor = requested_id)
                 break
-            except (IOError, WindowsError):
-                back_off_counter = back_off(back_off_counter, error_message("IO or Windows", "crawl_metadata"))
-            except (requests.exceptions.TooManyRedirects, requests.exceptions.RequestException):
-                back_off_counter = back_off(back_off_counter, error_message("Request [generic error]", "crawl_metadata"))
-            except requests.exceptions.HTTPError:
-                back_off_counter = back_off(back_off_counter, error_message("Request [hhtp]", "crawl_metadata"))
-            except requests.exceptions.ConnectionError:
-                back_off_counter = back_off(back_off_counter, error_message("Request [Connection]", "crawl_metadata"))
-            except requests.exceptions.Timeout:
-                back_off_counter = back_off(back_off_counter, error_message("Request [timeout]", "crawl_metadata"))  
+            except requests.exceptions.HTTPError as error:
+                back_off(error, error_message("Request [hhtp]", "crawl_metadata"))
+            except requests.exceptions.ConnectionError as error:
+                back_off(error, error_message("Request [Connection]", "crawl_metadata"))
+            except requests.exceptions.Timeout as error:
+                back_off(error, error_message("Request [timeout]", "crawl_metadata"))
+            except (requests.exceptions.TooManyRedirects, requests.exceptions.RequestException) as error:
+                back_off(error, error_message("Request [generic error]", "crawl_metadata"))
+            except (IOError, OSError, ValueError) as error:
+                back_off(error, error_message("IO or Windows", "crawl_metadata"))
+        
+        # Waits for the writer to persist the pending pages
+        pages.put(None)
+        writer.join()
+        if writer_errors != []:
+            if isinstance(writer_errors[0], (IOError, OSError, sqlite3.Error)):
+                log.error(error_message("IO or Windows", "crawl_metadata"))
+            else: log.error(error_message("Unexpected", "crawl_metadata"))
+            raise writer_errors[0]
+
+    def crawl_sharded(self, shards = 4, rate = 5.0, max_id = None):
+        """
+        Backfills the metadata store with a range-sharded crawl (see derpi_get/shard_crawler.py).
+        The ids between the last stored id and <max_id> are split into <shards> disjoint ranges crawled
+        in parallel under a shared rate budget; each shard keeps its own cursor, segments and checkpoint
+        in './data/shards' and the shards are merged into the store once all of them are complete.
+        <instances> caps the number of pages requested across all shards by each call.
+        ---
+        :param <shards>: <integer> ; number of shards crawled in parallel
+        :param <rate>: <float> ; number of page requests allowed per second across all shards
+        :param <max_id>: <integer> ; last id to crawl (defaults to the newest id on derpibooru)
+        """
+        assert(isinstance(shards, int) and shards > 0), error_message("Erroneous Type", "crawl_sharded")
+        try: backend = self.check_prior_extract()
+        except (IOError, OSError) as error:
+            log.error(error_message("IO or Windows", "crawl_sharded"))
+            raise
+        cache = self.open_cache()
+        controller = rate_controller(rate)
+        if max_id is None:
+            request = cache.get(self.api_root + NEWEST_PATH, before_request = controller.acquire, after_response = controller.observe)
+            request.raise_for_status()
+            newest = request.json()["images"]
+            max_id = newest[0]["id"] if newest != [] else backend.last_id()
+        crawler = shard_crawler(os.path.join(self.data_folder(), "shards"), backend, cache, controller,
+                                self.api_root + IMAGES_PATH, self.trim_metadata)
+        try:
+            nb_merged = crawler.run(shards, max_id, self.instances if type(self.instances)==int else None)
+        except (IOError, OSError) as error:
+            log.error(error_message("IO or Windows", "crawl_sharded"))
+            raise
+        if nb_merged > 0: log_event("crawl.merged", f"{nb_merged} pictures merged into the metadata store.", records = nb_merged)
+        return nb_merged
 
-    def json_collect(self, json_derpibooru, json_local, json_path):
+    def trim_metadata(self, json_derpibooru):
         """
-        Stores a json file for later use with a specific numbered name when its size reaches
-		1Mb. Storing is performed by renaming the target file.
+        Deletes unwanted keys (see keys_to_keep()) from each JSON entry of a derpibooru page.
         ---
         :param <json_derpibooru>: <json_object> ; JSON data extracted from derpibooru
-        :param <json_local>: <json_object> ; JSON data stored locally
-        :param <json_path>: <string> ; path of local file where the data is stored
         """
         stored_keys = self.keys_to_keep()
-        last_id = -1
+        return [{key: value for key, value in image_data.items() if key in stored_keys}
+                for image_data in json_derpibooru]
+
+    def refresh_metadata(self, since = None, rate = 5.0):
+        """
+        Re-fetches the already stored pictures whose metadata changed since the refresh watermark,
+        walking derpibooru's search results by ascending 'updated_at', and merges the changed fields in place.
+        The watermark (and page) are kept in 'derpibooru_refresh.json', separately from the forward crawl,
+        so that each refresh only costs the pages updated since the previous one.
+        ---
+        :param <since>: <str> ; ISO 8601 timestamp to start from when no refresh was run yet
+                                (defaults to the most recent 'updated_at' of the stored metadata)
+        :param <rate>: <float> ; number of page requests allowed per second
+        """
+        backend = self.check_prior_extract(False)
+        state_path = os.path.join(self.data_folder(), "derpibooru_refresh.json")
+        if os.path.exists(state_path):
+            with open(state_path, "r") as file: state = json.load(file)
+        else:
+            if since is None:
+                since = max((record["updated_at"] for record in backend.iter_records()
+                             if record.get("updated_at") is not None), default = None)
+            if since is None:
+                log_event("refresh.empty", "No stored metadata to refresh.")
+                return 0
+            state = {"watermark": since, "page": 1}
         
-        # Sorts metadata by ID
-        for image_data in json_derpibooru:
-            temp = image_data.copy()
-            # Deletes unwanted keys from each JSON entry
-            for item in image_data: 
-                if item not in stored_keys: del temp[item]
-            last_id = max(image_data["id"], last_id)
-            json_local.append(temp)
-            json_local.sort(key=operator.itemgetter("id"), reverse = True)
-        # Saves the JSON
-        with open(json_path,'w') as file: json.dump(json_local, file)
+        last_id = backend.last_id()
+        iterations = self.instances
+        cache = self.open_cache()
+        controller = rate_controller(rate)
+        nb_changed = 0
         
-        # Tests if the JSON is too large and needs to be split
-        try: split = self.json_split_size(json_path)
-        except (IOError, WindowsError) as error:
+        while True:
+            if type(iterations)==int:
+                if iterations > 0: iterations -= 1
+                else: break
+            log_event("refresh.page", f"You are requesting the pictures updated since {state['watermark']} (page {state['page']}).",
+                      watermark = state["watermark"], page = state["page"])
+            params = {"q": f"updated_at.gte:{state['watermark']}", "sf": "updated_at", "sd": "asc",
+                      "page": state["page"], "perpage": 50, "filter_id": EVERYTHING_FILTER_ID}
+            try:
+                request = cache.get(self.api_root + SEARCH_PATH, params, 60, controller.acquire, controller.observe)
+                request.raise_for_status()
+                json_derpibooru = request.json()["search"]
+            except (requests.exceptions.RequestException, ValueError) as error:
+                # Retries the same page after backing off (raises once the back-off gives up)
+                controller.back_off(error)
+                iterations = iterations + 1 if type(iterations)==int else iterations
+                continue
+            if json_derpibooru == []:
+                # The next refresh starts over from the first page of the watermark
+                write_atomic(state_path, json.dumps({"watermark": state["watermark"], "page": 1}))
+                log_event("refresh.done", "The stored metadata is up to date.", watermark = state["watermark"])
+                break
+            # Only already stored pictures are refreshed, more recent ones are left to the forward crawl
+            records = [record for record in self.trim_metadata(json_derpibooru) if record["id"] <= last_id]
+            nb_changed += backend.refresh(records)
+            # Moves the watermark forward, or to the next page if the whole page shares the same timestamp
+            newest = max(image_data["updated_at"] for image_data in json_derpibooru)
+            if newest != state["watermark"]: state = {"watermark": newest, "page": 1}
+            else: state["page"] += 1
+            write_atomic(state_path, json.dumps(state))
+        METRICS.increment("refreshed_records_total", nb_changed)
+        log_event("refresh.changed", f"{nb_changed} stored pictures refreshed.", records = nb_changed)
+        return nb_changed
+
+    def json_collect(self, json_derpibooru, backend):
+        """
+        Trims the metadata of a derpibooru page to the kept keys and appends it to the storage backend.
+        ---
+        :param <json_derpibooru>: <json_object> ; JSON data extracted from derpibooru
+        :param <backend>: <metadata_backend> ; storage backend opened by check_prior_extract()
+        """
+        records = self.trim_metadata(json_derpibooru)
+        try:
+            with METRICS.span("json_collect", records = len(records)): backend.append(records)
+        except (IOError, OSError) as error:
             log.error(error_message("IO or Windows", "json_collect"))
             raise
-        if split == True: json_local = []
-        return last_id, json_local
+        METRICS.increment("records_collected_total", len(records))
+        return max(record["id"] for record in records)
     
     def id_filter(self, tags, at_least_one):
         """
-        Retrieves the IDs of the locally stored metadata that fit specific tag parameters
+        Retrieves the IDs of the locally stored metadata that fit specific tag parameters.
+        The query is answered by the storage backend (inverted tag index or SQLite join table).
         ---
         :param <tags>: <list> ; list picture tags used for sorting and extracting metadata
         :param <at_least_one>: <boolean> ; toggles whether or not data to be retrieved must satisfy at least one tag or all of them
         """
+        # Creates the lists of the tags to keep (starting with +) and to remove (starting with -)
+        tags_keep = [item[1:] for item in tags if item.startswith("+")]
+        tags_remove = [item[1:] for item in tags if item.startswith("-")]
         
-        def any_or_all(boolean):
-            """
-            Returns the function any() if argument <boolean> TRUE, else returns function all()
-            ---
-            :param <boolean>: <boolean> ; boolean value
-            """
-            if boolean == True: return any
-            else: return all
-        
-        metadata_files_list = filter(lambda file: file.startswith("derpibooru_metadata"), os.listdir(os.getcwd() + "\\data"))
-        metadata_files_list = list(metadata_files_list)
-        id_list = []
-        url_list = []
-        
-        for fname in metadata_files_list:
-            try:
-                with open(os.getcwd() + "\\data\\" + fname,"r") as file: json_local = json.load(file)
-                if json_local == []: break
-                # Creates a list of the tags to keep based on each starting with a key character +
-                tags_keep = list(filter(lambda item: item.startswith("+"), tags))
-                tags_keep = list(map(lambda item: item[1:], tags_keep))
-                # Creates a list of the tags to keep based on each starting with a key character -
-                tags_remove = list(filter(lambda item: item.startswith("-"), tags))
-                tags_remove = list(map(lambda item: item[1:], tags_remove))
-                # Checks the requested filter
-                fltr = any_or_all(at_least_one)
-                # Filters out unwanted entries
-                filter_keep = lambda item: fltr(tag in item["tags"].split(", ") for tag in tags_keep)
-                filter_remove = lambda item: not any(tag in item["tags"].split(", ") for tag in tags_remove)
-                json_kept = list(filter(filter_keep, json_local))
-                json_kept = list(filter(filter_remove, json_kept))
-                filter_id = lambda item: item["id"]
-                filter_url = lambda item: item["representations"]["medium"][2:]
-                id_list += list(map(filter_id, json_kept))
-                url_list += list(map(filter_url, json_kept))
-            except (IOError, WindowsError) as error:
-                log.error(error_message(f"{fname} JSON - IO or Windows", "id_filter"))
-                raise
-        
-        return list(zip(id_list, url_list))
+        try:
+            backend = self.check_prior_extract(False)
+            with METRICS.span("id_filter", tags = len(tags_keep) + len(tags_remove)) as attributes:
+                id_list = self.with_representation(backend.filter_ids(tags_keep, tags_remove, at_least_one), backend)
+                attributes["matches"] = len(id_list)
+        except (IOError, OSError) as error:
+            log.error(error_message("IO or Windows", "id_filter"))
+            raise
+        METRICS.increment("filter_matches_total", len(id_list), {"method": "id_filter"})
+        return id_list
     
-    def repair_tags(self):
+    def query_filter(self, expression):
+        """
+        Retrieves the IDs of the locally stored metadata matching a boolean query expression,
+        e.g. '(a OR b) AND NOT c AND score.gt:100'. The expression is compiled once into a matcher;
+        queries that only test tags are answered from the tag index when the backend has one.
+        ---
+        :param <expression>: <str> ; query expression (see derpi_get/query.py for the syntax)
+        """
+        assert(isinstance(expression, str)), error_message("Erroneous Type", "query_filter")
+        query = compile_query(expression)
+        try:
+            backend = self.check_prior_extract(False)
+            with METRICS.span("query_filter", tag_only = query.tag_only) as attributes:
+                id_list = self.with_representation(backend.filter_query(query), backend)
+                attributes["matches"] = len(id_list)
+        except (IOError, OSError) as error:
+            log.error(error_message("IO or Windows", "query_filter"))
+            raise
+        METRICS.increment("filter_matches_total", len(id_list), {"method": "query_filter"})
+        return id_list
+
+    def with_representation(self, id_list, backend):
+        """
+        Turns the (id, medium url) items answered by the backend into (id, url) items of the selected representation.
+        Derived sizes (see DERIVED_REPRESENTATIONS) are rebuilt from the medium url; others are read from the stored records,
+        and pictures without that representation are left out.
+        ---
+        :param <id_list>: <list> ; (id, medium url) items
+        :param <backend>: <metadata_backend> ; storage backend opened by check_prior_extract()
+        """
+        if self.representation == "medium": return id_list
+        if self.representation in DERIVED_REPRESENTATIONS:
+            return [(image_id, representation_url(url, self.representation)) for image_id, url in id_list]
+        urls = backend.representation_urls([image_id for image_id, _ in id_list], self.representation)
+        return [(image_id, urls[image_id]) for image_id, _ in id_list if image_id in urls]
+
+    def as_query(self, query):
+        """
+        Turns the query forms accepted by iter_records() and iter_ids() into a compiled query or a predicate.
+        ---
+        :param <query>: <str>, <list>, <compiled_query> or <function> ; query expression, list of +/- tags
+                        (combined according to at_least_one), compiled query or record -> boolean predicate
+        """
+        if query is None or isinstance(query, compiled_query) or callable(query): return query
+        if isinstance(query, str): return compile_query(query)
+        assert(isinstance(query, list)), error_message("Erroneous Type", "as_query")
+        return tag_list_query([item[1:] for item in query if item.startswith("+")],
+                              [item[1:] for item in query if item.startswith("-")], self.at_least_one)
+
+    def iter_records(self, query = None, min_id = None, max_id = None):
+        """
+        Streams the locally stored records, segment by segment (or page by page with the sqlite backend).
+        The query is evaluated as records are read and segments outside of [min_id, max_id] are skipped.
+        ---
+        :param <query>: <str>, <list>, <compiled_query> or <function> ; see as_query() (None to stream every record)
+        :param <min_id>: <integer> ; lowest id to return (None for no bound)
+        :param <max_id>: <integer> ; highest id to return (None for no bound)
+        """
+        query = self.as_query(query)
+        predicate = query.match if isinstance(query, compiled_query) else query
+        try:
+            backend = self.check_prior_extract(False)
+            yield from backend.iter_records(min_id, max_id, predicate)
+        except (IOError, OSError) as error:
+            log.error(error_message("IO or Windows", "iter_records"))
+            raise
+
+    def iter_ids(self, query = None, min_id = None, max_id = None):
+        """
+        Streams the (id, url) of the locally stored pictures matching a query, in the format of id_filter().
+        Tag-only queries are answered from the tag index without reading the segments.
+        ---
+        :param <query>: <str>, <list>, <compiled_query> or <function> ; see as_query() (None to stream every id)
+        :param <min_id>: <integer> ; lowest id to return (None for no bound)
+        :param <max_id>: <integer> ; highest id to return (None for no bound)
+        """
+        query = self.as_query(query)
+        try:
+            backend = self.check_prior_extract(False)
+            if self.representation in DERIVED_REPRESENTATIONS:
+                for item in backend.iter_ids(query, min_id, max_id):
+                    yield (item[0], representation_url(item[1], self.representation))
+                return
+            # Other representations are looked up by batches of ids
+            items = backend.iter_ids(query, min_id, max_id)
+            while True:
+                batch = list(itertools.islice(items, 1000))
+                if batch == []: break
+                yield from self.with_representation(batch, backend)
+        except (IOError, OSError) as error:
+            log.error(error_message("IO or Windows", "iter_ids"))
+            raise
+
+    def load_metadata(self, expression = None, compact = True):
+        """
+        Loads the locally stored metadata (optionally only the records matching a query expression).
+        Records are compacted while they are read into a compact_metadata table (see derpi_get/records.py),
+        which holds the corpus in a fraction (about a seventh) of the memory of the equivalent dictionaries.
+        ---
+        :param <expression>: <str> ; query expression (None to load every record)
+        :param <compact>: <boolean> ; returns a compact_metadata table instead of a list of dictionaries
+        """
+        query = compile_query(expression) if expression is not None else None
+        try:
+            backend = self.check_prior_extract(False)
+            records = compact_metadata() if compact else []
+            for record in backend.iter_records(predicate = query.match if query is not None else None):
+                records.append(record)
+            return records
+        except (IOError, OSError) as error:
+            log.error(error_message("IO or Windows", "load_metadata"))
+            raise
+
+    def convert_metadata(self, codec):
+        """
+        Converts the sealed metadata segments, legacy 'derpibooru_metadata*.json' files included, to a segment codec,
+        which becomes the codec of the store. Segments already encoded with the codec are left as they are.
+        ---
+        :param <codec>: <str> ; "jsonl" (uncompressed), "gzip", "zstd" (requires zstandard) or "msgpack" (requires msgpack and zstandard)
+        """
+        assert(self.backend == "segments"), error_message("Erroneous Value", "convert_metadata")
+        assert(codec in CODECS), error_message("Erroneous Value", "convert_metadata")
+        backend = self.check_prior_extract(False)
+        try:
+            with METRICS.span("convert", codec = codec):
+                nb_converted = backend.store.convert(codec)
+        except (IOError, OSError) as error:
+            log.error(error_message("IO or Windows", "convert_metadata"))
+            raise
+        self.codec = codec
+        log_event("convert.done", f"{nb_converted} metadata segments converted to {codec}.", segments = nb_converted, codec = codec)
+        return nb_converted
+
+    def columnar_path(self, file_format = "parquet"):
+        """
+        Returns the path of the columnar export of the metadata.
+        ---
+        :param <file_format>: <str> ; "parquet" or "arrow"
+        """
+        assert(file_format in FILE_FORMATS), error_message("Erroneous Value", "columnar_path")
+        return os.path.join(self.data_folder(), "derpibooru_metadata" + FILE_FORMATS[file_format])
+
+    def export_metadata(self, file_format = "parquet"):
+        """
+        Compacts the locally stored metadata segments into a columnar file (Parquet or Arrow IPC).
+        Requires pyarrow.
+        ---
+        :param <file_format>: <str> ; "parquet" or "arrow"
+        """
+        backend = self.check_prior_extract(False)
+        path = self.columnar_path(file_format)
+        try:
+            nb_records = export_columnar(backend, path, file_format)
+        except (IOError, OSError) as error:
+            log.error(error_message("IO or Windows", "export_metadata"))
+            raise
+        log_event("export.done", f"{nb_records} records exported to {path}.", records = nb_records, path = path)
+        return path
+
+    def query_metadata(self, tags = [], at_least_one = True, file_format = "parquet", **ranges):
+        """
+        Retrieves the IDs of the exported metadata fitting tag parameters and range predicates,
+        e.g. query_metadata(["+safe"], score = (100, None), created_at = ("2019-01-01", "2019-12-31")).
+        Predicates are evaluated with vectorized column scans on the file built by export_metadata().
+        ---
+        :param <tags>: <list> ; list of "+tag"/"-tag" strings, as in id_filter()
+        :param <at_least_one>: <boolean> ; toggles whether or not data to be retrieved must satisfy at least one tag or all of them
+        :param <file_format>: <str> ; "parquet" or "arrow"
+        :param <ranges>: <tuple> ; (low, high) inclusive bounds on score, upvotes, downvotes, faves, aspect_ratio, created_at or updated_at
+        """
+        assert(isinstance(tags, list)), error_message("Erroneous Type", "query_metadata")
+        assert(isinstance(at_least_one, bool)), error_message("Erroneous Type", "query_metadata")
+        tags_keep = [item[1:] for item in tags if item.startswith("+")]
+        tags_remove = [item[1:] for item in tags if item.startswith("-")]
+        try:
+            return query_columnar(self.columnar_path(file_format), tags_keep, tags_remove, at_least_one, ranges)
+        except (IOError, OSError) as error:
+            log.error(error_message("IO or Windows", "query_metadata"))
+            raise
+
+    def repair_tags(self, workers = 4, rate = 5.0, batch_size = 50):
         """
         Checks if all retrieved IDs have an available list of tags.
-        If not, repairs them by requested the derpibooru's API.
+        If not, repairs them by requesting the derpibooru's API by batches of ids, on concurrent workers.
+        Progress is checkpointed in 'derpibooru_repair.json' so that an interrupted repair resumes where it stopped.
+        ---
+        :param <workers>: <integer> ; number of concurrent requests
+        :param <rate>: <float> ; number of requests allowed per second
+        :param <batch_size>: <integer> ; number of ids requested at once (at most 50)
         """
-        metadata_files_list = filter(lambda file: file.startswith("derpibooru_metadata"), os.listdir(os.getcwd() + "\\data"))
-        metadata_files_list = list(metadata_files_list)
-        
-        for fname in metadata_files_list: 
-            with open(os.getcwd() + "\\data\\" + fname, "r") as file: 
-                try:
-                    json_local = json.load(file)
-                    if json_local == []: break
-                    for index, item in enumerate(json_local):
-                        if item["tags"] == None:
-                            json_id = item["id"]
-                            path_derpibooru = "https://derpibooru.org/" + str(json_id) + ".json"
-                            json_derpibooru = requests.get(path_derpibooru).json()
-                            time.sleep(.200)
-                            if json_derpibooru["tags"] == None: raise AbsentTagList
-                            json_local[index]["tags"] = json_derpibooru["tags"]
-                            print(f"The tags of the picture {json_id} were updated.") 
-                except AbsentTagList:
-                    print(f"The url request for the picture {json_id} returned an empty list of tags.")
-                except (IOError, WindowsError) as error:
-                    log.error(error_message("IO or Windows", "repair_tags"))
-                    raise
-                except (requests.exceptions.TooManyRedirects, requests.exceptions.RequestException) as error:
-                    log.error(error_message("Request [generic error]", "repair_tags"))
-                    raise
-                except requests.exceptions.HTTPError as error:
-                    log.error(error_message("Request [hhtp]", "repair_tags"))
-                    raise
-                except requests.exceptions.ConnectionError as error:
-                    log.error(error_message("Request [Connection]", "repair_tags"))
-                    raise
-                except requests.exceptions.Timeout as error:
-                    log.error(error_message("Request [timeout]", "repair_tags"))
-                    raise
-            try:
-                with open(os.getcwd() + "\\data\\" + fname,'w') as file: json.dump(json_local, file)
-            except (IOError, WindowsError) as error:
-                log.error(error_message("IO or Windows", "repair_tags"))
-                raise
+        backend = self.check_prior_extract(False)
+        checkpoint_path = os.path.join(self.data_folder(), "derpibooru_repair.json")
+        try:
+            nb_repaired = repair_engine(backend, checkpoint_path, self.open_cache(), workers, rate, batch_size,
+                                        self.api_root + SEARCH_PATH).run()
+        except (IOError, OSError) as error:
+            log.error(error_message("IO or Windows", "repair_tags"))
+            raise
+        except (requests.exceptions.TooManyRedirects, requests.exceptions.RequestException) as error:
+            log.error(error_message("Request [generic error]", "repair_tags"))
+            raise
+        log_event("repair.done", f"{nb_repaired} pictures repaired.", records = nb_repaired)
+        return nb_repaired
 
 class Error(Exception):
     """Base class for other exceptions"""
@@ -0,0 +1,260 @@
+import itertools
+import logging
+import os
+import requests
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from requests.adapters import HTTPAdapter
+from .metrics import METRICS, log_event
+from .rate_limiter import rate_controller
+
+log = logging.getLogger()
+
+# Statuses answered to requests that can be sent again after backing off
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+def resume_headers(part_path, resume = True):
+    """
+    Returns the offset a download resumes from and the headers of its request.
+    A partial file is only resumed when the validator (ETag or Last-Modified) of the response it was started from
+    is known: it is sent as If-Range, so that a picture changed since then is sent whole again.
+    ---
+    :param <part_path>: <str> ; path of the partial file
+    :param <resume>: <boolean> ; toggles resuming partial files
+    """
+    validator_path = part_path + ".validator"
+    if not (resume and os.path.exists(part_path) and os.path.exists(validator_path)): return 0, {}
+    offset = os.path.getsize(part_path)
+    if offset == 0: return 0, {}
+    with open(validator_path, "r") as file: validator = file.read()
+    return offset, {"Range": f"bytes={offset}-", "If-Range": validator}
+
+def start_part(part_path, headers):
+    """
+    Records the validator of the response a partial file is written from (see resume_headers()).
+    Weak ETags cannot be sent as If-Range: Last-Modified is recorded instead, if the response has one.
+    ---
+    :param <part_path>: <str> ; path of the partial file
+    :param <headers>: <dict> ; headers of the response
+    """
+    etag = headers.get("ETag")
+    validator = etag if etag is not None and not etag.startswith("W/") else headers.get("Last-Modified")
+    if validator is None: clear_part(part_path)
+    else:
+        with open(part_path + ".validator", "w") as file: file.write(validator)
+
+def clear_part(part_path):
+    """
+    Deletes the validator of a partial file once the file is complete or discarded.
+    ---
+    :param <part_path>: <str> ; path of the partial file
+    """
+    if os.path.exists(part_path + ".validator"): os.remove(part_path + ".validator")
+
+def open_part(part_path, status, headers):
+    """
+    Opens the partial file a response is written to: appended to for a 206 response, else written from the start.
+    A server ignoring the Range header, or a picture changed since the partial file was started (If-Range),
+    sends the whole picture again.
+    ---
+    :param <part_path>: <str> ; path of the partial file
+    :param <status>: <integer> ; status of the response (200 or 206)
+    :param <headers>: <dict> ; headers of the response
+    """
+    if status == 206: return open(part_path, "ab")
+    start_part(part_path, headers)
+    return open(part_path, "wb")
+
+def close_part(file, part_path, path):
+    """
+    Flushes a complete partial file to disk and renames it to its final name.
+    ---
+    :param <file>: <file> ; opened partial file
+    :param <part_path>: <str> ; path of the partial file
+    :param <path>: <str> ; final path of the picture
+    """
+    file.flush()
+    os.fsync(file.fileno())
+    file.close()
+    os.replace(part_path, path)
+    clear_part(part_path)
+
+def discard_part(part_path):
+    """
+    Deletes a partial file that does not match the remote picture anymore, along with its validator.
+    ---
+    :param <part_path>: <str> ; path of the partial file
+    """
+    if os.path.exists(part_path): os.remove(part_path)
+    clear_part(part_path)
+
+def range_start(headers):
+    """
+    Returns the first byte of the range sent in a 206 response (None if its Content-Range cannot be read).
+    ---
+    :param <headers>: <dict> ; headers of the response ('Content-Range: bytes <start>-<end>/<size>')
+    """
+    content_range = headers.get("Content-Range", "")
+    try: return int(content_range.split(" ")[1].split("-")[0])
+    except (IndexError, ValueError): return None
+
+class download_engine:
+    """
+    Downloads pictures with a bounded pool of worker threads.
+    Workers share one connection-pooled session and one adaptive rate controller, so that requests are
+    sent at the rate the server sustains regardless of the latency of each individual download.
+    Pictures are streamed to a '.part' file that is renamed once complete: a file bearing
+    its final name is always whole, and an interrupted '.part' file can be resumed.
+    """
+    def __init__(self, workers = 4, rate = 5.0, timeout = 60, chunk_size = 64 * 1024, resume = True, cache = None,
+                 attempts = 5):
+        """
+        Initializes the download engine.
+        ---
+        :param <workers>: <integer> ; number of concurrent downloads
+        :param <rate>: <float> ; number of requests allowed per second across all workers
+        :param <timeout>: <integer> ; timeout in seconds of each request
+        :param <chunk_size>: <integer> ; size in bytes of the chunks written to disk
+        :param <resume>: <boolean> ; toggles resuming interrupted downloads with HTTP Range requests
+        :param <cache>: <http_cache> ; HTTP cache revalidating previously downloaded pictures (optional)
+        :param <attempts>: <integer> ; number of requests sent for one picture before giving up on it
+        """
+        assert(isinstance(workers, int) and workers > 0), "The number of workers must be a positive integer."
+        assert(isinstance(attempts, int) and attempts > 0), "The number of attempts must be a positive integer."
+        self.workers = workers
+        self.attempts = attempts
+        self.timeout = timeout
+        self.chunk_size = chunk_size
+        self.resume = resume
+        self.cache = cache
+        self.limiter = rate_controller(rate)
+        self.session = cache.session if cache is not None else requests.Session()
+        adapter = HTTPAdapter(pool_connections = workers, pool_maxsize = workers)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def fetch(self, image_id, url, path):
+        """
+        Downloads one picture and reports the outcome.
+        Throttled requests and stale partial files are retried, up to <attempts> requests per picture.
+        ---
+        :param <image_id>: <integer> ; id of the picture
+        :param <url>: <str> ; url of the picture
+        :param <path>: <str> ; path where the picture is saved
+        """
+        result = {"id": image_id, "url": url, "path": path, "success": False, "from_cache": False,
+                  "bytes": 0, "error": None}
+        part_path = path + ".part"
+        key = self.cache.key(url) if self.cache is not None else None
+        for _ in range(self.attempts):
+            offset, headers = resume_headers(part_path, self.resume)
+            # Pictures already in the HTTP cache are served as is while fresh, else revalidated
+            meta = self.cache.load(key) if (key is not None and offset == 0) else None
+            try:
+                if meta is not None and self.cache.is_fresh(meta):
+                    self.cache.copy_to(key, path)
+                    result["success"] = result["from_cache"] = True
+                    return result
+                headers.update(self.cache.validators(meta) if meta is not None else {})
+                self.limiter.acquire()
+                with self.session.get(url, headers = headers, stream = True, timeout = self.timeout) as request:
+                    self.limiter.observe(request)
+                    if request.status_code in RETRY_STATUSES:
+                        # Throttled or unavailable: backs off (every worker waits) and tries again
+                        result["error"] = f"HTTP {request.status_code}"
+                        request.close()
+                        self.limiter.back_off(requests.exceptions.HTTPError(result["error"], response = request))
+                        continue
+                    if request.status_code == 304 and meta is not None:
+                        self.cache.revalidated(key, meta, request)
+                        self.cache.copy_to(key, path)
+                        result["success"] = result["from_cache"] = True
+                        return result
+                    if offset > 0 and (request.status_code == 416 or
+                                       request.status_code == 206 and range_start(request.headers) != offset):
+                        # The partial file does not match the remote picture anymore: starts over
+                        result["error"] = f"HTTP {request.status_code} (range mismatch)"
+                        discard_part(part_path)
+                        continue
+                    if request.status_code not in (200, 206):
+                        result["error"] = f"HTTP {request.status_code}"
+                        return result
+                    with open_part(part_path, request.status_code, request.headers) as file:
+                        for chunk in request.iter_content(chunk_size = self.chunk_size):
+                            file.write(chunk)
+                            result["bytes"] += len(chunk)
+                        close_part(file, part_path, path)
+                if self.cache is not None: self.cache.store(key, url, request.headers, file_path = path)
+                result["success"], result["error"] = True, None
+            except (requests.exceptions.RequestException, IOError, OSError) as error:
+                result["error"] = repr(error)
+            return result
+        return result
+
+    def download(self, jobs, on_result = None):
+        """
+        Downloads a list of pictures concurrently and returns a summary of the run.
+        Jobs are drawn from <jobs> as downloads complete, with at most two jobs per worker submitted at a time,
+        so a generator starts downloading before it is exhausted and a long list is never queued at once.
+        ---
+        :param <jobs>: <iterable> ; (id, url, path) tuples
+        :param <on_result>: <function> ; called with the result of each download as it completes (e.g. to record progress)
+        """
+        started = time.monotonic()
+        results = []
+        jobs = iter(jobs)
+
+        def timed_fetch(*job):
+            """
+            Downloads one picture (see fetch()) and records the duration of the download.
+            ---
+            :param <job>: <tuple> ; (id, url, path)
+            """
+            with METRICS.timer("download_seconds"): return self.fetch(*job)
+
+        with ThreadPoolExecutor(max_workers = self.workers) as executor:
+            pending = {executor.submit(timed_fetch, *job) for job in itertools.islice(jobs, 2 * self.workers)}
+            while pending:
+                done, pending = wait(pending, return_when = FIRST_COMPLETED)
+                for future in done:
+                    result = future.result()
+                    results.append(result)
+                    record_download(result)
+                    if on_result is not None: on_result(result)
+                    job = next(jobs, None)
+                    if job is not None: pending.add(executor.submit(timed_fetch, *job))
+        return summarize(results, time.monotonic() - started)
+
+def record_download(result):
+    """
+    Counts the outcome of a download and logs it.
+    ---
+    :param <result>: <dict> ; result of the download (see download_engine.fetch())
+    """
+    outcome = ("cached" if result["from_cache"] else "downloaded") if result["success"] else "failed"
+    METRICS.increment("downloads_total", labels = {"outcome": outcome})
+    METRICS.increment("download_bytes_total", result["bytes"])
+    if result["success"]:
+        log_event("download.done", f"The picture {result['id']} was downloaded.", id = result["id"],
+                  bytes = result["bytes"], from_cache = result["from_cache"])
+    else:
+        log_event("download.failed", f"The picture {result['id']} could not be downloaded ({result['error']}).",
+                  logging.WARNING, id = result["id"], error = result["error"])
+
+def summarize(results, elapsed):
+    """
+    Returns the summary of a download run: counts, throughput and per-picture results.
+    ---
+    :param <results>: <list> ; results of the downloads (see download_engine.fetch())
+    :param <elapsed>: <float> ; duration of the run in seconds
+    """
+    downloaded = [result for result in results if result["success"]]
+    nb_bytes = sum(result["bytes"] for result in downloaded)
+    return {"downloaded": len(downloaded),
+            "from_cache": len([result for result in downloaded if result["from_cache"]]),
+            "failed": len(results) - len(downloaded),
+            "bytes": nb_bytes,
+            "seconds": elapsed,
+            "images_per_second": len(downloaded) / elapsed if elapsed > 0 else 0.0,
+            "bytes_per_second": nb_bytes / elapsed if elapsed > 0 else 0.0,
+            "results": results}
@@ -0,0 +1,161 @@
+import hashlib
+import json
+import logging
+import os
+import random
+from .metrics import METRICS, log_event
+from .segment_store import write_atomic
+
+log = logging.getLogger()
+
+# Formats downloaded by request_imgs()
+DOWNLOAD_FORMATS = ("png", "jpeg", "jpg")
+# Representations derpibooru serves next to 'medium' as '<prefix><name><extension>' ('full' is served elsewhere)
+DERIVED_REPRESENTATIONS = ("thumb_tiny", "thumb_small", "thumb", "small", "medium", "large", "tall")
+QUEUE_NAME = "derpibooru_download_queue.json"
+PROGRESS_NAME = "derpibooru_download_queue.done"
+
+def url_extension(url):
+    """
+    Returns the lower-case extension of the file an url points to ('' if it has none).
+    ---
+    :param <url>: <str> ; url of a picture
+    """
+    name = url.rsplit("/", 1)[-1]
+    return name.rsplit(".", 1)[-1].lower() if "." in name else ""
+
+def representation_url(url, name):
+    """
+    Turns the url of the 'medium' representation of a picture into the url of another derived representation.
+    ---
+    :param <url>: <str> ; url of the 'medium' representation (e.g. 'derpicdn.net/img/2020/1/1/1/medium.png')
+    :param <name>: <str> ; name of the representation (see DERIVED_REPRESENTATIONS)
+    """
+    head, _, tail = url.rpartition("/")
+    if not tail.startswith("medium."): return url
+    return f"{head}/{name}{tail[len('medium'):]}"
+
+class download_planner:
+    """
+    Plans the downloads of a query folder in linear time:
+    the (id, url) items are filtered on their format up front, the pictures already present in the folder
+    are found from a single directory listing, and the items are shuffled (or sampled) with a seeded
+    generator without touching the caller's list. The resulting work queue is saved in the query folder
+    ('derpibooru_download_queue.json') and completed downloads are appended to a progress file, so that
+    an interrupted run planned from the same ids resumes with the pictures left to download.
+    """
+    def __init__(self, folder, formats = DOWNLOAD_FORMATS, seed = None):
+        """
+        Initializes the planner.
+        ---
+        :param <folder>: <str> ; query folder where the pictures are exposed
+        :param <formats>: <tuple> ; extensions of the pictures to download
+        :param <seed>: <integer> ; seed of the shuffle (None for a different order on each run)
+        """
+        self.folder = folder
+        self.formats = tuple(extension.lower() for extension in formats)
+        self.seed = seed
+        self.queue_path = os.path.join(folder, QUEUE_NAME)
+        self.progress_path = os.path.join(folder, PROGRESS_NAME)
+
+    def present_ids(self):
+        """
+        Returns the set of the ids of the pictures already present in the query folder, from one directory listing.
+        """
+        present = set()
+        for fname in os.listdir(self.folder):
+            stem, _, extension = fname.partition(".")
+            if stem.isdigit() and extension.lower() in self.formats: present.add(int(stem))
+        return present
+
+    def eligible(self, item):
+        """
+        Checks whether the picture of an (id, url) item has a downloaded format.
+        ---
+        :param <item>: <tuple> ; (id, url) item
+        """
+        return url_extension(item[1]) in self.formats
+
+    def fingerprint(self, items, nb_of_requests):
+        """
+        Returns a digest identifying a plan, so that a saved queue is only resumed by the same request.
+        ---
+        :param <items>: <list> ; eligible (id, url) items
+        :param <nb_of_requests>: <integer> ; number of pictures requested
+        """
+        digest = hashlib.sha1(f"{nb_of_requests}|{self.seed}|{','.join(self.formats)}".encode("utf-8"))
+        for image_id, url in items: digest.update(f"|{image_id}:{url}".encode("utf-8"))
+        return digest.hexdigest()
+
+    def order(self, items, nb_of_requests):
+        """
+        Returns <nb_of_requests> items picked at random (all of them, shuffled, if there are fewer),
+        in O(n) and without modifying <items>.
+        ---
+        :param <items>: <list> ; eligible (id, url) items
+        :param <nb_of_requests>: <integer> ; number of items to pick
+        """
+        generator = random.Random(self.seed)
+        if nb_of_requests < len(items): return generator.sample(items, nb_of_requests)
+        picked = list(items)
+        generator.shuffle(picked)
+        return picked
+
+    def plan(self, id_list, nb_of_requests = None):
+        """
+        Returns the work queue of a list of (id, url) items: eligible items, picked at random,
+        minus the pictures present in the folder and the downloads completed by an interrupted run.
+        ---
+        :param <id_list>: <list> ; (id, url) items (see id_filter())
+        :param <nb_of_requests>: <integer> ; number of pictures to pick (None for all of them)
+        """
+        items = [(item[0], item[1]) for item in id_list if self.eligible(item)]
+        METRICS.increment("planner_skipped_format_total", len(id_list) - len(items))
+        if nb_of_requests is None: nb_of_requests = len(items)
+        fingerprint = self.fingerprint(items, nb_of_requests)
+        queue = self.load_queue(fingerprint)
+        if queue is None:
+            present = self.present_ids()
+            picked = self.order(items, nb_of_requests)
+            queue = [item for item in picked if item[0] not in present]
+            METRICS.increment("planner_skipped_present_total", len(picked) - len(queue))
+            write_atomic(self.queue_path, json.dumps({"fingerprint": fingerprint, "pending": queue}))
+            if os.path.exists(self.progress_path): os.remove(self.progress_path)
+        log_event("planner.queue", f"{len(queue)} pictures queued for download out of {len(id_list)} ids.",
+                  queued = len(queue), ids = len(id_list), eligible = len(items))
+        return queue
+
+    def load_queue(self, fingerprint):
+        """
+        Returns the pending items of the saved queue if it was planned by the same request, else None.
+        ---
+        :param <fingerprint>: <str> ; digest of the request (see fingerprint())
+        """
+        if not os.path.exists(self.queue_path): return None
+        with open(self.queue_path, "r") as file: saved = json.load(file)
+        if saved["fingerprint"] != fingerprint: return None
+        done = set()
+        if os.path.exists(self.progress_path):
+            with open(self.progress_path, "r") as file:
+                done = {int(line) for line in file if line.strip().isdigit()}
+        queue = [tuple(item) for item in saved["pending"] if item[0] not in done]
+        log_event("planner.resume", f"Resuming an interrupted download: {len(queue)} pictures left.", pending = len(queue))
+        return queue
+
+    def done(self, image_id):
+        """
+        Records the completion of a queued picture (downloaded, linked or already stored).
+        ---
+        :param <image_id>: <integer> ; id of the picture
+        """
+        with open(self.progress_path, "a") as file: file.write(f"{image_id}\n")
+
+    def finish(self, nb_failed):
+        """
+        Deletes the saved queue once every queued picture was completed.
+        ---
+        :param <nb_failed>: <integer> ; number of failed downloads (the queue is kept for a next run if any)
+        """
+        if nb_failed > 0: return
+        for path in (self.queue_path, self.progress_path):
+            if os.path.exists(path): os.remove(path)
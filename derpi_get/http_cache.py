@@ -0,0 +1,277 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+import requests
+from .metrics import METRICS
+
+log = logging.getLogger()
+
+class cached_response:
+    """
+    Response served from the HTTP cache. Mimics the parts of requests.Response used by derpi_get.
+    """
+    def __init__(self, content, headers):
+        """
+        Initializes the cached response.
+        ---
+        :param <content>: <bytes> ; body of the response
+        :param <headers>: <dict> ; headers stored with the response
+        """
+        self.status_code = 200
+        self.content = content
+        self.headers = headers
+        self.from_cache = True
+
+    def json(self):
+        """
+        Returns the body of the response decoded from JSON.
+        """
+        return json.loads(self.content)
+
+    def raise_for_status(self):
+        """
+        Does nothing: only successful responses are stored in the cache.
+        """
+        pass
+
+def parse_cache_control(headers):
+    """
+    Returns the number of seconds a response stays fresh (0 if it must be revalidated),
+    or None if it must not be stored at all.
+    ---
+    :param <headers>: <dict> ; response headers
+    """
+    directives = {}
+    for directive in headers.get("Cache-Control", "").split(","):
+        name, _, value = directive.strip().partition("=")
+        if name != "": directives[name.lower()] = value.strip('"')
+    if "no-store" in directives: return None
+    if "no-cache" in directives: return 0
+    try: return max(0, int(directives.get("max-age", 0)))
+    except ValueError: return 0
+
+class http_cache:
+    """
+    On-disk HTTP cache shared by the crawl, repair, refresh and download paths.
+    Responses are stored with their ETag/Last-Modified validators and served without any request
+    while their Cache-Control max-age holds; stale entries are revalidated with If-None-Match and
+    If-Modified-Since, so that an unchanged resource only costs a 304 round-trip.
+    Entries are evicted by least recent use once the cache exceeds its size cap.
+    """
+    def __init__(self, folder, max_size = 512 * 1024 ** 2, session = None):
+        """
+        Opens (or creates) the cache located in <folder>.
+        ---
+        :param <folder>: <str> ; folder where cached bodies and their metadata are stored
+        :param <max_size>: <integer> ; size in bytes above which least recently used entries are evicted (0 disables storage)
+        :param <session>: <requests.Session> ; session used to send requests (a new one if None)
+        """
+        self.folder = folder
+        self.max_size = max_size
+        self.session = session if session is not None else requests.Session()
+        self.lock = threading.Lock()
+        if not os.path.exists(folder): os.makedirs(folder)
+        # Rebuilds the LRU bookkeeping {key: [size, last use]} from the bodies' modification times
+        self.entries = {}
+        for fname in os.listdir(folder):
+            if not fname.endswith(".body"): continue
+            stat = os.stat(os.path.join(folder, fname))
+            self.entries[fname[:-5]] = [stat.st_size, stat.st_mtime]
+        self.total_size = sum(size for size, last_use in self.entries.values())
+
+    def key(self, url, params = None):
+        """
+        Returns the cache key of a url and its query parameters.
+        ---
+        :param <url>: <str> ; url of the resource
+        :param <params>: <dict> ; query parameters
+        """
+        full_url = requests.Request("GET", url, params = params).prepare().url
+        return hashlib.sha256(full_url.encode("utf-8")).hexdigest()
+
+    def paths(self, key):
+        """
+        Returns the paths of the body and of the metadata of an entry.
+        ---
+        :param <key>: <str> ; cache key
+        """
+        return os.path.join(self.folder, key + ".body"), os.path.join(self.folder, key + ".json")
+
+    def load(self, key):
+        """
+        Returns the metadata of an entry (None if the entry does not exist).
+        ---
+        :param <key>: <str> ; cache key
+        """
+        body_path, meta_path = self.paths(key)
+        if not (os.path.exists(body_path) and os.path.exists(meta_path)): return None
+        try:
+            with open(meta_path, "r") as file: return json.load(file)
+        except ValueError:
+            return None
+
+    def is_fresh(self, meta):
+        """
+        Checks whether an entry can be served without contacting the server.
+        ---
+        :param <meta>: <dict> ; metadata of the entry
+        """
+        return time.time() < meta["stored_at"] + meta["max_age"]
+
+    def validators(self, meta):
+        """
+        Returns the conditional request headers of an entry.
+        ---
+        :param <meta>: <dict> ; metadata of the entry (None for no entry)
+        """
+        headers = {}
+        if meta is None: return headers
+        if meta.get("etag"): headers["If-None-Match"] = meta["etag"]
+        if meta.get("last_modified"): headers["If-Modified-Since"] = meta["last_modified"]
+        return headers
+
+    def use(self, key):
+        """
+        Marks an entry as recently used.
+        ---
+        :param <key>: <str> ; cache key
+        """
+        now = time.time()
+        with self.lock:
+            if key in self.entries: self.entries[key][1] = now
+        try: os.utime(self.paths(key)[0], (now, now))
+        except OSError: pass
+
+    def revalidated(self, key, meta, response):
+        """
+        Refreshes the metadata of an entry after a 304 answer.
+        ---
+        :param <key>: <str> ; cache key
+        :param <meta>: <dict> ; metadata of the entry
+        :param <response>: <requests.Response> ; 304 response of the server
+        """
+        max_age = parse_cache_control(response.headers)
+        meta = dict(meta, stored_at = time.time(), max_age = max_age or 0)
+        meta["etag"] = response.headers.get("ETag", meta.get("etag"))
+        meta["last_modified"] = response.headers.get("Last-Modified", meta.get("last_modified"))
+        self.write_meta(key, meta)
+        self.use(key)
+        return meta
+
+    def write_meta(self, key, meta):
+        """
+        Atomically writes the metadata of an entry.
+        ---
+        :param <key>: <str> ; cache key
+        :param <meta>: <dict> ; metadata of the entry
+        """
+        meta_path = self.paths(key)[1]
+        temp_path = f"{meta_path}.{threading.get_ident()}.tmp"
+        with open(temp_path, "w") as file: json.dump(meta, file)
+        os.replace(temp_path, meta_path)
+
+    def store(self, key, url, headers, content = None, file_path = None):
+        """
+        Stores a 200 response if its headers allow it. The body is either given as bytes
+        or as a file that is hard-linked (or copied) into the cache.
+        ---
+        :param <key>: <str> ; cache key
+        :param <url>: <str> ; url of the resource
+        :param <headers>: <dict> ; response headers
+        :param <content>: <bytes> ; body of the response
+        :param <file_path>: <str> ; path of a file holding the body of the response
+        """
+        max_age = parse_cache_control(headers)
+        etag, last_modified = headers.get("ETag"), headers.get("Last-Modified")
+        if self.max_size == 0 or max_age is None or (max_age == 0 and etag is None and last_modified is None): return
+        body_path = self.paths(key)[0]
+        temp_path = f"{body_path}.{threading.get_ident()}.tmp"
+        if content is not None:
+            with open(temp_path, "wb") as file: file.write(content)
+        else:
+            try: os.link(file_path, temp_path)
+            except OSError: shutil.copyfile(file_path, temp_path)
+        os.replace(temp_path, body_path)
+        self.write_meta(key, {"url": url, "etag": etag, "last_modified": last_modified,
+                              "stored_at": time.time(), "max_age": max_age,
+                              "content_type": headers.get("Content-Type")})
+        size = os.path.getsize(body_path)
+        with self.lock:
+            previous = self.entries.get(key, [0, 0])[0]
+            self.entries[key] = [size, time.time()]
+            self.total_size += size - previous
+        self.evict()
+
+    def evict(self):
+        """
+        Deletes the least recently used entries until the cache fits in 90% of its size cap.
+        """
+        with self.lock:
+            if self.total_size <= self.max_size: return
+            victims = []
+            for key, (size, last_use) in sorted(self.entries.items(), key = lambda item: item[1][1]):
+                if self.total_size <= 0.9 * self.max_size: break
+                victims.append(key)
+                self.total_size -= size
+                del self.entries[key]
+        for key in victims:
+            for path in self.paths(key):
+                try: os.remove(path)
+                except OSError: pass
+
+    def read(self, key, meta):
+        """
+        Returns an entry as a cached_response.
+        ---
+        :param <key>: <str> ; cache key
+        :param <meta>: <dict> ; metadata of the entry
+        """
+        with open(self.paths(key)[0], "rb") as file: content = file.read()
+        self.use(key)
+        return cached_response(content, {"Content-Type": meta.get("content_type")})
+
+    def copy_to(self, key, path):
+        """
+        Hard-links (or copies) the body of an entry to <path>.
+        ---
+        :param <key>: <str> ; cache key
+        :param <path>: <str> ; destination path
+        """
+        temp_path = path + ".part"
+        if os.path.exists(temp_path): os.remove(temp_path)
+        try: os.link(self.paths(key)[0], temp_path)
+        except OSError: shutil.copyfile(self.paths(key)[0], temp_path)
+        os.replace(temp_path, path)
+        self.use(key)
+
+    def get(self, url, params = None, timeout = 60, before_request = None, after_response = None):
+        """
+        Sends a GET request through the cache and returns a requests.Response or a cached_response.
+        ---
+        :param <url>: <str> ; url of the resource
+        :param <params>: <dict> ; query parameters
+        :param <timeout>: <integer> ; timeout in seconds of the request
+        :param <before_request>: <function> ; called before a request actually goes to the server (e.g. a rate limiter)
+        :param <after_response>: <function> ; called with each response of the server (e.g. rate_controller.observe)
+        """
+        key = self.key(url, params)
+        meta = self.load(key)
+        if meta is not None and self.is_fresh(meta):
+            METRICS.increment("http_requests_total", labels = {"outcome": "hit"})
+            return self.read(key, meta)
+        if before_request is not None: before_request()
+        started = time.perf_counter()
+        response = self.session.get(url, params = params, headers = self.validators(meta), timeout = timeout)
+        METRICS.observe("http_request_seconds", time.perf_counter() - started)
+        if after_response is not None: after_response(response)
+        if response.status_code == 304 and meta is not None:
+            METRICS.increment("http_requests_total", labels = {"outcome": "revalidated"})
+            return self.read(key, self.revalidated(key, meta, response))
+        METRICS.increment("http_requests_total", labels = {"outcome": "miss", "status": str(response.status_code)})
+        METRICS.increment("http_response_bytes_total", len(response.content))
+        if response.status_code == 200: self.store(key, url, response.headers, content = response.content)
+        return response
@@ -0,0 +1,77 @@
+import logging
+import os
+import shutil
+
+log = logging.getLogger()
+
+class image_store:
+    """
+    Content-addressed store of downloaded pictures. Each picture is kept once under
+    'objects/<hash[:2]>/<hash>_<representation>.<ext>' (keyed by derpibooru's sha512_hash, or by id
+    for metadata crawled without hashes) and exposed in each query folder through a hard link
+    (or a copy where links are not supported), so that overlapping tag queries share both
+    bandwidth and disk space.
+    """
+    def __init__(self, folder):
+        """
+        Opens (or creates) the object store located in <folder>.
+        The hash index is built from a single listing of the store.
+        ---
+        :param <folder>: <str> ; folder where the objects are stored
+        """
+        self.folder = folder
+        if not os.path.exists(folder): os.makedirs(folder)
+        self.objects = set()
+        for prefix in os.listdir(folder):
+            prefix_path = os.path.join(folder, prefix)
+            if not os.path.isdir(prefix_path): continue
+            self.objects.update(fname for fname in os.listdir(prefix_path) if not fname.endswith(".part"))
+
+    def object_name(self, image_id, url, sha512_hash = None):
+        """
+        Returns the name of the object holding a picture representation.
+        ---
+        :param <image_id>: <integer> ; id of the picture
+        :param <url>: <str> ; url of the representation (e.g. '.../medium.png')
+        :param <sha512_hash>: <str> ; hash of the picture (None if unknown)
+        """
+        representation, extension = os.path.splitext(url.split("/")[-1])
+        digest = sha512_hash if sha512_hash is not None else f"id{image_id}"
+        return f"{digest}_{representation}{extension}"
+
+    def object_path(self, name):
+        """
+        Returns the path of an object, creating its prefix folder if needed.
+        ---
+        :param <name>: <str> ; name of the object
+        """
+        prefix_path = os.path.join(self.folder, name[:2])
+        if not os.path.exists(prefix_path): os.makedirs(prefix_path, exist_ok = True)
+        return os.path.join(prefix_path, name)
+
+    def contains(self, name):
+        """
+        Checks whether an object was already downloaded.
+        ---
+        :param <name>: <str> ; name of the object
+        """
+        return name in self.objects
+
+    def add(self, name):
+        """
+        Records a newly downloaded object.
+        ---
+        :param <name>: <str> ; name of the object
+        """
+        self.objects.add(name)
+
+    def link(self, name, view_path):
+        """
+        Exposes an object in a query folder.
+        ---
+        :param <name>: <str> ; name of the object
+        :param <view_path>: <str> ; path of the picture in the query folder
+        """
+        if os.path.exists(view_path): return
+        try: os.link(self.object_path(name), view_path)
+        except OSError: shutil.copyfile(self.object_path(name), view_path)
@@ -0,0 +1,399 @@
+import json
+import logging
+import os
+import sys
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+log = logging.getLogger()
+
+# Upper bounds in seconds of the histogram buckets (the last bucket, +Inf, is implicit)
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+class metrics_registry:
+    """
+    Thread-safe registry of the counters and histograms measured across derpi_get, and source of trace spans.
+    Metrics are identified by a name and a dictionary of labels, e.g. ("http_requests_total", {"outcome": "miss"}).
+    Exporters (see prometheus_exporter and jsonl_exporter) read snapshots of the registry on flush() and,
+    while tracing is enabled, receive every completed span. derpi_get records into the module-level METRICS.
+    """
+    def __init__(self, prefix = "derpi_get_", buckets = DEFAULT_BUCKETS):
+        """
+        Initializes an empty registry.
+        ---
+        :param <prefix>: <str> ; prefix of the exported metric names
+        :param <buckets>: <tuple> ; upper bounds in seconds of the histogram buckets
+        """
+        self.prefix = prefix
+        self.buckets = tuple(buckets)
+        self.counters = {}
+        self.histograms = {}
+        self.exporters = []
+        self.tracing = False
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def key(self, name, labels):
+        """
+        Returns the key of a counter or histogram in the registry: its name and its sorted labels.
+        ---
+        :param <name>: <str> ; name of the counter or histogram
+        :param <labels>: <dict> ; labels (None for no labels)
+        """
+        return (name, tuple(sorted((labels or {}).items())))
+
+    def increment(self, name, value = 1, labels = None):
+        """
+        Adds <value> to a counter.
+        ---
+        :param <name>: <str> ; name of the counter
+        :param <value>: <float> ; amount added
+        :param <labels>: <dict> ; labels of the counter
+        """
+        key = self.key(name, labels)
+        with self.lock: self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, labels = None):
+        """
+        Records a value (usually a duration in seconds) in a histogram.
+        ---
+        :param <name>: <str> ; name of the histogram
+        :param <value>: <float> ; observed value
+        :param <labels>: <dict> ; labels of the histogram
+        """
+        key = self.key(name, labels)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = {"buckets": [0] * (len(self.buckets) + 1), "sum": 0.0, "count": 0}
+            position = 0
+            while position < len(self.buckets) and value > self.buckets[position]: position += 1
+            histogram["buckets"][position] += 1
+            histogram["sum"] += value
+            histogram["count"] += 1
+
+    @contextmanager
+    def timer(self, name, labels = None):
+        """
+        Context manager recording the duration of its block in a histogram.
+        ---
+        :param <name>: <str> ; name of the histogram
+        :param <labels>: <dict> ; labels of the histogram
+        """
+        started = time.perf_counter()
+        try: yield
+        finally: self.observe(name, time.perf_counter() - started, labels)
+
+    @contextmanager
+    def span(self, name, **attributes):
+        """
+        Context manager timing one phase of a run (crawl, repair, a page request...).
+        The duration is recorded in the 'phase_seconds' histogram; while tracing is enabled, the span
+        (with its parent, i.e. the enclosing span of the same thread) is also handed to the exporters.
+        Attributes can be added within the block through the yielded dictionary.
+        ---
+        :param <name>: <str> ; name of the phase
+        :param <attributes>: <dict> ; attributes of the span
+        """
+        stack = self.local.__dict__.setdefault("spans", [])
+        parent = stack[-1] if stack != [] else None
+        span = {"type": "span", "name": name, "trace_id": parent["trace_id"] if parent else uuid.uuid4().hex,
+                "span_id": uuid.uuid4().hex[:16], "parent_id": parent["span_id"] if parent else None,
+                "thread": threading.current_thread().name, "start": time.time(), "attributes": attributes}
+        stack.append(span)
+        started = time.perf_counter()
+        try:
+            yield span["attributes"]
+        except BaseException as error:
+            span["error"] = repr(error)
+            raise
+        finally:
+            span["duration"] = time.perf_counter() - started
+            stack.pop()
+            self.observe("phase_seconds", span["duration"], {"phase": name})
+            if self.tracing:
+                for exporter in list(self.exporters):
+                    if hasattr(exporter, "export_span"): exporter.export_span(span)
+
+    def current_span(self):
+        """
+        Returns the innermost open span of the calling thread (None outside of any span).
+        """
+        stack = self.local.__dict__.get("spans", [])
+        return stack[-1] if stack != [] else None
+
+    @contextmanager
+    def attach(self, span):
+        """
+        Context manager making <span> (e.g. opened by another thread) the parent of the spans opened in its block.
+        ---
+        :param <span>: <dict> ; span returned by current_span() (None leaves the spans of the block unparented)
+        """
+        stack = self.local.__dict__.setdefault("spans", [])
+        if span is None:
+            yield
+            return
+        stack.append(span)
+        try: yield
+        finally: stack.remove(span)
+
+    def snapshot(self):
+        """
+        Returns a copy of the current values: {"counters": [...], "histograms": [...]}.
+        Histogram buckets are cumulative, as in the Prometheus exposition format.
+        """
+        with self.lock:
+            counters = [{"name": self.prefix + name, "labels": dict(labels), "value": value}
+                        for (name, labels), value in sorted(self.counters.items())]
+            histograms = []
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                cumulative, buckets = 0, {}
+                for bound, count in zip(list(self.buckets) + ["+Inf"], histogram["buckets"]):
+                    cumulative += count
+                    buckets[str(bound)] = cumulative
+                histograms.append({"name": self.prefix + name, "labels": dict(labels), "buckets": buckets,
+                                   "sum": histogram["sum"], "count": histogram["count"]})
+        return {"counters": counters, "histograms": histograms}
+
+    def add_exporter(self, exporter):
+        """
+        Registers an exporter, which receives the snapshots of flush() (export_metrics) and the spans (export_span).
+        ---
+        :param <exporter>: <object> ; exporter (see jsonl_exporter)
+        """
+        with self.lock:
+            if exporter not in self.exporters: self.exporters.append(exporter)
+        return exporter
+
+    def remove_exporter(self, exporter):
+        """
+        Unregisters an exporter (exporters that were not registered are ignored).
+        ---
+        :param <exporter>: <object> ; exporter (see jsonl_exporter)
+        """
+        with self.lock:
+            if exporter in self.exporters: self.exporters.remove(exporter)
+
+    def flush(self):
+        """
+        Hands a snapshot of the registry to every exporter that writes snapshots.
+        """
+        exporters = [exporter for exporter in self.exporters if hasattr(exporter, "export_metrics")]
+        if exporters == []: return
+        snapshot = self.snapshot()
+        for exporter in exporters: exporter.export_metrics(snapshot)
+
+    def reset(self):
+        """
+        Empties the counters and histograms.
+        """
+        with self.lock:
+            self.counters = {}
+            self.histograms = {}
+
+METRICS = metrics_registry()
+
+def escape_label(value):
+    """
+    Escapes a label value for the Prometheus text format (backslashes, double quotes and line feeds).
+    ---
+    :param <value>: <object> ; value of the label
+    """
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+def format_labels(labels, extra = None):
+    """
+    Formats labels as a Prometheus label set ('{name="value",...}', empty if there are no labels).
+    ---
+    :param <labels>: <dict> ; labels of the counter or histogram
+    :param <extra>: <dict> ; labels appended after them (e.g. the 'le' bound of a bucket)
+    """
+    pairs = list(labels.items()) + list((extra or {}).items())
+    if pairs == []: return ""
+    return "{" + ",".join(f"{name}=\"{escape_label(value)}\"" for name, value in pairs) + "}"
+
+class prometheus_exporter:
+    """
+    Exposes the registry in the Prometheus text format, rendered on demand or served on '/metrics'.
+    """
+    def __init__(self, registry = METRICS):
+        """
+        Initializes the exporter.
+        ---
+        :param <registry>: <metrics_registry> ; registry to expose
+        """
+        self.registry = registry
+        self.server = None
+
+    def render(self):
+        """
+        Returns the registry in the Prometheus text exposition format.
+        """
+        snapshot = self.registry.snapshot()
+        lines, typed = [], set()
+        for counter in snapshot["counters"]:
+            if counter["name"] not in typed:
+                lines.append(f"# TYPE {counter['name']} counter")
+                typed.add(counter["name"])
+            lines.append(f"{counter['name']}{format_labels(counter['labels'])} {counter['value']}")
+        for histogram in snapshot["histograms"]:
+            if histogram["name"] not in typed:
+                lines.append(f"# TYPE {histogram['name']} histogram")
+                typed.add(histogram["name"])
+            for bound, count in histogram["buckets"].items():
+                lines.append(f"{histogram['name']}_bucket{format_labels(histogram['labels'], {'le': bound})} {count}")
+            lines.append(f"{histogram['name']}_sum{format_labels(histogram['labels'])} {histogram['sum']}")
+            lines.append(f"{histogram['name']}_count{format_labels(histogram['labels'])} {histogram['count']}")
+        return "\n".join(lines) + "\n"
+
+    def serve(self, port = 9464, host = "127.0.0.1"):
+        """
+        Serves the rendered registry on 'http://<host>:<port>/metrics' from a background thread.
+        ---
+        :param <port>: <integer> ; port to listen on
+        :param <host>: <str> ; address to listen on
+        """
+        exporter = self
+
+        class handler(BaseHTTPRequestHandler):
+            """
+            Answers '/metrics' with the rendered registry and any other path with a 404.
+            """
+            def log_message(self, *args):
+                """
+                Silences the access log of the server.
+                """
+                pass
+
+            def do_GET(self):
+                """
+                Sends the registry in the Prometheus text format.
+                """
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_response(404)
+                    self.end_headers()
+                    return
+                body = exporter.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        self.server = ThreadingHTTPServer((host, port), handler)
+        self.server.daemon_threads = True
+        threading.Thread(target = self.server.serve_forever, name = "derpi_get-metrics", daemon = True).start()
+        return self.server
+
+    def close(self):
+        """
+        Stops serving the registry.
+        """
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+class jsonl_exporter:
+    """
+    Appends the snapshots of the registry (on each flush()) and, optionally, every trace span to a JSON Lines file.
+    Each line holds a "type" ("metrics" or "span") and a "time" (UNIX timestamp).
+    """
+    def __init__(self, path, registry = METRICS, spans = True):
+        """
+        Initializes the exporter and registers it on the registry.
+        ---
+        :param <path>: <str> ; path of the JSON Lines file
+        :param <registry>: <metrics_registry> ; registry to export
+        :param <spans>: <boolean> ; toggles tracing, i.e. writing every completed span
+        """
+        self.path = path
+        self.registry = registry
+        self.lock = threading.Lock()
+        folder = os.path.dirname(os.path.abspath(path))
+        if not os.path.exists(folder): os.makedirs(folder)
+        registry.add_exporter(self)
+        if spans: registry.tracing = True
+
+    def write(self, item):
+        """
+        Appends one item to the file as a JSON line.
+        ---
+        :param <item>: <dict> ; span or snapshot
+        """
+        line = json.dumps(item, default = str) + "\n"
+        with self.lock:
+            with open(self.path, "a", encoding = "utf-8") as file: file.write(line)
+
+    def export_span(self, span):
+        """
+        Writes a completed span, stamped with its start time.
+        ---
+        :param <span>: <dict> ; completed span (see metrics_registry.span())
+        """
+        self.write(dict(span, time = span["start"]))
+
+    def export_metrics(self, snapshot):
+        """
+        Writes a snapshot of the registry, stamped with the current time.
+        ---
+        :param <snapshot>: <dict> ; snapshot of the registry (see metrics_registry.snapshot())
+        """
+        self.write({"type": "metrics", "time": time.time(), **snapshot})
+
+    def close(self):
+        """
+        Writes a last snapshot and unregisters the exporter.
+        """
+        self.export_metrics(self.registry.snapshot())
+        self.registry.remove_exporter(self)
+
+def log_event(event, message, level = logging.INFO, **fields):
+    """
+    Logs a progress message with the name of the event and its fields attached to the record
+    (record.event and record.fields), so that structured_formatter can emit them as JSON.
+    ---
+    :param <event>: <str> ; name of the event (e.g. 'crawl.page')
+    :param <message>: <str> ; human readable message
+    :param <level>: <integer> ; logging level
+    :param <fields>: <dict> ; values describing the event
+    """
+    log.log(level, message, extra = {"event": event, "fields": fields})
+
+class structured_formatter(logging.Formatter):
+    """
+    Formats each log record as one JSON object: time, level, event, message and the fields of the event.
+    """
+    def format(self, record):
+        """
+        Returns a log record as a JSON object, with the traceback of its exception if it has one.
+        ---
+        :param <record>: <logging.LogRecord> ; log record
+        """
+        item = {"time": record.created, "level": record.levelname, "event": getattr(record, "event", None),
+                "message": record.getMessage()}
+        item.update(getattr(record, "fields", {}))
+        if record.exc_info: item["exception"] = self.formatException(record.exc_info)
+        return json.dumps(item, default = str)
+
+def configure_logging(level = logging.INFO, structured = False, stream = None):
+    """
+    Sends the progress messages of derpi_get to <stream>, as plain messages or as JSON lines.
+    Applications that configure logging themselves do not need to call it.
+    ---
+    :param <level>: <integer> ; lowest logging level shown
+    :param <structured>: <boolean> ; toggles JSON lines (see structured_formatter) instead of plain messages
+    :param <stream>: <file> ; stream the messages are written to (defaults to sys.stdout)
+    """
+    handler = logging.StreamHandler(stream if stream is not None else sys.stdout)
+    handler.setFormatter(structured_formatter() if structured else logging.Formatter("%(message)s"))
+    root = logging.getLogger()
+    for existing in [existing for existing in root.handlers if getattr(existing, "derpi_get", False)]:
+        root.removeHandler(existing)
+    handler.derpi_get = True
+    root.addHandler(handler)
+    root.setLevel(level)
+    return handler
@@ -0,0 +1,260 @@
+import re
+from .records import TAGS, compact_record
+
+FIELDS = {"score": float, "upvotes": float, "downvotes": float, "faves": float, "aspect_ratio": float,
+          "created_at": str, "updated_at": str}
+COMPARATORS = {"gt": lambda value, bound: value > bound,
+               "gte": lambda value, bound: value >= bound,
+               "lt": lambda value, bound: value < bound,
+               "lte": lambda value, bound: value <= bound,
+               "eq": lambda value, bound: value == bound}
+KEYWORD_PATTERN = re.compile(r"(AND|OR|NOT)(?=[\s()]|$)")
+FIELD_PATTERN = re.compile(r"^(\w+?)(?:\.(gt|gte|lt|lte|eq))?:(.+)$")
+
+class QuerySyntaxError(ValueError):
+    """Raised when a tag query expression cannot be parsed"""
+    pass
+
+def tokenize(expression):
+    """
+    Splits a query expression into (kind, value) tokens. Operators are AND (also && or ,),
+    OR (also ||) and NOT (also ! or - in front of a term); tags holding operator characters can be quoted.
+    ---
+    :param <expression>: <str> ; query expression, e.g. '(a OR b) AND NOT c AND score.gt:100'
+    """
+    tokens, position, term = [], 0, ""
+
+    def close_term():
+        """
+        Appends the term read so far (stripped) as a TERM token, if it is not blank, and returns the new empty term.
+        """
+        if term.strip() != "": tokens.append(("TERM", term.strip()))
+        return ""
+
+    while position < len(expression):
+        char, rest = expression[position], expression[position:]
+        keyword = KEYWORD_PATTERN.match(rest) if (term == "" or term[-1].isspace()) else None
+        if char in "()":
+            term = close_term()
+            tokens.append((char, char))
+            position += 1
+        elif rest.startswith("&&") or rest.startswith("||") or char == ",":
+            term = close_term()
+            tokens.append(("OR" if char == "|" else "AND", rest[:1 if char == "," else 2]))
+            position += 1 if char == "," else 2
+        elif keyword is not None:
+            term = close_term()
+            tokens.append((keyword.group(1), keyword.group(1)))
+            position += len(keyword.group(1))
+        elif char in "!-" and term.strip() == "":
+            tokens.append(("NOT", char))
+            position += 1
+        elif char == '"' and term.strip() == "":
+            closing = expression.find('"', position + 1)
+            if closing == -1: raise QuerySyntaxError(f"Unterminated quote in the query '{expression}'.")
+            tokens.append(("TAG", expression[position + 1:closing].strip()))
+            position = closing + 1
+        else:
+            term += char
+            position += 1
+    close_term()
+    return tokens
+
+class parser:
+    """
+    Recursive descent parser of the query language:
+    expression := conjunction (OR conjunction)* ; conjunction := unary (AND unary)* ;
+    unary := NOT unary | '(' expression ')' | term.
+    Parsed nodes are tuples: ("or", [nodes]), ("and", [nodes]), ("not", node), ("tag", name)
+    and ("field", name, comparator, bound).
+    """
+    def __init__(self, tokens):
+        """
+        Initializes the parser.
+        ---
+        :param <tokens>: <list> ; tokens produced by tokenize()
+        """
+        self.tokens = tokens
+        self.position = 0
+
+    def peek(self):
+        """
+        Returns the kind of the next token (None at the end of the query).
+        """
+        return self.tokens[self.position][0] if self.position < len(self.tokens) else None
+
+    def take(self, kind):
+        """
+        Consumes the next token and returns its text. Raises QuerySyntaxError if it is not of the expected kind.
+        ---
+        :param <kind>: <str> ; expected kind of token ("AND", "OR", "NOT", "(", ")", "TAG" or "TERM")
+        """
+        if self.peek() != kind: raise QuerySyntaxError(f"Expected {kind} at token {self.position} of the query.")
+        self.position += 1
+        return self.tokens[self.position - 1][1]
+
+    def parse(self):
+        """
+        Parses the whole query and returns its tree. Raises QuerySyntaxError on empty queries and trailing tokens.
+        """
+        if self.tokens == []: raise QuerySyntaxError("The query is empty.")
+        node = self.expression()
+        if self.peek() is not None: raise QuerySyntaxError(f"Unexpected token {self.tokens[self.position][1]!r}.")
+        return node
+
+    def expression(self):
+        """
+        Parses conjunctions joined by OR.
+        """
+        nodes = [self.conjunction()]
+        while self.peek() == "OR":
+            self.take("OR")
+            nodes.append(self.conjunction())
+        return nodes[0] if len(nodes) == 1 else ("or", nodes)
+
+    def conjunction(self):
+        """
+        Parses unary terms joined by AND.
+        """
+        nodes = [self.unary()]
+        while self.peek() == "AND":
+            self.take("AND")
+            nodes.append(self.unary())
+        return nodes[0] if len(nodes) == 1 else ("and", nodes)
+
+    def unary(self):
+        """
+        Parses a negation, a parenthesized expression, a quoted tag or a term.
+        """
+        if self.peek() == "NOT":
+            self.take("NOT")
+            return ("not", self.unary())
+        if self.peek() == "(":
+            self.take("(")
+            node = self.expression()
+            self.take(")")
+            return node
+        if self.peek() == "TAG": return ("tag", self.take("TAG"))
+        return self.term(self.take("TERM"))
+
+    def term(self, text):
+        """
+        Turns an unquoted term into a field comparison (e.g. 'score.gte:100') or, failing that, into a tag.
+        ---
+        :param <text>: <str> ; text of the term
+        """
+        match = FIELD_PATTERN.match(text)
+        if match is None or match.group(1) not in FIELDS: return ("tag", text)
+        name, comparator, bound = match.group(1), match.group(2) or "eq", match.group(3).strip()
+        try: bound = FIELDS[name](bound)
+        except ValueError: raise QuerySyntaxError(f"The value {bound!r} of the field {name} is not a number.")
+        return ("field", name, comparator, bound)
+
+class compiled_query:
+    """
+    Tag query compiled once into a matcher. Sibling tag tests are merged into frozensets so that
+    evaluating a record costs a few set operations: 'a AND b AND NOT c' becomes
+    {a, b} <= tags and tags.isdisjoint({c}); 'a OR b' becomes not tags.isdisjoint({a, b}).
+    """
+    def __init__(self, expression, tree = None):
+        """
+        Parses and compiles a query expression.
+        ---
+        :param <expression>: <str> ; query expression, e.g. '(a OR b) AND NOT c AND score.gt:100'
+        :param <tree>: <tuple> ; already parsed query (the expression is then only descriptive)
+        """
+        self.expression = expression
+        self.tree = tree if tree is not None else parser(tokenize(expression)).parse()
+        self.tag_only = self.is_tag_only(self.tree)
+        self.matcher = self.compile(self.tree)
+        # Same matcher on interned tag ids, for compact records
+        self.compact_matcher = self.compile(self.tree, TAGS.intern)
+
+    def is_tag_only(self, node):
+        """
+        Checks whether a node only tests tags (and can therefore be answered from a tag index).
+        ---
+        :param <node>: <tuple> ; parsed node
+        """
+        if node[0] == "tag": return True
+        if node[0] == "field": return False
+        if node[0] == "not": return self.is_tag_only(node[1])
+        return all(self.is_tag_only(child) for child in node[1])
+
+    def compile(self, node, tag_key = str):
+        """
+        Compiles a parsed node into a function (record tags frozenset, record) -> boolean.
+        ---
+        :param <node>: <tuple> ; parsed node
+        :param <tag_key>: <function> ; maps a tag to the values held by the tags frozenset (e.g. TAGS.intern)
+        """
+        kind = node[0]
+        if kind == "tag":
+            tag = tag_key(node[1])
+            return lambda tags, record: tag in tags
+        if kind == "field":
+            name, compare, bound = node[1], COMPARATORS[node[2]], node[3]
+            return lambda tags, record: record.get(name) is not None and compare(record[name], bound)
+        if kind == "not":
+            inner = self.compile(node[1], tag_key)
+            return lambda tags, record: not inner(tags, record)
+        children = node[1]
+        tag_children = frozenset(tag_key(child[1]) for child in children if child[0] == "tag")
+        negated_tags = frozenset(tag_key(child[1][1]) for child in children if child[0] == "not" and child[1][0] == "tag")
+        others = [self.compile(child, tag_key) for child in children if child[0] != "tag"
+                  and not (kind == "and" and child[0] == "not" and child[1][0] == "tag")]
+        if kind == "and":
+            def match_all(tags, record):
+                """
+                Checks that a record carries every tag child, no negated tag child, and matches the other children.
+                ---
+                :param <tags>: <frozenset> ; tags of the record
+                :param <record>: <dict> ; metadata record
+                """
+                return tag_children <= tags and tags.isdisjoint(negated_tags) and \
+                    all(other(tags, record) for other in others)
+            return match_all
+        def match_any(tags, record):
+            """
+            Checks that a record carries one of the tag children or matches one of the other children.
+            ---
+            :param <tags>: <frozenset> ; tags of the record
+            :param <record>: <dict> ; metadata record
+            """
+            return (not tags.isdisjoint(tag_children)) or any(other(tags, record) for other in others)
+        return match_any
+
+    def match(self, record):
+        """
+        Evaluates the query on a metadata record.
+        ---
+        :param <record>: <dict> or <compact_record> ; metadata record
+        """
+        if isinstance(record, compact_record): return self.compact_matcher(record.tag_set(), record)
+        tags = frozenset(record["tags"].split(", ")) if record.get("tags") else frozenset()
+        return self.matcher(tags, record)
+
+def tag_list_query(tags_keep, tags_remove, at_least_one):
+    """
+    Compiles the tag lists used by id_filter() into a query: at least one (or all) of <tags_keep>
+    and none of <tags_remove>. As with id_filter(), 'at least one' of no tag matches nothing.
+    ---
+    :param <tags_keep>: <list> ; tags that pictures must carry
+    :param <tags_remove>: <list> ; tags that pictures must not carry
+    :param <at_least_one>: <boolean> ; toggles 'at least one tag' instead of 'all tags'
+    """
+    keep = [("tag", tag) for tag in tags_keep]
+    remove = [("not", ("tag", tag)) for tag in tags_remove]
+    tree = ("and", [("or", keep)] + remove) if at_least_one else ("and", keep + remove)
+    description = f" {'OR' if at_least_one else 'AND'} ".join(f'"{tag}"' for tag in tags_keep)
+    if tags_remove != []: description += "".join(f' AND NOT "{tag}"' for tag in tags_remove)
+    return compiled_query(description, tree)
+
+def compile_query(expression):
+    """
+    Compiles a query expression (see compiled_query).
+    ---
+    :param <expression>: <str> ; query expression
+    """
+    assert(isinstance(expression, str)), "A query expression must be a string."
+    return compiled_query(expression)
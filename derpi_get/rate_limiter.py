@@ -0,0 +1,171 @@
+import logging
+import random
+import threading
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from .metrics import METRICS, log_event
+
+log = logging.getLogger()
+
+class token_bucket:
+    """
+    Thread-safe token bucket shared by every worker sending requests to derpibooru.
+    Tokens are refilled at <rate> per second up to <burst>; each request consumes one token.
+    """
+    def __init__(self, rate = 5.0, burst = 1):
+        """
+        Initializes the token bucket.
+        ---
+        :param <rate>: <float> ; number of requests allowed per second
+        :param <burst>: <integer> ; number of requests that can be sent back to back
+        """
+        assert(rate > 0 and burst >= 1), "The rate and burst of a token_bucket must be positive."
+        self.rate = float(rate)
+        self.burst = burst
+        self.tokens = float(burst)
+        self.timestamp = time.monotonic()
+        self.lock = threading.Lock()
+
+    def refill(self):
+        """
+        Adds the tokens earned since the last refill (the lock must be held).
+        """
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.timestamp) * self.rate)
+        self.timestamp = now
+
+    def take(self):
+        """
+        Consumes a token and returns 0 if one is available, else returns the number of seconds to wait.
+        """
+        with self.lock:
+            self.refill()
+            if self.tokens >= 1.0:
+                self.tokens -= 1.0
+                return 0.0
+            return (1.0 - self.tokens) / self.rate
+
+    def acquire(self):
+        """
+        Blocks until a token is available, then consumes it.
+        """
+        wait = self.take()
+        while wait > 0:
+            METRICS.increment("rate_limit_wait_seconds_total", wait)
+            time.sleep(wait)
+            wait = self.take()
+
+def parse_retry_after(value):
+    """
+    Returns the number of seconds requested by a Retry-After header (delay in seconds or HTTP date), None if unreadable.
+    ---
+    :param <value>: <str> ; value of the header
+    """
+    if value is None: return None
+    try: return max(0.0, float(value))
+    except ValueError: pass
+    try: return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError): return None
+
+class rate_controller(token_bucket):
+    """
+    Adaptive token bucket shared by every requester of a crawl, repair or download run.
+    The rate is paced by the server's answers (AIMD): each success adds <increase> requests per second
+    up to the configured ceiling, each 429/503 answer multiplies the rate by <decrease> down to <min_rate>.
+    Retry-After and rate limit headers (RateLimit-Remaining/RateLimit-Reset, with or without the X- prefix)
+    pause or slow down every requester. Failures back off exponentially with jitter, capped at <max_delay>,
+    and the back-off resets on the next success.
+    """
+    def __init__(self, rate = 5.0, min_rate = 0.2, increase = 0.1, decrease = 0.5,
+                 base_delay = 1.0, max_delay = 300.0, max_failures = 50):
+        """
+        Initializes the controller at its ceiling rate.
+        ---
+        :param <rate>: <float> ; ceiling of the number of requests per second
+        :param <min_rate>: <float> ; floor of the number of requests per second
+        :param <increase>: <float> ; requests per second added after each success
+        :param <decrease>: <float> ; factor applied to the rate after each throttling answer
+        :param <base_delay>: <float> ; back-off delay in seconds after a first failure
+        :param <max_delay>: <float> ; cap in seconds of the back-off delay
+        :param <max_failures>: <integer> ; number of consecutive failures after which back_off() gives up
+        """
+        assert(0 < min_rate <= rate), "The minimum rate of a rate_controller must be positive and below its rate."
+        assert(0 < decrease < 1), "The decrease factor of a rate_controller must be between 0 and 1."
+        super().__init__(rate)
+        self.ceiling = float(rate)
+        self.min_rate = float(min_rate)
+        self.increase = increase
+        self.decrease = decrease
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_failures = max_failures
+        self.failures = 0
+        self.paused_until = 0.0
+
+    def take(self):
+        """
+        Returns the number of seconds to wait, while a back-off pause lasts or no token is available,
+        else consumes a token and returns 0.
+        """
+        with self.lock:
+            pause = self.paused_until - time.monotonic()
+        if pause > 0: return pause
+        return token_bucket.take(self)
+
+    def pause(self, seconds):
+        """
+        Holds every requester for <seconds> (the lock must be held).
+        ---
+        :param <seconds>: <float> ; duration of the pause
+        """
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def observe(self, response):
+        """
+        Adapts the pace to a response of the server.
+        ---
+        :param <response>: <requests.Response> ; response (any object with status_code/status and headers)
+        """
+        status = getattr(response, "status_code", None) or getattr(response, "status", None)
+        headers = response.headers
+        with self.lock:
+            self.refill()
+            if status in (429, 503):
+                METRICS.increment("throttled_responses_total", labels = {"status": str(status)})
+                self.rate = max(self.min_rate, self.rate * self.decrease)
+                retry_after = parse_retry_after(headers.get("Retry-After"))
+                if retry_after is not None: self.pause(retry_after)
+            elif status is not None and status < 400:
+                self.failures = 0
+                self.rate = min(self.ceiling, self.rate + self.increase)
+            remaining = headers.get("RateLimit-Remaining", headers.get("X-RateLimit-Remaining"))
+            reset = headers.get("RateLimit-Reset", headers.get("X-RateLimit-Reset"))
+            try: remaining, reset = int(remaining), float(reset)
+            except (TypeError, ValueError): return
+            # Reset values larger than a year are epoch timestamps rather than delays
+            if reset > 365 * 24 * 3600: reset = max(0.0, reset - time.time())
+            if remaining <= 0: self.pause(reset)
+            elif reset > 0: self.rate = max(self.min_rate, min(self.rate, remaining / reset))
+
+    def back_off(self, error):
+        """
+        Records a failure and holds every requester for a capped, jittered exponential delay.
+        Raises <error> after <max_failures> consecutive failures. Returns the delay.
+        ---
+        :param <error>: <Exception> ; error that caused the failure
+        """
+        with self.lock:
+            self.failures += 1
+            if self.failures > self.max_failures:
+                self.failures = 0
+                raise error
+            delay = min(self.max_delay, self.base_delay * 2 ** (self.failures - 1))
+            delay = delay / 2 + random.uniform(0, delay / 2)
+            self.pause(delay)
+            delay = max(delay, self.paused_until - time.monotonic())
+        METRICS.increment("backoffs_total")
+        METRICS.increment("backoff_seconds_total", delay)
+        log_event("backoff", f"The program will back off for {delay:.1f} seconds.", logging.WARNING,
+                  delay = round(delay, 3), failures = self.failures, error = repr(error))
+        return delay
@@ -0,0 +1,410 @@
+import threading
+from array import array
+
+# Marks the keys that a record does not hold
+MISSING = object()
+
+# Columns of compact_metadata (see img_metadata.keys_to_keep()); keys outside of them are kept as-is
+INTEGER_FIELDS = ("id", "score", "upvotes", "downvotes", "faves", "uploader_id")
+FLOAT_FIELDS = ("aspect_ratio",)
+TEXT_FIELDS = ("created_at", "updated_at", "uploader")
+HASH_FIELDS = ("sha512_hash", "orig_sha512_hash")
+COLUMN_FIELDS = INTEGER_FIELDS + FLOAT_FIELDS + TEXT_FIELDS + HASH_FIELDS + ("tags", "representations")
+
+class tag_table:
+    """
+    Thread-safe intern table mapping each tag string to a small integer id (and back).
+    Compact metadata and compiled queries share the module-level table TAGS, so that a tag
+    string is held once in memory however many records carry it.
+    """
+    def __init__(self):
+        """
+        Initializes an empty table.
+        """
+        self.ids = {}
+        self.names = []
+        self.lock = threading.Lock()
+
+    def intern(self, name):
+        """
+        Returns the id of a tag, registering the tag if it is new.
+        ---
+        :param <name>: <str> ; tag
+        """
+        tag_id = self.ids.get(name)
+        if tag_id is not None: return tag_id
+        with self.lock:
+            tag_id = self.ids.get(name)
+            if tag_id is None:
+                tag_id = len(self.names)
+                self.names.append(name)
+                self.ids[name] = tag_id
+        return tag_id
+
+    def name(self, tag_id):
+        """
+        Returns the tag string of an id.
+        ---
+        :param <tag_id>: <integer> ; id of the tag
+        """
+        return self.names[tag_id]
+
+    def __len__(self):
+        """
+        Returns the number of interned tags.
+        """
+        return len(self.names)
+
+TAGS = tag_table()
+
+class value_column:
+    """
+    Column of numbers held in a typed array. Values that do not fit the array (None, a missing key,
+    an int in a float column...) are kept aside by row.
+    """
+    def __init__(self, typecode, kind):
+        """
+        Initializes an empty column.
+        ---
+        :param <typecode>: <str> ; typecode of the array ('q' or 'd')
+        :param <kind>: <type> ; type of the values stored in the array
+        """
+        self.values = array(typecode)
+        self.kind = kind
+        self.others = {}
+
+    def append(self, value):
+        """
+        Adds a value at the end of the column.
+        ---
+        :param <value>: <integer>, <float> or any other value ; value of the next row
+        """
+        if type(value) is self.kind and (self.kind is float or -2 ** 63 <= value < 2 ** 63):
+            self.values.append(value)
+        else:
+            self.others[len(self.values)] = value
+            self.values.append(0)
+
+    def __getitem__(self, row):
+        """
+        Returns the value of a row.
+        ---
+        :param <row>: <integer> ; row of the value
+        """
+        if row in self.others: return self.others[row]
+        return self.values[row]
+
+class blob_column:
+    """
+    Column of strings concatenated in a single buffer and delimited by an array of offsets.
+    <encode> turns a value into bytes (raising ValueError or TypeError for values it cannot encode,
+    which are then kept aside by row) and <decode> reverses it.
+    """
+    def __init__(self, encode, decode):
+        """
+        Initializes an empty column.
+        ---
+        :param <encode>: <function> ; value -> bytes
+        :param <decode>: <function> ; bytes -> value
+        """
+        self.data = bytearray()
+        self.offsets = array("I", [0])
+        self.encode = encode
+        self.decode = decode
+        self.others = {}
+
+    def append(self, value):
+        """
+        Adds a value at the end of the column.
+        ---
+        :param <value>: <str> or any other value ; value of the next row
+        """
+        try:
+            self.data += self.encode(value)
+        except (ValueError, TypeError, AttributeError):
+            self.others[len(self.offsets) - 1] = value
+        self.offsets.append(len(self.data))
+
+    def __getitem__(self, row):
+        """
+        Returns the decoded value of a row.
+        ---
+        :param <row>: <integer> ; row of the value
+        """
+        if row in self.others: return self.others[row]
+        return self.decode(bytes(self.data[self.offsets[row]:self.offsets[row + 1]]))
+
+def encode_text(value):
+    """
+    Encodes a string of a blob_column (other values raise AttributeError and are kept aside).
+    ---
+    :param <value>: <str> ; string to encode
+    """
+    return value.encode("utf-8")
+
+def decode_text(data):
+    """
+    Decodes a string of a blob_column.
+    ---
+    :param <data>: <bytes> ; UTF-8 encoded string
+    """
+    return data.decode("utf-8")
+
+def encode_hash(value):
+    """
+    Packs a lower-case hexadecimal hash into half its length (other values raise ValueError and are kept aside).
+    ---
+    :param <value>: <str> ; hexadecimal hash
+    """
+    if value != value.lower(): raise ValueError(value)
+    return bytes.fromhex(value)
+
+def decode_hash(data):
+    """
+    Unpacks a hash packed by encode_hash().
+    ---
+    :param <data>: <bytes> ; packed hash
+    """
+    return data.hex()
+
+class compact_record:
+    """
+    Read-only view of one row of compact_metadata. It answers the dictionary reads used across
+    derpi_get (record["id"], record.get("tags"), ...); values are only materialized when read.
+    """
+    __slots__ = ("table", "row")
+
+    def __init__(self, table, row):
+        """
+        Initializes the view.
+        ---
+        :param <table>: <compact_metadata> ; table holding the record
+        :param <row>: <integer> ; row of the record
+        """
+        self.table = table
+        self.row = row
+
+    def __getitem__(self, key):
+        """
+        Returns the value of a key of the record. Raises KeyError if the record does not hold it.
+        ---
+        :param <key>: <str> ; key of the record
+        """
+        value = self.table.value(self.row, key)
+        if value is MISSING: raise KeyError(key)
+        return value
+
+    def get(self, key, default = None):
+        """
+        Returns the value of a key of the record (<default> if the record does not hold it).
+        ---
+        :param <key>: <str> ; key of the record
+        :param <default>: <any> ; value returned for missing keys
+        """
+        value = self.table.value(self.row, key)
+        return default if value is MISSING else value
+
+    def __contains__(self, key):
+        """
+        Checks whether the record holds a key.
+        ---
+        :param <key>: <str> ; key of the record
+        """
+        return self.table.value(self.row, key) is not MISSING
+
+    def url(self, name):
+        """
+        Returns the url of one representation without building the whole dictionary.
+        ---
+        :param <name>: <str> ; representation name (e.g. 'medium')
+        """
+        return self.table.url(self.row, name)
+
+    def tag_set(self):
+        """
+        Returns the frozenset of the interned tag ids of the record.
+        """
+        return self.table.tag_set(self.row)
+
+    def to_dict(self):
+        """
+        Returns the record as a dictionary.
+        """
+        return self.table.to_dict(self.row)
+
+class compact_metadata:
+    """
+    Memory-compact table of metadata records, five to nine times smaller than the equivalent list of dictionaries
+    depending on the records (short of an order of magnitude: timestamps and 'full' urls are kept as text).
+    Numbers are stored in typed arrays and strings in concatenated buffers; tags are stored as one array
+    of ids from the TAGS intern table and hashes are packed as bytes. Representation urls are rebuilt
+    on access: derpibooru serves them as '<prefix><name><extension>', so each row only stores its prefix,
+    the ids of its (shared) name tuple and extension, and the urls that do not follow the pattern (usually 'full').
+    Indexing or iterating the table yields compact_record views.
+    """
+    def __init__(self, records = ()):
+        """
+        Initializes the table.
+        ---
+        :param <records>: <iterable> ; metadata dictionaries to add
+        """
+        self.length = 0
+        self.integers = {field: value_column("q", int) for field in INTEGER_FIELDS}
+        self.floats = {field: value_column("d", float) for field in FLOAT_FIELDS}
+        self.texts = {field: blob_column(encode_text, decode_text) for field in TEXT_FIELDS}
+        self.hashes = {field: blob_column(encode_hash, decode_hash) for field in HASH_FIELDS}
+        self.tag_ids = array("I")
+        self.tag_offsets = array("I", [0])
+        self.tags_others = {}
+        # Representations: shared name tuples and extensions, per-row prefixes and exceptions
+        self.shapes, self.shape_ids = [], {}
+        self.shape_column = array("I")
+        self.prefixes = blob_column(encode_text, decode_text)
+        self.exceptions = blob_column(encode_text, decode_text)
+        self.representations_others = {}
+        self.extra = {}
+        self.extend(records)
+
+    def __len__(self):
+        """
+        Returns the number of records of the table.
+        """
+        return self.length
+
+    def __getitem__(self, row):
+        """
+        Returns a view of a row (negative rows count from the end).
+        ---
+        :param <row>: <integer> ; row of the record
+        """
+        if row < 0: row += self.length
+        if not 0 <= row < self.length: raise IndexError(row)
+        return compact_record(self, row)
+
+    def __iter__(self):
+        """
+        Iterates over views of every row, in insertion order.
+        """
+        for row in range(self.length): yield compact_record(self, row)
+
+    def extend(self, records):
+        """
+        Adds metadata records to the table.
+        ---
+        :param <records>: <iterable> ; metadata dictionaries
+        """
+        for record in records: self.append(record)
+
+    def append(self, record):
+        """
+        Adds a metadata record to the table.
+        ---
+        :param <record>: <dict> ; metadata dictionary
+        """
+        row = self.length
+        for field, column in self.integers.items(): column.append(record.get(field, MISSING))
+        for field, column in self.floats.items(): column.append(record.get(field, MISSING))
+        for field, column in self.texts.items(): column.append(record.get(field, MISSING))
+        for field, column in self.hashes.items(): column.append(record.get(field, MISSING))
+        tags = record.get("tags", MISSING)
+        if isinstance(tags, str):
+            if tags != "": self.tag_ids.extend(TAGS.intern(tag) for tag in tags.split(", "))
+        else:
+            self.tags_others[row] = tags
+        self.tag_offsets.append(len(self.tag_ids))
+        self.append_representations(row, record.get("representations", MISSING))
+        extra = {key: value for key, value in record.items() if key not in COLUMN_FIELDS}
+        if extra != {}: self.extra[row] = extra
+        self.length += 1
+
+    def shape_id(self, shape):
+        """
+        Returns the id of a (representation names, extension) pair, registering it if it is new.
+        ---
+        :param <shape>: <tuple> ; (tuple of names, extension)
+        """
+        if shape not in self.shape_ids:
+            self.shape_ids[shape] = len(self.shapes)
+            self.shapes.append(shape)
+        return self.shape_ids[shape]
+
+    def append_representations(self, row, representations):
+        """
+        Splits the representation urls of a row into a shared prefix and extension and the urls that do not follow them.
+        ---
+        :param <row>: <integer> ; row of the record
+        :param <representations>: <dict> ; {name: url}
+        """
+        prefix, extension = "", ""
+        if not isinstance(representations, dict) or \
+                not all(isinstance(url, str) and "\t" not in url and "\n" not in url for url in representations.values()):
+            self.representations_others[row] = representations
+            representations = {}
+        name = "medium" if "medium" in representations else next(iter(representations), None)
+        if name is not None and f"/{name}." in representations[name]:
+            position = representations[name].rindex(f"/{name}.") + 1
+            prefix, extension = representations[name][:position], representations[name][position + len(name):]
+        self.shape_column.append(self.shape_id((tuple(representations), extension)))
+        self.prefixes.append(prefix)
+        self.exceptions.append("\n".join(f"{key}\t{url}" for key, url in representations.items()
+                                         if url != f"{prefix}{key}{extension}"))
+
+    def url(self, row, name):
+        """
+        Returns the url of one representation of a row.
+        ---
+        :param <row>: <integer> ; row of the record
+        :param <name>: <str> ; representation name (e.g. 'medium')
+        """
+        if row in self.representations_others:
+            representations = self.representations_others[row]
+            if not isinstance(representations, dict) or name not in representations: raise KeyError(name)
+            return representations[name]
+        names, extension = self.shapes[self.shape_column[row]]
+        if name not in names: raise KeyError(name)
+        exceptions = self.exceptions[row]
+        if exceptions != "":
+            for line in exceptions.split("\n"):
+                key, url = line.split("\t", 1)
+                if key == name: return url
+        return f"{self.prefixes[row]}{name}{extension}"
+
+    def tag_set(self, row):
+        """
+        Returns the frozenset of the interned tag ids of a row.
+        ---
+        :param <row>: <integer> ; row of the record
+        """
+        return frozenset(self.tag_ids[self.tag_offsets[row]:self.tag_offsets[row + 1]])
+
+    def value(self, row, key):
+        """
+        Returns the value of a key of a row (MISSING if the record does not hold it).
+        ---
+        :param <row>: <integer> ; row of the record
+        :param <key>: <str> ; key of the record
+        """
+        if key in self.integers: return self.integers[key][row]
+        if key in self.floats: return self.floats[key][row]
+        if key in self.texts: return self.texts[key][row]
+        if key in self.hashes: return self.hashes[key][row]
+        if key == "tags":
+            if row in self.tags_others: return self.tags_others[row]
+            return ", ".join(TAGS.names[tag_id] for tag_id in self.tag_ids[self.tag_offsets[row]:self.tag_offsets[row + 1]])
+        if key == "representations":
+            if row in self.representations_others: return self.representations_others[row]
+            return {name: self.url(row, name) for name in self.shapes[self.shape_column[row]][0]}
+        return self.extra.get(row, {}).get(key, MISSING)
+
+    def to_dict(self, row):
+        """
+        Returns a row as a dictionary.
+        ---
+        :param <row>: <integer> ; row of the record
+        """
+        record = {}
+        for key in COLUMN_FIELDS:
+            value = self.value(row, key)
+            if value is not MISSING: record[key] = value
+        record.update(self.extra.get(row, {}))
+        return record
@@ -0,0 +1,135 @@
+import itertools
+import json
+import logging
+import os
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from requests.adapters import HTTPAdapter
+import requests
+from .metrics import METRICS, log_event
+from .rate_limiter import rate_controller
+from .segment_store import write_atomic
+
+log = logging.getLogger()
+
+# The "Everything" filter keeps the search endpoint from hiding pictures that need repairs
+SEARCH_PATH = "/search.json"
+SEARCH_URL = "https://derpibooru.org" + SEARCH_PATH
+EVERYTHING_FILTER_ID = 56027
+
+def record_batch(ids, tags):
+    """
+    Counts and logs the outcome of a repaired batch.
+    ---
+    :param <ids>: <list> ; ids of the batch
+    :param <tags>: <dict> ; {id: tags} of the ids for which tags were found
+    """
+    METRICS.increment("repaired_records_total", len(tags))
+    METRICS.increment("unrepaired_records_total", len(ids) - len(tags))
+    for image_id in ids:
+        if image_id in tags: log_event("repair.updated", f"The tags of the picture {image_id} were updated.", id = image_id)
+        else: log_event("repair.empty", f"The url request for the picture {image_id} returned an empty list of tags.",
+                        id = image_id)
+
+class repair_engine:
+    """
+    Repairs the records whose list of tags is missing.
+    The ids to repair are gathered once and checkpointed; they are then fetched by batches
+    through the search endpoint ('id:1 || id:2 ...') on a pool of workers sharing a rate limiter.
+    Each completed batch is merged into the backend, which only rewrites the records that changed,
+    and removed from the checkpoint so that an interrupted repair resumes where it stopped.
+    """
+    def __init__(self, backend, checkpoint_path, cache, workers = 4, rate = 5.0, batch_size = 50, search_url = SEARCH_URL):
+        """
+        Initializes the repair engine.
+        ---
+        :param <backend>: <metadata_backend> ; metadata storage backend
+        :param <checkpoint_path>: <str> ; path of the checkpoint file listing the ids left to repair
+        :param <cache>: <http_cache> ; HTTP cache the search requests go through
+        :param <workers>: <integer> ; number of concurrent batch requests
+        :param <rate>: <float> ; number of requests allowed per second across all workers
+        :param <batch_size>: <integer> ; number of ids requested per search query (at most 50)
+        :param <search_url>: <str> ; url of the search endpoint
+        """
+        assert(isinstance(workers, int) and workers > 0), "The number of workers must be a positive integer."
+        assert(isinstance(batch_size, int) and 0 < batch_size <= 50), "The batch size must be between 1 and 50."
+        self.backend = backend
+        self.checkpoint_path = checkpoint_path
+        self.workers = workers
+        self.batch_size = batch_size
+        self.search_url = search_url
+        self.limiter = rate_controller(rate)
+        self.cache = cache
+        adapter = HTTPAdapter(pool_connections = workers, pool_maxsize = workers)
+        self.cache.session.mount("http://", adapter)
+        self.cache.session.mount("https://", adapter)
+
+    def pending_ids(self):
+        """
+        Returns the ids left to repair, from the checkpoint if one exists, else from a scan of the backend.
+        """
+        if os.path.exists(self.checkpoint_path):
+            with open(self.checkpoint_path, "r") as file: pending = json.load(file)["pending"]
+            log_event("repair.resume", f"Resuming an interrupted repair: {len(pending)} pictures left.",
+                      pending = len(pending))
+            return pending
+        pending = [record["id"] for record in self.backend.records_missing_tags()]
+        self.save_checkpoint(pending)
+        return pending
+
+    def save_checkpoint(self, pending):
+        """
+        Atomically records the ids left to repair.
+        ---
+        :param <pending>: <list> ; ids left to repair
+        """
+        write_atomic(self.checkpoint_path, json.dumps({"pending": pending}))
+
+    def fetch_batch(self, ids):
+        """
+        Requests the tags of a batch of ids through the search endpoint, backing off and retrying on failures.
+        Returns a dictionary {id: tags} holding the ids for which tags were found.
+        ---
+        :param <ids>: <list> ; ids to request
+        """
+        params = {"q": " || ".join(f"id:{image_id}" for image_id in ids),
+                  "perpage": len(ids), "filter_id": EVERYTHING_FILTER_ID}
+        while True:
+            try:
+                request = self.cache.get(self.search_url, params, 60, self.limiter.acquire, self.limiter.observe)
+                request.raise_for_status()
+                break
+            except requests.exceptions.RequestException as error:
+                self.limiter.back_off(error)
+        return {image_data["id"]: image_data["tags"] for image_data in request.json()["search"]
+                if image_data.get("tags") is not None}
+
+    def run(self):
+        """
+        Repairs every pending id and returns the number of repaired records.
+        Batches are submitted as others complete, one per worker at a time, so that a failure stops the repair
+        after the batches in flight; the batches completed until then are merged and checkpointed.
+        """
+        pending = self.pending_ids()
+        remaining = set(pending)
+        batches = (pending[start:start + self.batch_size] for start in range(0, len(pending), self.batch_size))
+        nb_repaired = 0
+        with ThreadPoolExecutor(max_workers = self.workers) as executor:
+            futures = {executor.submit(self.fetch_batch, batch): batch for batch in itertools.islice(batches, self.workers)}
+            while futures:
+                done, _ = wait(futures, return_when = FIRST_COMPLETED)
+                failures = [future.exception() for future in done if future.exception() is not None]
+                for future in done:
+                    batch = futures.pop(future)
+                    if future.exception() is not None: continue
+                    tags = future.result()
+                    self.backend.update({image_id: {"tags": tags[image_id]} for image_id in batch if image_id in tags})
+                    record_batch(batch, tags)
+                    nb_repaired += len(tags)
+                    remaining.difference_update(batch)
+                    self.save_checkpoint(sorted(remaining))
+                    if failures == []:
+                        batch = next(batches, None)
+                        if batch is not None: futures[executor.submit(self.fetch_batch, batch)] = batch
+                if failures != []: raise failures[0]
+        os.remove(self.checkpoint_path)
+        return nb_repaired
@@ -0,0 +1,118 @@
+import gzip
+import json
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+def encode_lines(records):
+    """
+    Encodes records as UTF-8 JSON Lines.
+    ---
+    :param <records>: <list> ; list of metadata dictionaries
+    """
+    return "".join(json.dumps(record) + "\n" for record in records).encode("utf-8")
+
+def decode_lines(data):
+    """
+    Decodes UTF-8 JSON Lines into a list of records.
+    ---
+    :param <data>: <bytes> ; encoded segment
+    """
+    # One parse of the whole segment is much faster than one json.loads() per line
+    lines = [line for line in data.decode("utf-8").split("\n") if line.strip() != ""]
+    return json.loads("[" + ",".join(lines) + "]")
+
+class segment_codec:
+    """
+    Encoding of the sealed metadata segments. The active segment is always plain JSON Lines,
+    which can be appended to and truncated after a crash; it is encoded with the codec of the store once sealed.
+    """
+    def __init__(self, name, extension, encode, decode, requires = None):
+        """
+        Initializes the codec.
+        ---
+        :param <name>: <str> ; name of the codec (recorded as the format of the segments in the manifest)
+        :param <extension>: <str> ; extension of the segment files
+        :param <encode>: <function> ; list of records -> bytes
+        :param <decode>: <function> ; bytes -> list of records
+        :param <requires>: <str> ; pip package(s) the codec depends on (None for the standard library)
+        """
+        self.name = name
+        self.extension = extension
+        self.encode = encode
+        self.decode = decode
+        self.requires = requires
+
+    def available(self):
+        """
+        Checks whether the packages the codec depends on are installed.
+        """
+        if self.name == "zstd": return zstandard is not None
+        if self.name == "msgpack": return zstandard is not None and msgpack is not None
+        return True
+
+    def require(self):
+        """
+        Raises an ImportError explaining how to enable the codec when its packages are missing.
+        """
+        if not self.available():
+            raise ImportError(f"The {self.name} segment codec of derpi_get requires {self.requires} (pip install {self.requires}).")
+
+def encode_zstd(records):
+    """
+    Encodes records as zstd-compressed JSON Lines.
+    ---
+    :param <records>: <list> ; list of metadata dictionaries
+    """
+    return zstandard.ZstdCompressor(level = 10).compress(encode_lines(records))
+
+def decode_zstd(data):
+    """
+    Decodes zstd-compressed JSON Lines into a list of records.
+    ---
+    :param <data>: <bytes> ; encoded segment
+    """
+    return decode_lines(zstandard.ZstdDecompressor().decompress(data))
+
+def encode_msgpack(records):
+    """
+    Encodes records as a zstd-compressed stream of msgpack maps.
+    ---
+    :param <records>: <list> ; list of metadata dictionaries
+    """
+    return zstandard.ZstdCompressor(level = 10).compress(b"".join(msgpack.packb(record) for record in records))
+
+def decode_msgpack(data):
+    """
+    Decodes a zstd-compressed stream of msgpack maps into a list of records.
+    ---
+    :param <data>: <bytes> ; encoded segment
+    """
+    unpacker = msgpack.Unpacker(raw = False, strict_map_key = False)
+    unpacker.feed(zstandard.ZstdDecompressor().decompress(data))
+    return list(unpacker)
+
+CODECS = {"jsonl": segment_codec("jsonl", ".jsonl", encode_lines, decode_lines),
+          "gzip": segment_codec("gzip", ".jsonl.gz", lambda records: gzip.compress(encode_lines(records), 6),
+                                lambda data: decode_lines(gzip.decompress(data))),
+          "zstd": segment_codec("zstd", ".jsonl.zst", encode_zstd, decode_zstd, "zstandard"),
+          "msgpack": segment_codec("msgpack", ".msgpack.zst", encode_msgpack, decode_msgpack, "msgpack zstandard")}
+
+def get_codec(name):
+    """
+    Returns an available segment codec.
+    ---
+    :param <name>: <str> ; "jsonl" (uncompressed), "gzip" (gzip-framed JSON Lines, standard library),
+                           "zstd" (zstd-framed JSON Lines, requires zstandard) or "msgpack" (zstd-framed msgpack,
+                           requires msgpack and zstandard)
+    """
+    if name not in CODECS: raise ValueError(f"Unknown segment codec {name} (available: {', '.join(CODECS)}).")
+    CODECS[name].require()
+    return CODECS[name]
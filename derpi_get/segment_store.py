@@ -0,0 +1,322 @@
+import json
+import logging
+import os
+from .metrics import METRICS
+from .segment_codecs import CODECS, get_codec
+
+log = logging.getLogger()
+
+SEGMENT_PREFIX = "derpibooru_metadata"
+MANIFEST_NAME = "derpibooru_manifest.json"
+# Suffixes of the files a segment can be stored in (legacy JSON, JSON Lines and the codecs), with or without '.tmp'
+SEGMENT_SUFFIXES = [".json"] + [codec.extension for codec in CODECS.values()]
+
+def store_error_message(error_type, location):
+    """
+    Creates a custom error message for the segment store.
+    ---
+    :param <error_type>: <str> ; short description of occuring error
+    :param <location>: <str> ; name of method where the error occured
+    """
+    return f"An {error_type} error was raised in the {location} method of the class segment_store "+\
+        "in the derpi_get/segment_store.py file."
+
+def write_atomic(path, content, mode = "w"):
+    """
+    Writes a file through a temporary file that is renamed over the target once flushed to disk.
+    A crash during the write leaves the previous version of the file untouched.
+    ---
+    :param <path>: <str> ; path of the file to write
+    :param <content>: <str> or <bytes> ; content of the file
+    :param <mode>: <str> ; file opening mode ("w" or "wb")
+    """
+    temp_path = path + ".tmp"
+    with open(temp_path, mode) as file:
+        file.write(content)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temp_path, path)
+
+class segment_store:
+    """
+    Append-only store of picture metadata kept as a series of JSON Lines segments.
+    Records are appended to an active segment that is sealed (renamed to a numbered file)
+    once it reaches a size or record-count limit. A small manifest records the id range
+    of every segment so that the resume point never requires loading the data itself.
+    Legacy 'derpibooru_metadata*.json' files are registered as read-only segments.
+    Sealed segments are encoded with the codec of the store (see derpi_get/segment_codecs.py), recorded
+    in the manifest; each segment records its own format, so that a store can mix codecs.
+    """
+    def __init__(self, folder, max_size = 1024 ** 2, max_records = None, codec = None):
+        """
+        Opens (or creates) the segment store located in <folder>.
+        ---
+        :param <folder>: <str> ; folder where the segments and the manifest are stored
+        :param <max_size>: <integer> ; size in bytes at which the active segment is sealed
+        :param <max_records>: <integer> ; number of records at which the active segment is sealed (None to disable)
+        :param <codec>: <str> ; codec of the segments sealed from now on ("jsonl", "gzip", "zstd" or "msgpack"),
+                                None to keep the codec of the store ("jsonl" for a new store)
+        """
+        assert(isinstance(folder, str)), store_error_message("Erroneous Type", "__init__")
+        assert(isinstance(max_size, int) and max_size > 0), store_error_message("Erroneous Type", "__init__")
+        assert(max_records is None or (isinstance(max_records, int) and max_records > 0)), \
+            store_error_message("Erroneous Type", "__init__")
+
+        self.folder = folder
+        self.max_size = max_size
+        self.max_records = max_records
+        self.manifest_path = os.path.join(folder, MANIFEST_NAME)
+        self.active_path = os.path.join(folder, SEGMENT_PREFIX + ".jsonl")
+
+        if not os.path.exists(folder): os.makedirs(folder)
+        # The manifest is only rewritten when it changes, so that opening a store does not write to it
+        changed = not os.path.exists(self.manifest_path)
+        if not changed:
+            with open(self.manifest_path, "r") as file: self.manifest = json.load(file)
+        else:
+            self.manifest = {"next_segment": 0, "segments": self.import_legacy()}
+        if codec is not None and self.manifest.get("codec", "jsonl") != get_codec(codec).name:
+            self.manifest["codec"] = codec
+            changed = True
+        self.codec = get_codec(self.manifest.get("codec", "jsonl"))
+        if self.recover() or changed: self.save_manifest()
+
+    def import_legacy(self):
+        """
+        Registers the 'derpibooru_metadata*.json' files produced by former versions as sealed segments.
+        Those files are read once to record their id range and are never rewritten.
+        """
+        segments = []
+        for fname in sorted(os.listdir(self.folder)):
+            if not (fname.startswith(SEGMENT_PREFIX) and fname.endswith(".json")): continue
+            with open(os.path.join(self.folder, fname), "r") as file: json_local = json.load(file)
+            if json_local == []: continue
+            ids = [item["id"] for item in json_local]
+            segments.append({"file": fname, "format": "json", "min_id": min(ids),
+                             "max_id": max(ids), "records": len(ids)})
+        return segments
+
+    def recover(self):
+        """
+        Brings the store back to a consistent state after an interruption:
+        finishes a sealing whose rename did not happen, deletes the files left over by an interrupted encoding,
+        drops a partially written trailing line of the active segment and recomputes the active segment's id range.
+        Returns whether the manifest has to be saved.
+        """
+        if self.manifest["segments"] != []:
+            sealed_path = os.path.join(self.folder, self.manifest["segments"][-1]["file"])
+            if not os.path.exists(sealed_path) and os.path.exists(self.active_path):
+                os.replace(self.active_path, sealed_path)
+
+        # Other encodings of a listed segment are either half written or already replaced
+        listed = {entry["file"] for entry in self.manifest["segments"]} | {os.path.basename(self.active_path)}
+        stems = {entry["file"].split(".")[0] for entry in self.manifest["segments"]}
+        for fname in os.listdir(self.folder):
+            suffix = fname[len(fname.split(".")[0]):]
+            if suffix.endswith(".tmp"): suffix = suffix[:-len(".tmp")]
+            if fname not in listed and fname.split(".")[0] in stems and suffix in SEGMENT_SUFFIXES:
+                os.remove(os.path.join(self.folder, fname))
+
+        active = {"file": os.path.basename(self.active_path), "format": "jsonl",
+                  "min_id": None, "max_id": None, "records": 0, "size": 0}
+        if os.path.exists(self.active_path):
+            valid_offset = 0
+            with open(self.active_path, "rb") as file:
+                for line in file:
+                    try: record = json.loads(line)
+                    except ValueError: break
+                    if not line.endswith(b"\n"): break
+                    valid_offset += len(line)
+                    self.update_range(active, [record["id"]])
+            if valid_offset != os.path.getsize(self.active_path):
+                log.warning(f"Truncating a partially written record in {self.active_path}.")
+                with open(self.active_path, "r+b") as file: file.truncate(valid_offset)
+            active["size"] = valid_offset
+        changed = self.manifest.get("active") != active
+        self.manifest["active"] = active
+        return changed
+
+    def update_range(self, entry, ids):
+        """
+        Updates the id range and the record count of a manifest entry.
+        ---
+        :param <entry>: <dict> ; manifest entry of a segment
+        :param <ids>: <list> ; ids of the records added to the segment
+        """
+        if ids == []: return
+        low, high = min(ids), max(ids)
+        entry["min_id"] = low if entry["min_id"] is None else min(entry["min_id"], low)
+        entry["max_id"] = high if entry["max_id"] is None else max(entry["max_id"], high)
+        entry["records"] += len(ids)
+
+    def encode_segment(self, entry, codec):
+        """
+        Re-encodes a sealed segment with another codec: the new file is written first, then listed in
+        the manifest, then the former file is deleted (recover() deletes whichever file an interruption leaves over).
+        ---
+        :param <entry>: <dict> ; manifest entry of the segment
+        :param <codec>: <segment_codec> ; codec of the new file
+        """
+        records = self.read_segment(entry)
+        stem = entry["file"].split(".")[0]
+        new_name = stem + codec.extension
+        # A legacy 'derpibooru_metadata.json' file must not take the name of the active segment
+        if new_name == os.path.basename(self.active_path): new_name = f"{stem}_legacy{codec.extension}"
+        write_atomic(os.path.join(self.folder, new_name), codec.encode(records), "wb")
+        former_name = entry["file"]
+        entry["file"], entry["format"] = new_name, codec.name
+        self.save_manifest()
+        if former_name != new_name: os.remove(os.path.join(self.folder, former_name))
+
+    def convert(self, codec):
+        """
+        Re-encodes every sealed segment (legacy 'derpibooru_metadata*.json' files included) with a codec,
+        which becomes the codec of the store. Returns the number of converted segments.
+        ---
+        :param <codec>: <str> ; "jsonl", "gzip", "zstd" or "msgpack"
+        """
+        self.codec = get_codec(codec)
+        self.manifest["codec"] = self.codec.name
+        self.save_manifest()
+        nb_converted = 0
+        for entry in self.manifest["segments"]:
+            if entry["format"] == self.codec.name: continue
+            self.encode_segment(entry, self.codec)
+            nb_converted += 1
+        return nb_converted
+
+    def save_manifest(self):
+        """
+        Atomically rewrites the manifest.
+        """
+        write_atomic(self.manifest_path, json.dumps(self.manifest))
+
+    def append(self, records):
+        """
+        Appends a list of records to the active segment and seals it if it grew too large.
+        ---
+        :param <records>: <list> ; list of metadata dictionaries (each one holding an 'id' key)
+        """
+        assert(isinstance(records, list)), store_error_message("Erroneous Type", "append")
+        if records == []: return
+        active = self.manifest["active"]
+        payload = "".join(json.dumps(record) + "\n" for record in records).encode("utf-8")
+        with open(self.active_path, "ab") as file:
+            file.write(payload)
+            file.flush()
+            os.fsync(file.fileno())
+        active["size"] += len(payload)
+        self.update_range(active, [record["id"] for record in records])
+
+        if ((active["size"] >= self.max_size) or
+            (self.max_records is not None and active["records"] >= self.max_records)):
+            self.seal()
+        else:
+            self.save_manifest()
+
+    def seal(self):
+        """
+        Seals the active segment: the manifest is first updated to list it under its
+        numbered name, then the file is renamed. recover() completes the rename if
+        the process stops in between.
+        """
+        active = self.manifest["active"]
+        if active["records"] == 0: return
+        # Numbers already used by a listed segment or by a file in any format (e.g. legacy or converted files) are skipped
+        taken = {entry["file"].split(".")[0] for entry in self.manifest["segments"]}
+        while True:
+            number = self.manifest["next_segment"]
+            self.manifest["next_segment"] += 1
+            stem = f"{SEGMENT_PREFIX}_{number}"
+            if stem not in taken and not any(os.path.exists(os.path.join(self.folder, stem + suffix))
+                                             for suffix in SEGMENT_SUFFIXES):
+                break
+        sealed_name = stem + ".jsonl"
+        log.info(f"MAX SEGMENT SIZE REACHED: {active['file']} sealed as {sealed_name}.")
+        sealed = {"file": sealed_name, "format": "jsonl", "min_id": active["min_id"],
+                  "max_id": active["max_id"], "records": active["records"]}
+        self.manifest["segments"].append(sealed)
+        self.manifest["active"] = {"file": active["file"], "format": "jsonl",
+                                   "min_id": None, "max_id": None, "records": 0, "size": 0}
+        self.save_manifest()
+        os.replace(self.active_path, os.path.join(self.folder, sealed_name))
+        if self.codec.name != "jsonl": self.encode_segment(sealed, self.codec)
+
+    def last_id(self):
+        """
+        Returns the highest stored id according to the manifest (0 if the store is empty).
+        """
+        entries = self.manifest["segments"] + [self.manifest["active"]]
+        ids = [entry["max_id"] for entry in entries if entry["max_id"] is not None]
+        return max(ids) if ids != [] else 0
+
+    def segments(self):
+        """
+        Returns the manifest entries of every segment holding records, the active one last.
+        """
+        entries = list(self.manifest["segments"])
+        if self.manifest["active"]["records"] > 0: entries.append(self.manifest["active"])
+        return entries
+
+    def read_segment(self, entry):
+        """
+        Returns the list of records stored in a segment.
+        ---
+        :param <entry>: <dict> ; manifest entry of the segment
+        """
+        path = os.path.join(self.folder, entry["file"])
+        METRICS.increment("segment_reads_total")
+        METRICS.increment("store_records_read_total", entry["records"])
+        if entry["format"] == "json":
+            with open(path, "r") as file: return json.load(file)
+        codec = get_codec(entry["format"])
+        with open(path, "rb") as file: return codec.decode(file.read())
+
+    def rewrite_segment(self, entry, records):
+        """
+        Atomically replaces the content of a sealed segment. Segments keep their format.
+        ---
+        :param <entry>: <dict> ; manifest entry of the segment
+        :param <records>: <list> ; new content of the segment
+        """
+        path = os.path.join(self.folder, entry["file"])
+        with METRICS.timer("segment_rewrite_seconds"):
+            if entry["format"] == "json": write_atomic(path, json.dumps(records))
+            else: write_atomic(path, get_codec(entry["format"]).encode(records), "wb")
+        METRICS.increment("segment_rewrites_total")
+        if entry is self.manifest["active"]:
+            entry["size"] = os.path.getsize(path)
+            self.save_manifest()
+
+    def iter_segment(self, entry):
+        """
+        Iterates over the records of a segment, parsing the active segment one line at a time.
+        Sealed segments are decoded at once (see derpi_get/segment_codecs.py).
+        ---
+        :param <entry>: <dict> ; manifest entry of the segment
+        """
+        if entry is not self.manifest["active"]:
+            yield from self.read_segment(entry)
+            return
+        METRICS.increment("segment_reads_total")
+        METRICS.increment("store_records_read_total", entry["records"])
+        with open(os.path.join(self.folder, entry["file"]), "r") as file:
+            for line in file:
+                if line.strip() != "": yield json.loads(line)
+
+    def iter_records(self, min_id = None, max_id = None, predicate = None):
+        """
+        Iterates over the stored records, segment by segment. Segments whose id range (known from
+        the manifest) lies outside of [min_id, max_id] are skipped without being read.
+        ---
+        :param <min_id>: <integer> ; lowest id to return (None for no bound)
+        :param <max_id>: <integer> ; highest id to return (None for no bound)
+        :param <predicate>: <function> ; record -> boolean, records failing it are not returned (None to keep all)
+        """
+        for entry in self.segments():
+            if min_id is not None and entry["max_id"] is not None and entry["max_id"] < min_id: continue
+            if max_id is not None and entry["min_id"] is not None and entry["min_id"] > max_id: continue
+            for record in self.iter_segment(entry):
+                if min_id is not None and record["id"] < min_id: continue
+                if max_id is not None and record["id"] > max_id: continue
+                if predicate is None or predicate(record): yield record
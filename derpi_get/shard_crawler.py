@@ -0,0 +1,187 @@
+import json
+import logging
+import os
+import shutil
+import threading
+import requests
+from concurrent.futures import FIRST_EXCEPTION, ThreadPoolExecutor, wait
+from .metrics import METRICS, log_event
+from .segment_store import segment_store, write_atomic
+
+log = logging.getLogger()
+
+PLAN_NAME = "derpibooru_shards.json"
+
+def split_range(start, end, nb_shards):
+    """
+    Splits the ids in ]start, end] into at most <nb_shards> disjoint ranges [low, high] of similar sizes.
+    ---
+    :param <start>: <integer> ; id after which the ranges start
+    :param <end>: <integer> ; last id of the ranges
+    :param <nb_shards>: <integer> ; number of ranges
+    """
+    length = end - start
+    if length <= 0: return []
+    nb_shards = max(1, min(nb_shards, length))
+    bounds = [start + length * position // nb_shards for position in range(nb_shards + 1)]
+    return [[bounds[position] + 1, bounds[position + 1]] for position in range(nb_shards)]
+
+class shard_crawler:
+    """
+    Range-sharded crawl used to backfill the metadata store.
+    The ids between the last stored id and the newest id on derpibooru are split into disjoint ranges
+    crawled in parallel by worker threads sharing one rate controller (the global request budget).
+    Each shard has its own cursor, its own segment store ('shards/shard_<n>') and a checkpoint
+    ('shards/shard_<n>.json'), so that an interrupted crawl resumes every shard where it stopped.
+    Once every shard is complete, the shards are merged into the metadata store in ascending id order.
+    """
+    def __init__(self, folder, backend, cache, controller, page_url, collect):
+        """
+        Initializes the sharded crawl.
+        ---
+        :param <folder>: <str> ; folder holding the plan, the checkpoints and the segments of the shards
+        :param <backend>: <metadata_backend> ; metadata store the shards are merged into
+        :param <cache>: <http_cache> ; HTTP cache the page requests go through
+        :param <controller>: <rate_controller> ; rate controller shared by all shards
+        :param <page_url>: <str> ; url of the pages of ids following a cursor ('...&gt=')
+        :param <collect>: <function> ; page -> list of trimmed records (see img_metadata.trim_metadata())
+        """
+        self.folder = folder
+        self.backend = backend
+        self.cache = cache
+        self.controller = controller
+        self.page_url = page_url
+        self.collect = collect
+        self.plan_path = os.path.join(folder, PLAN_NAME)
+        self.lock = threading.Lock()
+        if not os.path.exists(folder): os.makedirs(folder)
+
+    def checkpoint_path(self, position):
+        """
+        Returns the path of the checkpoint of a shard ('shard_<n>.json').
+        ---
+        :param <position>: <integer> ; position of the shard
+        """
+        return os.path.join(self.folder, f"shard_{position}.json")
+
+    def plan(self, nb_shards, end):
+        """
+        Returns the list of shards {low, high, cursor, done}, resuming the current plan if one exists.
+        ---
+        :param <nb_shards>: <integer> ; number of shards of a new plan
+        :param <end>: <integer> ; newest id on derpibooru (last id of a new plan)
+        """
+        if os.path.exists(self.plan_path):
+            with open(self.plan_path, "r") as file: ranges = json.load(file)["ranges"]
+            log_event("shards.resume", f"Resuming a sharded crawl of {len(ranges)} shards.", shards = len(ranges))
+        else:
+            ranges = split_range(self.backend.last_id(), end, nb_shards)
+            write_atomic(self.plan_path, json.dumps({"ranges": ranges}))
+        shards = []
+        for position, (low, high) in enumerate(ranges):
+            path = self.checkpoint_path(position)
+            if os.path.exists(path):
+                with open(path, "r") as file: shards.append(json.load(file))
+            else:
+                shards.append({"low": low, "high": high, "cursor": low - 1, "done": False})
+        return shards
+
+    def crawl_shard(self, position, shard, budget, stop = None):
+        """
+        Crawls one shard until its range is exhausted, the shared page budget is spent or another shard failed.
+        A failing shard sets <stop> so that the other shards stop at their next page.
+        ---
+        :param <position>: <integer> ; position of the shard
+        :param <shard>: <dict> ; checkpoint of the shard
+        :param <budget>: <dict> ; {"pages": remaining pages (None for no limit)} shared by all shards
+        :param <stop>: <threading.Event> ; stop signal shared by all shards (None for a shard crawled alone)
+        """
+        if stop is None: stop = threading.Event()
+        try: self.crawl_pages(position, shard, budget, stop)
+        except BaseException:
+            stop.set()
+            raise
+
+    def crawl_pages(self, position, shard, budget, stop):
+        """
+        Requests the pages of one shard and stores them, checkpointing the shard after each page (see crawl_shard()).
+        ---
+        :param <position>: <integer> ; position of the shard
+        :param <shard>: <dict> ; checkpoint of the shard
+        :param <budget>: <dict> ; {"pages": remaining pages (None for no limit)} shared by all shards
+        :param <stop>: <threading.Event> ; stop signal shared by all shards
+        """
+        store = segment_store(os.path.join(self.folder, f"shard_{position}"))
+        # Pages stored after the last checkpoint are not requested again
+        shard["cursor"] = max(shard["cursor"], store.last_id())
+        while not shard["done"]:
+            if stop.is_set(): return
+            with self.lock:
+                if budget["pages"] is not None:
+                    if budget["pages"] <= 0: return
+                    budget["pages"] -= 1
+            try:
+                with METRICS.span("shard.page", shard = position, cursor = shard["cursor"]):
+                    request = self.cache.get(f"{self.page_url}{shard['cursor']}&lte={shard['high']}",
+                                             before_request = self.controller.acquire,
+                                             after_response = self.controller.observe)
+                    request.raise_for_status()
+                    page = request.json()["images"]
+            except (requests.exceptions.RequestException, ValueError) as error:
+                self.controller.back_off(error)
+                with self.lock:
+                    if budget["pages"] is not None: budget["pages"] += 1
+                continue
+            METRICS.increment("pages_crawled_total")
+            records = [record for record in self.collect(page) if record["id"] <= shard["high"]]
+            store.append(records)
+            if records != []: shard["cursor"] = max(record["id"] for record in records)
+            shard["done"] = records == [] or len(records) < len(page) or shard["cursor"] >= shard["high"]
+            write_atomic(self.checkpoint_path(position), json.dumps(shard))
+            log_event("shards.page", f"Shard {position}: ids up to {shard['cursor']} of [{shard['low']}, {shard['high']}] retrieved.",
+                      shard = position, cursor = shard["cursor"], low = shard["low"], high = shard["high"])
+
+    def merge(self, shards):
+        """
+        Appends the records of the completed shards to the metadata store in ascending id order, then deletes the shards.
+        Records already merged (ids up to the last stored id) are skipped, so that an interrupted merge can be resumed.
+        ---
+        :param <shards>: <list> ; checkpoints of the shards
+        """
+        nb_merged = 0
+        for position in range(len(shards)):
+            store = segment_store(os.path.join(self.folder, f"shard_{position}"))
+            last_id = self.backend.last_id()
+            for entry in store.segments():
+                records = sorted((record for record in store.iter_segment(entry) if record["id"] > last_id),
+                                 key = lambda record: record["id"])
+                self.backend.append(records)
+                nb_merged += len(records)
+        shutil.rmtree(self.folder)
+        return nb_merged
+
+    def run(self, nb_shards, end, pages = None):
+        """
+        Crawls every shard on parallel workers and merges them once all are complete.
+        Returns the number of merged records (0 while shards are left incomplete).
+        ---
+        :param <nb_shards>: <integer> ; number of shards (and of workers)
+        :param <end>: <integer> ; newest id on derpibooru
+        :param <pages>: <integer> ; number of pages allowed across all shards (None for no limit)
+        """
+        shards = self.plan(nb_shards, end)
+        budget = {"pages": pages}
+        stop = threading.Event()
+        with ThreadPoolExecutor(max_workers = max(1, len(shards))) as executor:
+            futures = [executor.submit(self.crawl_shard, position, shard, budget, stop)
+                       for position, shard in enumerate(shards) if not shard["done"]]
+            # The first failure stops the other shards (their checkpoints keep the pages already stored)
+            _, pending = wait(futures, return_when = FIRST_EXCEPTION)
+            for future in pending: future.cancel()
+            for future in futures:
+                if not future.cancelled(): future.result()
+        if not all(shard["done"] for shard in shards):
+            nb_done = len([shard for shard in shards if shard["done"]])
+            log_event("shards.partial", f"{nb_done} of {len(shards)} shards completed.", done = nb_done, shards = len(shards))
+            return 0
+        return self.merge(shards)
@@ -0,0 +1,420 @@
+import bisect
+import heapq
+import json
+import logging
+import os
+from array import array
+from .segment_store import write_atomic
+
+log = logging.getLogger()
+
+INDEX_NAME = "derpibooru_tag_index"
+# Size in bytes of a sha512 digest
+DIGEST_SIZE = 64
+
+def split_tags(record):
+    """
+    Returns the list of tags of a metadata record (empty if its tags are missing).
+    ---
+    :param <record>: <dict> ; metadata record
+    """
+    if record.get("tags") in (None, ""): return []
+    return record["tags"].split(", ")
+
+def insert_posting(posting, image_id):
+    """
+    Inserts an id in a sorted posting list, appending directly when ids arrive in ascending order.
+    ---
+    :param <posting>: <list> ; sorted list of ids
+    :param <image_id>: <integer> ; id to insert
+    """
+    if len(posting) == 0 or posting[-1] < image_id:
+        posting.append(image_id)
+        return
+    position = bisect.bisect_left(posting, image_id)
+    if position == len(posting) or posting[position] != image_id: posting.insert(position, image_id)
+
+def remove_posting(posting, image_id):
+    """
+    Removes an id from a sorted posting list if it is present.
+    ---
+    :param <posting>: <list> ; sorted list of ids
+    :param <image_id>: <integer> ; id to remove
+    """
+    position = bisect.bisect_left(posting, image_id)
+    if position < len(posting) and posting[position] == image_id: del posting[position]
+
+def intersect_postings(postings):
+    """
+    Intersects sorted posting lists, starting from the shortest one and
+    searching the others by bisection from the last matched position.
+    ---
+    :param <postings>: <list> ; list of sorted lists of ids
+    """
+    if postings == []: return []
+    postings = sorted(postings, key = len)
+    result = postings[0]
+    for posting in postings[1:]:
+        kept, low = [], 0
+        for image_id in result:
+            low = bisect.bisect_left(posting, image_id, low)
+            if low == len(posting): break
+            if posting[low] == image_id: kept.append(image_id)
+        result = kept
+        if result == []: break
+    return list(result)
+
+def union_postings(postings):
+    """
+    Merges sorted posting lists into one sorted list without duplicates.
+    ---
+    :param <postings>: <list> ; list of sorted lists of ids
+    """
+    result = []
+    for image_id in heapq.merge(*postings):
+        if result == [] or result[-1] != image_id: result.append(image_id)
+    return result
+
+def subtract_postings(posting, removed):
+    """
+    Returns the ids of a sorted posting list that are absent from another sorted posting list.
+    ---
+    :param <posting>: <list> ; sorted list of ids
+    :param <removed>: <list> ; sorted list of ids to subtract
+    """
+    if len(removed) == 0: return list(posting)
+    kept, low = [], 0
+    for image_id in posting:
+        low = bisect.bisect_left(removed, image_id, low)
+        if low == len(removed) or removed[low] != image_id: kept.append(image_id)
+    return kept
+
+class tag_index:
+    """
+    Persistent inverted index mapping each tag to the sorted list of ids of the pictures carrying it.
+    The index is stored as a binary snapshot ('derpibooru_tag_index.bin') and an append-only log of changes
+    ('derpibooru_tag_index.jsonl') that is folded into the snapshot once it grows large enough.
+    The snapshot starts with a JSON header giving the position of each posting list, followed by the
+    indexed ids and the posting lists as 32-bit integers: a posting list is only read when a query uses it.
+    The medium urls are kept apart ('derpibooru_tag_index.urls': the count and sorted ids, the offsets of
+    the urls then the urls themselves), and only read when url() or urls_of() is first called.
+    The sha512 digests of the pictures are kept apart ('derpibooru_tag_index.hashes': the sorted ids as
+    32-bit integers followed by the 64-byte digests), and only read when hashes_of() is first called.
+    """
+    def __init__(self, folder, compact_min = 10000):
+        """
+        Loads the tag index stored in <folder>.
+        ---
+        :param <folder>: <str> ; folder where the index files are stored
+        :param <compact_min>: <integer> ; minimum number of logged changes before the log is folded into the snapshot
+        """
+        self.snapshot_path = os.path.join(folder, INDEX_NAME + ".bin")
+        self.legacy_path = os.path.join(folder, INDEX_NAME + ".json")
+        self.log_path = os.path.join(folder, INDEX_NAME + ".jsonl")
+        self.urls_path = os.path.join(folder, INDEX_NAME + ".urls")
+        self.hashes_path = os.path.join(folder, INDEX_NAME + ".hashes")
+        self.compact_min = compact_min
+        # Position (start, length) of each posting list in the snapshot and posting lists read or changed since
+        self.tags = {}
+        self.data_start = 0
+        self.postings = {}
+        self.ids = array("I")
+        # Urls of the url file (loaded lazily) and urls indexed since it was written
+        self.url_ids = None
+        self.url_offsets = None
+        self.url_blob = None
+        self.new_urls = {}
+        # Digests of the hash file (loaded lazily) and digests indexed since it was written
+        self.hash_ids = None
+        self.hash_digests = None
+        self.new_hashes = {}
+        self.last_id = 0
+        self.logged = 0
+        self.load()
+
+    def load(self):
+        """
+        Reads the snapshot then replays the log of changes.
+        """
+        migrated = False
+        if os.path.exists(self.snapshot_path):
+            with open(self.snapshot_path, "rb") as file:
+                size = array("I")
+                size.fromfile(file, 1)
+                header = json.loads(file.read(size[0]))
+                self.ids.fromfile(file, header["ids"])
+            self.tags = header["tags"]
+            self.data_start = size.itemsize + size[0]
+            self.last_id = header["last_id"]
+        elif os.path.exists(self.legacy_path):
+            # Former snapshots were a single JSON document: they are rewritten in the binary layout
+            with open(self.legacy_path, "r") as file: snapshot = json.load(file)
+            self.postings = {tag: array("I", posting) for tag, posting in snapshot["postings"].items()}
+            self.ids = array("I", snapshot["ids"])
+            self.new_urls = {int(image_id): url for image_id, url in snapshot["urls"].items()}
+            self.last_id = snapshot["last_id"]
+            for image_id, sha in snapshot.get("hashes", {}).items(): self.add_hash(int(image_id), sha)
+            migrated = True
+        if os.path.exists(self.log_path):
+            truncated = False
+            with open(self.log_path, "r") as file:
+                for line in file:
+                    try: change = json.loads(line)
+                    except ValueError:
+                        truncated = True
+                        break
+                    self.apply(change)
+                    self.logged += 1
+            # Drops a partially written change by folding the valid part of the log into the snapshot
+            migrated = migrated or truncated
+        if migrated: self.compact()
+        if os.path.exists(self.legacy_path) and os.path.exists(self.snapshot_path): os.remove(self.legacy_path)
+
+    def posting(self, tag, create = False):
+        """
+        Returns the sorted posting list of a tag, reading it from the snapshot the first time it is used.
+        ---
+        :param <tag>: <str> ; tag
+        :param <create>: <boolean> ; toggles keeping an empty posting list for an unknown tag (to insert ids in it)
+        """
+        if tag in self.postings: return self.postings[tag]
+        posting = array("I")
+        if tag in self.tags:
+            start, length = self.tags[tag]
+            with open(self.snapshot_path, "rb") as file:
+                file.seek(self.data_start + start * posting.itemsize)
+                posting.fromfile(file, length)
+        elif not create: return posting
+        self.postings[tag] = posting
+        return posting
+
+    def load_urls(self):
+        """
+        Reads the url file, if it was not read yet.
+        """
+        if self.url_ids is not None: return
+        self.url_ids, self.url_offsets, self.url_blob = array("I"), array("I", [0]), b""
+        if not os.path.exists(self.urls_path): return
+        with open(self.urls_path, "rb") as file:
+            count = array("I")
+            count.fromfile(file, 1)
+            self.url_ids.fromfile(file, count[0])
+            self.url_offsets = array("I")
+            self.url_offsets.fromfile(file, count[0] + 1)
+            self.url_blob = file.read()
+
+    def url(self, image_id):
+        """
+        Returns the medium url of a picture (None if it has none).
+        ---
+        :param <image_id>: <integer> ; id of the picture
+        """
+        if image_id in self.new_urls: return self.new_urls[image_id]
+        self.load_urls()
+        position = bisect.bisect_left(self.url_ids, image_id)
+        if position == len(self.url_ids) or self.url_ids[position] != image_id: return None
+        return self.url_blob[self.url_offsets[position]:self.url_offsets[position + 1]].decode("utf-8")
+
+    def urls_of(self, ids):
+        """
+        Iterates over the (id, medium url) of the given ids that have a url.
+        ---
+        :param <ids>: <list> ; ids of the pictures
+        """
+        for image_id in ids:
+            url = self.url(image_id)
+            if url is not None: yield (image_id, url)
+
+    def save_urls(self):
+        """
+        Merges the urls indexed since the url file was written into a new url file.
+        """
+        if self.new_urls == {}: return
+        self.load_urls()
+        url_ids = sorted(set(self.url_ids) | set(self.new_urls))
+        urls = [self.url(image_id).encode("utf-8") for image_id in url_ids]
+        offsets = array("I", [0])
+        for url in urls: offsets.append(offsets[-1] + len(url))
+        write_atomic(self.urls_path, array("I", [len(url_ids)]).tobytes() + array("I", url_ids).tobytes() +
+                     offsets.tobytes() + b"".join(urls), "wb")
+        self.url_ids, self.url_offsets, self.url_blob, self.new_urls = None, None, None, {}
+
+    def add_hash(self, image_id, sha):
+        """
+        Records the sha512 digest of a picture.
+        ---
+        :param <image_id>: <integer> ; id of the picture
+        :param <sha>: <str> ; hexadecimal sha512 hash (ignored if it is not one)
+        """
+        try: digest = bytes.fromhex(sha)
+        except (TypeError, ValueError): return
+        if len(digest) == DIGEST_SIZE: self.new_hashes[image_id] = digest
+
+    def load_hashes(self):
+        """
+        Reads the hash file, if it was not read yet.
+        """
+        if self.hash_ids is not None: return
+        self.hash_ids, self.hash_digests = array("I"), b""
+        if not os.path.exists(self.hashes_path): return
+        with open(self.hashes_path, "rb") as file:
+            count = os.fstat(file.fileno()).st_size // (self.hash_ids.itemsize + DIGEST_SIZE)
+            self.hash_ids.fromfile(file, count)
+            self.hash_digests = file.read(count * DIGEST_SIZE)
+
+    def digest(self, image_id):
+        """
+        Returns the sha512 digest of a picture (None if it is unknown).
+        ---
+        :param <image_id>: <integer> ; id of the picture
+        """
+        if image_id in self.new_hashes: return self.new_hashes[image_id]
+        self.load_hashes()
+        position = bisect.bisect_left(self.hash_ids, image_id)
+        if position == len(self.hash_ids) or self.hash_ids[position] != image_id: return None
+        return self.hash_digests[position * DIGEST_SIZE:(position + 1) * DIGEST_SIZE]
+
+    def hashes_of(self, ids):
+        """
+        Returns a dictionary {id: sha512_hash} (hexadecimal) of the given ids whose hash is known.
+        ---
+        :param <ids>: <list> ; ids of the pictures
+        """
+        hashes = {}
+        for image_id in ids:
+            digest = self.digest(image_id)
+            if digest is not None: hashes[image_id] = digest.hex()
+        return hashes
+
+    def save_hashes(self):
+        """
+        Merges the digests indexed since the hash file was written into a new hash file.
+        """
+        if self.new_hashes == {}: return
+        self.load_hashes()
+        hashed = sorted(set(self.hash_ids) | set(self.new_hashes))
+        write_atomic(self.hashes_path, array("I", hashed).tobytes() +
+                     b"".join(self.digest(image_id) for image_id in hashed), "wb")
+        self.hash_ids, self.hash_digests, self.new_hashes = None, None, {}
+
+    def apply(self, change):
+        """
+        Applies one change of the log to the in-memory index.
+        ---
+        :param <change>: <dict> ; {"id", "tags", "url", "hash"} and optionally "old" (tags to unlink first)
+        """
+        image_id = change["id"]
+        # Emptied posting lists are kept until the next compaction so that the snapshot is not read again
+        for tag in change.get("old", []): remove_posting(self.posting(tag), image_id)
+        for tag in change["tags"]: insert_posting(self.posting(tag, create = True), image_id)
+        insert_posting(self.ids, image_id)
+        if change.get("url") is not None: self.new_urls[image_id] = change["url"]
+        if change.get("hash") is not None: self.add_hash(image_id, change["hash"])
+        self.last_id = max(self.last_id, image_id)
+
+    def record_changes(self, changes):
+        """
+        Logs a list of changes to disk, applies them and compacts the index if needed.
+        ---
+        :param <changes>: <list> ; list of changes (see apply())
+        """
+        if changes == []: return
+        with open(self.log_path, "a") as file:
+            file.write("".join(json.dumps(change) + "\n" for change in changes))
+        for change in changes: self.apply(change)
+        self.logged += len(changes)
+        if self.logged >= max(self.compact_min, len(self.ids) // 2): self.compact()
+
+    def add_records(self, records):
+        """
+        Indexes newly stored metadata records.
+        ---
+        :param <records>: <list> ; list of metadata dictionaries
+        """
+        self.record_changes([{"id": record["id"], "tags": split_tags(record),
+                              "url": (record.get("representations") or {}).get("medium"),
+                              "hash": record.get("sha512_hash")}
+                             for record in records])
+
+    def update_record(self, old_record, new_record):
+        """
+        Re-indexes a record whose tags changed.
+        ---
+        :param <old_record>: <dict> ; metadata record as previously indexed
+        :param <new_record>: <dict> ; updated metadata record
+        """
+        self.record_changes([{"id": new_record["id"], "old": split_tags(old_record),
+                              "tags": split_tags(new_record),
+                              "url": (new_record.get("representations") or {}).get("medium"),
+                              "hash": new_record.get("sha512_hash")}])
+
+    def compact(self):
+        """
+        Folds the log of changes into a new snapshot and empties the log.
+        """
+        self.save_urls()
+        self.save_hashes()
+        # Posting lists that were never read are copied from the previous snapshot
+        previous = array("I")
+        if any(tag not in self.postings for tag in self.tags):
+            with open(self.snapshot_path, "rb") as file:
+                file.seek(self.data_start)
+                previous.frombytes(file.read())
+        data, tags = array("I", self.ids), {}
+        for tag in sorted(set(self.tags) | set(self.postings)):
+            if tag in self.postings: posting = self.postings[tag]
+            else: posting = previous[self.tags[tag][0]:self.tags[tag][0] + self.tags[tag][1]]
+            if len(posting) == 0: continue
+            tags[tag] = [len(data), len(posting)]
+            data.extend(posting)
+        header = json.dumps({"last_id": self.last_id, "ids": len(self.ids), "tags": tags}).encode("utf-8")
+        write_atomic(self.snapshot_path, array("I", [len(header)]).tobytes() + header + data.tobytes(), "wb")
+        self.tags, self.data_start, self.postings = tags, data.itemsize + len(header), {}
+        with open(self.log_path, "w") as file: file.write("")
+        self.logged = 0
+
+    def catch_up(self, store):
+        """
+        Indexes the records of the store that are more recent than the last indexed id
+        (e.g. metadata crawled before the index existed or after an interruption).
+        ---
+        :param <store>: <segment_store> ; metadata store
+        """
+        if store.last_id() <= self.last_id: return
+        floor = self.last_id
+        log.info(f"Indexing stored metadata above the id {floor}.")
+        for entry in store.segments():
+            if entry["max_id"] <= floor: continue
+            self.add_records([record for record in store.read_segment(entry) if record["id"] > floor])
+        self.compact()
+
+    def evaluate(self, node):
+        """
+        Returns the sorted ids matching a parsed tag-only query node (see derpi_get/query.py)
+        by intersecting, merging and subtracting posting lists.
+        ---
+        :param <node>: <tuple> ; parsed query node
+        """
+        kind = node[0]
+        if kind == "tag": return self.posting(node[1])
+        if kind == "not": return subtract_postings(self.ids, self.evaluate(node[1]))
+        if kind == "or": return union_postings([self.evaluate(child) for child in node[1]])
+        positives = [self.evaluate(child) for child in node[1] if child[0] != "not"]
+        negatives = [self.evaluate(child[1]) for child in node[1] if child[0] == "not"]
+        kept = intersect_postings(positives) if positives != [] else self.ids
+        return subtract_postings(kept, union_postings(negatives))
+
+    def query(self, tags_keep, tags_remove, at_least_one):
+        """
+        Returns the sorted ids carrying at least one (or all) of <tags_keep> and none of <tags_remove>.
+        ---
+        :param <tags_keep>: <list> ; tags that pictures must carry
+        :param <tags_remove>: <list> ; tags that pictures must not carry
+        :param <at_least_one>: <boolean> ; toggles 'at least one tag' instead of 'all tags'
+        """
+        keep = [self.posting(tag) for tag in tags_keep]
+        if at_least_one: kept = union_postings(keep)
+        elif keep == []: kept = self.ids
+        else: kept = intersect_postings(keep)
+        removed = union_postings([self.posting(tag) for tag in tags_remove])
+        return subtract_postings(kept, removed)
@@ -0,0 +1,57 @@
+import os
+import shutil
+import tempfile
+import unittest
+from datetime import date
+from derpi_get.backends import segment_backend
+from derpi_get.columnar import export_columnar, query_columnar
+
+def records():
+    """
+    Returns metadata records of the ids 1 to 4, created at the start and end of two days.
+    """
+    created = ["2019-01-01T00:00:00Z", "2019-01-01T23:59:59Z", "2019-01-02T12:00:00Z", "2019-01-03T00:00:00Z"]
+    return [{"id": image_id, "tags": "safe", "created_at": created_at,
+             "representations": {"medium": f"//derpicdn.net/{image_id}/medium.png"}}
+            for image_id, created_at in enumerate(created, 1)]
+
+class test_date_ranges(unittest.TestCase):
+    """
+    Date bounds without a timezone are taken as UTC, and a day given as upper bound includes the whole day.
+    """
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        backend = segment_backend(self.folder)
+        backend.append(records())
+        self.path = os.path.join(self.folder, "metadata.parquet")
+        export_columnar(backend, self.path)
+        backend.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def ids(self, low, high):
+        """
+        Returns the ids of the pictures created between <low> and <high>.
+        ---
+        :param <low>: <str>, <date> or <datetime> ; lower bound (None for no bound)
+        :param <high>: <str>, <date> or <datetime> ; upper bound (None for no bound)
+        """
+        return [image_id for image_id, _ in query_columnar(self.path, ranges = {"created_at": (low, high)},
+                                                            at_least_one = False)]
+
+    def test_days(self):
+        self.assertEqual(self.ids("2019-01-01", "2019-01-01"), [1, 2])
+        self.assertEqual(self.ids("2019-01-02", None), [3, 4])
+        self.assertEqual(self.ids(None, date(2019, 1, 2)), [1, 2, 3])
+
+    def test_times(self):
+        self.assertEqual(self.ids("2019-01-01T12:00:00", "2019-01-02T12:00:00"), [2, 3])
+        self.assertEqual(self.ids("2019-01-02T13:00:00+01:00", "2019-01-03T00:00:00Z"), [3, 4])
+
+    def test_tags(self):
+        self.assertEqual(query_columnar(self.path, ["safe"])[0], (1, "derpicdn.net/1/medium.png"))
+        self.assertEqual(query_columnar(self.path, ["safe"], ["safe"]), [])
+
+if __name__ == "__main__":
+    unittest.main()
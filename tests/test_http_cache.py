@@ -0,0 +1,119 @@
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from derpi_get.http_cache import http_cache
+
+class server:
+    """
+    Local HTTP server answering every path with one body, an ETag and a Cache-Control header,
+    and with a 304 to requests bearing the current ETag.
+    """
+    def __init__(self, cache_control):
+        """
+        Starts the server on a free port.
+        ---
+        :param <cache_control>: <str> ; Cache-Control header of the responses
+        """
+        self.body, self.etag, self.cache_control = b"first", '"1"', cache_control
+        self.statuses = []
+        owner = self
+
+        class handler(BaseHTTPRequestHandler):
+            """
+            Serves the body of the server, or a 304 if it was not modified.
+            """
+            def log_message(self, *args):
+                """
+                Silences the access log of the server.
+                """
+                pass
+
+            def do_GET(self):
+                """
+                Answers with a 304 if the ETag sent matches, else with the body.
+                """
+                status = 304 if self.headers.get("If-None-Match") == owner.etag else 200
+                owner.statuses.append(status)
+                self.send_response(status)
+                self.send_header("ETag", owner.etag)
+                self.send_header("Cache-Control", owner.cache_control)
+                self.send_header("Content-Length", "0" if status == 304 else str(len(owner.body)))
+                self.end_headers()
+                if status == 200: self.wfile.write(owner.body)
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        self.url = f"http://127.0.0.1:{self.httpd.server_port}/resource"
+        threading.Thread(target = self.httpd.serve_forever, daemon = True).start()
+
+    def close(self):
+        """
+        Stops the server.
+        """
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+class test_http_cache(unittest.TestCase):
+    """
+    Fresh entries are served without requests, stale ones are revalidated and the least recently used are evicted.
+    """
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def serve(self, cache_control):
+        """
+        Starts a local server that is stopped at the end of the test.
+        ---
+        :param <cache_control>: <str> ; Cache-Control header of the responses
+        """
+        local = server(cache_control)
+        self.addCleanup(local.close)
+        return local
+
+    def test_fresh(self):
+        local = self.serve("max-age=60")
+        cache = http_cache(self.folder)
+        self.assertEqual(cache.get(local.url).content, b"first")
+        response = cache.get(local.url)
+        self.assertTrue(response.from_cache)
+        self.assertEqual((response.content, local.statuses), (b"first", [200]))
+
+    def test_revalidation(self):
+        local = self.serve("no-cache")
+        cache = http_cache(self.folder)
+        cache.get(local.url)
+        response = cache.get(local.url)
+        self.assertTrue(response.from_cache)
+        self.assertEqual((response.content, local.statuses), (b"first", [200, 304]))
+        local.body, local.etag = b"second", '"2"'
+        self.assertEqual(http_cache(self.folder).get(local.url).content, b"second")
+        self.assertEqual(local.statuses, [200, 304, 200])
+
+    def test_no_store(self):
+        local = self.serve("no-store")
+        cache = http_cache(self.folder)
+        cache.get(local.url)
+        cache.get(local.url)
+        self.assertEqual(local.statuses, [200, 200])
+
+    def test_eviction(self):
+        cache = http_cache(self.folder, max_size = 1000)
+        headers = {"Cache-Control": "max-age=60"}
+        urls = {name: f"http://derpibooru.org/{name}" for name in ["a", "b", "c", "d"]}
+        for name in ["a", "b", "c"]: cache.store(cache.key(urls[name]), urls[name], headers, content = b"x" * 300)
+        cache.use(cache.key(urls["a"]))
+        cache.store(cache.key(urls["d"]), urls["d"], headers, content = b"x" * 300)
+        kept = [name for name in urls if cache.load(cache.key(urls[name])) is not None]
+        self.assertEqual(kept, ["a", "c", "d"])
+        self.assertLessEqual(cache.total_size, 1000)
+        # The bookkeeping is rebuilt from the files when the cache is opened again
+        self.assertEqual(http_cache(self.folder, max_size = 1000).total_size, 900)
+        self.assertEqual(len([fname for fname in os.listdir(self.folder) if fname.endswith(".body")]), 3)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,61 @@
+import unittest
+from derpi_get.query import QuerySyntaxError, compile_query, parser, tokenize
+
+def record(tags, **fields):
+    """
+    Returns a metadata record carrying <tags>.
+    ---
+    :param <tags>: <str> ; tags of the record, separated by ', '
+    :param <fields>: <dict> ; other fields of the record (e.g. score)
+    """
+    return dict(fields, id = 1, tags = tags)
+
+class test_parser(unittest.TestCase):
+    """
+    Operator precedence, aliases, quoting and field comparisons of the query language.
+    """
+    def parse(self, expression):
+        """
+        Returns the tree of a query expression.
+        ---
+        :param <expression>: <str> ; query expression
+        """
+        return parser(tokenize(expression)).parse()
+
+    def test_precedence(self):
+        self.assertEqual(self.parse("a OR b AND NOT c"),
+                         ("or", [("tag", "a"), ("and", [("tag", "b"), ("not", ("tag", "c"))])]))
+        self.assertEqual(self.parse("(a || b) && !c"),
+                         ("and", [("or", [("tag", "a"), ("tag", "b")]), ("not", ("tag", "c"))]))
+
+    def test_tags_with_spaces_and_keywords(self):
+        self.assertEqual(self.parse("pinkie pie, NOTE"), ("and", [("tag", "pinkie pie"), ("tag", "NOTE")]))
+        self.assertEqual(self.parse('"a && b" OR c'), ("or", [("tag", "a && b"), ("tag", "c")]))
+
+    def test_fields(self):
+        self.assertEqual(self.parse("score.gte:100"), ("field", "score", "gte", 100.0))
+        self.assertEqual(self.parse("artist:foo"), ("tag", "artist:foo"))
+        with self.assertRaises(QuerySyntaxError): self.parse("score.gt:many")
+
+    def test_syntax_errors(self):
+        for expression in ["", "a AND", "(a OR b", "a b)"]:
+            with self.assertRaises(QuerySyntaxError): self.parse(expression)
+
+class test_match(unittest.TestCase):
+    """
+    Compiled queries agree with the parsed expression on records.
+    """
+    def test_match(self):
+        query = compile_query("(a OR b) AND NOT c AND score.gt:10")
+        self.assertTrue(query.match(record("a, d", score = 11)))
+        self.assertFalse(query.match(record("a, c", score = 11)))
+        self.assertFalse(query.match(record("b", score = 10)))
+        self.assertFalse(query.match(record("b")))
+        self.assertFalse(query.tag_only)
+        self.assertTrue(compile_query("a AND NOT b").tag_only)
+
+    def test_missing_tags(self):
+        self.assertTrue(compile_query("NOT a").match({"id": 1, "tags": None}))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,52 @@
+import unittest
+from derpi_get.rate_limiter import rate_controller
+
+class response:
+    """
+    Minimal server response: a status code and headers.
+    """
+    def __init__(self, status_code, headers = None):
+        """
+        Initializes the response.
+        ---
+        :param <status_code>: <integer> ; status of the response
+        :param <headers>: <dict> ; headers of the response
+        """
+        self.status_code = status_code
+        self.headers = headers or {}
+
+class test_aimd(unittest.TestCase):
+    """
+    The rate halves on each throttling answer down to its floor and grows back additively up to its ceiling.
+    """
+    def test_decrease_then_increase(self):
+        controller = rate_controller(rate = 4.0, min_rate = 0.5, increase = 1.0, decrease = 0.5)
+        for expected in [2.0, 1.0, 0.5, 0.5]:
+            controller.observe(response(429))
+            self.assertAlmostEqual(controller.rate, expected)
+        for expected in [1.5, 2.5, 3.5, 4.0, 4.0]:
+            controller.observe(response(200))
+            self.assertAlmostEqual(controller.rate, expected)
+
+    def test_retry_after_pauses(self):
+        controller = rate_controller(rate = 4.0)
+        controller.observe(response(503, {"Retry-After": "30"}))
+        self.assertGreater(controller.take(), 29)
+
+    def test_rate_limit_headers(self):
+        controller = rate_controller(rate = 4.0)
+        controller.observe(response(200, {"X-RateLimit-Remaining": "10", "X-RateLimit-Reset": "10"}))
+        self.assertAlmostEqual(controller.rate, 1.0)
+        controller.observe(response(200, {"RateLimit-Remaining": "0", "RateLimit-Reset": "60"}))
+        self.assertGreater(controller.take(), 59)
+
+    def test_back_off_gives_up(self):
+        controller = rate_controller(rate = 4.0, base_delay = 0.001, max_failures = 2)
+        error = IOError("unreachable")
+        controller.back_off(error)
+        controller.back_off(error)
+        with self.assertRaises(IOError): controller.back_off(error)
+        self.assertEqual(controller.failures, 0)
+
+if __name__ == "__main__":
+    unittest.main()
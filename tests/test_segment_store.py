@@ -0,0 +1,85 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from derpi_get.segment_store import segment_store
+
+def records(start, end):
+    """
+    Returns minimal metadata records of the ids in [start, end].
+    ---
+    :param <start>: <integer> ; first id
+    :param <end>: <integer> ; last id
+    """
+    return [{"id": image_id, "tags": "safe"} for image_id in range(start, end + 1)]
+
+class test_convert_then_append(unittest.TestCase):
+    """
+    Segments sealed after a conversion must not take the name of a converted segment.
+    """
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        for number, (start, end) in enumerate([(1, 100), (101, 200)]):
+            with open(os.path.join(self.folder, f"derpibooru_metadata_{number}.json"), "w") as file:
+                json.dump(records(start, end), file)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_records_survive(self):
+        store = segment_store(self.folder, max_records = 100)
+        self.assertEqual(store.convert("gzip"), 2)
+        store.append(records(201, 300))
+        store = segment_store(self.folder, max_records = 100)
+        ids = [record["id"] for record in store.iter_records()]
+        self.assertEqual(sorted(ids), list(range(1, 301)))
+        files = [entry["file"] for entry in store.manifest["segments"]]
+        self.assertEqual(len(files), len(set(files)))
+
+class test_crash_recovery(unittest.TestCase):
+    """
+    Opening a store completes or undoes the writes that an interruption left half done.
+    """
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_partial_line(self):
+        store = segment_store(self.folder)
+        store.append(records(1, 10))
+        with open(store.active_path, "a") as file: file.write('{"id": 11, "ta')
+        store = segment_store(self.folder)
+        self.assertEqual(store.last_id(), 10)
+        store.append(records(11, 12))
+        ids = [record["id"] for record in segment_store(self.folder).iter_records()]
+        self.assertEqual(ids, list(range(1, 13)))
+
+    def test_interrupted_seal(self):
+        store = segment_store(self.folder, max_records = 100)
+        store.append(records(1, 10))
+        # The manifest lists the sealed segment but the active segment was not renamed yet
+        active = store.manifest["active"]
+        store.manifest["segments"].append({"file": "derpibooru_metadata_0.jsonl", "format": "jsonl",
+                                           "min_id": active["min_id"], "max_id": active["max_id"],
+                                           "records": active["records"]})
+        store.manifest["next_segment"] = 1
+        store.save_manifest()
+        store = segment_store(self.folder, max_records = 100)
+        self.assertTrue(os.path.exists(os.path.join(self.folder, "derpibooru_metadata_0.jsonl")))
+        self.assertEqual(store.manifest["active"]["records"], 0)
+        self.assertEqual([record["id"] for record in store.iter_records()], list(range(1, 11)))
+
+    def test_interrupted_encoding(self):
+        store = segment_store(self.folder, max_records = 10)
+        store.append(records(1, 10))
+        leftover = os.path.join(self.folder, "derpibooru_metadata_0.jsonl.gz.tmp")
+        with open(leftover, "wb") as file: file.write(b"half written")
+        store = segment_store(self.folder, max_records = 10)
+        self.assertFalse(os.path.exists(leftover))
+        self.assertEqual(len(list(store.iter_records())), 10)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,70 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from derpi_get.segment_store import segment_store
+from derpi_get.tag_index import tag_index
+
+def records(start, end):
+    """
+    Returns metadata records of the ids in [start, end]: every picture is 'safe', even ids are also 'cat'.
+    ---
+    :param <start>: <integer> ; first id
+    :param <end>: <integer> ; last id
+    """
+    return [{"id": image_id, "tags": "safe, cat" if image_id % 2 == 0 else "safe",
+             "representations": {"medium": f"//derpicdn.net/{image_id}/medium.png"},
+             "sha512_hash": hashlib.sha512(str(image_id).encode()).hexdigest()}
+            for image_id in range(start, end + 1)]
+
+class test_tag_index(unittest.TestCase):
+    """
+    The index catches up with the store, survives reopening and compaction, and migrates former snapshots.
+    """
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_catch_up(self):
+        store = segment_store(self.folder, max_records = 25)
+        store.append(records(1, 60))
+        index = tag_index(self.folder)
+        index.catch_up(store)
+        self.assertEqual((index.last_id, len(index.ids)), (60, 60))
+        # Records stored while the index was not updated are indexed on the next catch-up only
+        store.append(records(61, 70))
+        index = tag_index(self.folder)
+        self.assertEqual(index.last_id, 60)
+        index.catch_up(store)
+        self.assertEqual(index.query(["cat"], [], True), list(range(2, 71, 2)))
+
+    def test_reopen_and_compact(self):
+        index = tag_index(self.folder, compact_min = 1000)
+        index.add_records(records(1, 20))
+        index.update_record(records(4, 4)[0], dict(records(4, 4)[0], tags = "dog"))
+        for compact in [False, True]:
+            if compact: index.compact()
+            index = tag_index(self.folder, compact_min = 1000)
+            self.assertEqual(index.query(["cat"], ["safe"], True), [])
+            self.assertEqual(index.query(["dog", "cat"], [], True), list(range(2, 21, 2)))
+            self.assertEqual(list(index.posting("dog")), [4])
+            self.assertEqual(index.url(3), "//derpicdn.net/3/medium.png")
+            self.assertEqual(index.hashes_of([5, 99]), {5: hashlib.sha512(b"5").hexdigest()})
+
+    def test_legacy_snapshot(self):
+        with open(os.path.join(self.folder, "derpibooru_tag_index.json"), "w") as file:
+            json.dump({"last_id": 2, "ids": [1, 2], "urls": {"1": "//a/1.png"}, "hashes": {"2": "ab" * 64},
+                       "postings": {"safe": [1, 2], "cat": [2]}}, file)
+        index = tag_index(self.folder)
+        self.assertFalse(os.path.exists(os.path.join(self.folder, "derpibooru_tag_index.json")))
+        index = tag_index(self.folder)
+        self.assertEqual(index.query(["safe"], ["cat"], False), [1])
+        self.assertEqual(list(index.urls_of([1, 2])), [(1, "//a/1.png")])
+        self.assertEqual(index.hashes_of([1, 2]), {2: "ab" * 64})
+
+if __name__ == "__main__":
+    unittest.main()